@@ -1,6 +1,7 @@
 from django.contrib import admin
 from shopify.models import *
 from shopify.forms import BulkUpdatePriceForm, ApplyDiscountForm
+from shopify.utils import update_cache_columns
 from django.shortcuts import render
 from django.urls import path
 from django.http import HttpResponseRedirect
@@ -17,6 +18,7 @@ def update_price(modeladmin, request, queryset):
             price = form.cleaned_data['price']
                         
             updated_count = queryset.update(price=price)            
+            update_cache_columns(queryset)
             modeladmin.message_user(request, f"{updated_count} products' prices updated to {price}.")
                         
             return HttpResponseRedirect(reverse('admin:shopify_product_changelist'))
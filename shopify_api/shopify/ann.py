@@ -0,0 +1,243 @@
+from django.conf import settings
+from shopify.encoders import normalize_embeddings
+from shopify.embedding_store import BundleWriter, append_bundle, find_rows, get_index_path, index_lock, load_bundle, read_bundle, remove_bundle, touch_bundle
+import numpy as np
+import os
+
+# Inverted file index: products are grouped by their nearest centroid and a
+# query only scores the products of its nprobe nearest groups. Vectors stay
+# in the embeddings bundle, this index holds the centroids and the product
+# ids of every group.
+#
+# Saved products join a delta of (id, group) pairs appended in place, and
+# their previous entries are flagged as deleted. Searches scan the delta of
+# the probed groups too, a rebuild of the embeddings merges it into the
+# lists. A delta that fills up first is merged with the current centroids.
+IVF_INDEX = "product_ivf"
+ASSIGN_BATCH_SIZE = 65536
+
+
+def top_k(scores, k):
+
+    # Positions of the k highest scores, best first. A 2D array is ranked
+    # row by row
+    k = min(k, scores.shape[-1])
+
+    if k <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+
+    candidates = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=-1), axis=-1, kind='stable')
+
+    return np.take_along_axis(candidates, order, axis=-1)
+
+def default_nlist(rows):
+    return max(1, min(rows, int(4 * np.sqrt(rows))))
+
+def assign_lists(embeddings, centroids):
+
+    lists = np.empty(len(embeddings), dtype=np.int32)
+
+    for start in range(0, len(embeddings), ASSIGN_BATCH_SIZE):
+        lists[start:start + ASSIGN_BATCH_SIZE] = np.argmax(embeddings[start:start + ASSIGN_BATCH_SIZE] @ centroids.T, axis=1)
+
+    return lists
+
+def train_centroids(embeddings, nlist, iterations=10, sample_size=None, seed=0):
+
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(embeddings), sample_size or nlist * 64)
+
+    # Sorted positions keep reads from the mapped file sequential
+    sample = np.asarray(embeddings[np.sort(rng.choice(len(embeddings), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+    # Spherical k-means, the rows are unit vectors and ranked by cosine
+    for _ in range(iterations):
+
+        lists = assign_lists(sample, centroids)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, sample)
+        counts = np.bincount(lists, minlength=nlist)
+
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+
+        centroids = normalize_embeddings(sums)
+
+    return centroids
+
+def _group_lists(ids, lists, nlist):
+
+    order = np.lexsort((ids, lists))
+
+    return {
+        "ids": ids[order],
+        "offsets": np.searchsorted(lists[order], np.arange(nlist + 1)).astype(np.int64)
+    }
+
+def build_ivf(ids, embeddings, nlist=None, iterations=10, seed=0):
+
+    nlist = nlist or default_nlist(len(ids))
+    nlist = max(1, min(nlist, len(ids)))
+
+    if not len(ids):
+        return {"centroids": np.zeros((1, embeddings.shape[1]), dtype=np.float32), "ids": np.empty(0, dtype=np.int64), "offsets": np.zeros(2, dtype=np.int64)}
+
+    centroids = train_centroids(embeddings, nlist, iterations=iterations, seed=seed)
+
+    return {"centroids": centroids, **_group_lists(np.asarray(ids, dtype=np.int64), assign_lists(embeddings, centroids), nlist)}
+
+def get_delta_capacity(rows):
+    return 2 * max(settings.SEMANTIC_SEARCH_COMPACT_MIN_ROWS, int(settings.SEMANTIC_SEARCH_COMPACT_RATIO * rows))
+
+def search_ivf(ivf, product_embeddings, query_embedding, top_n, nprobe, mask=None):
+
+    offsets = ivf["offsets"]
+    probed = top_k(ivf["centroids"] @ query_embedding, nprobe)
+    groups = [slice(offsets[group], offsets[group + 1]) for group in probed]
+
+    candidate_ids = np.concatenate([ivf["ids"][group] for group in groups])
+
+    if "deleted" in ivf:
+        candidate_ids = candidate_ids[np.concatenate([ivf["deleted"][group] for group in groups]) == 0]
+
+    if len(ivf.get("delta_ids", ())):
+        delta = np.isin(ivf["delta_lists"], probed) & (ivf["delta_deleted"] == 0)
+        candidate_ids = np.concatenate([candidate_ids, ivf["delta_ids"][delta]])
+
+    # Ids are mapped back to embedding rows, rows of products deleted from
+    # the embeddings but not yet from this index are dropped
+    rows, found = find_rows(product_embeddings, candidate_ids)
+    rows = np.sort(rows[found])
+
+    if mask is not None:
+        rows = rows[mask[rows]]
+
+    similarities = product_embeddings["embeddings"][rows] @ query_embedding
+    best = top_k(similarities, top_n)
+
+    return rows[best], similarities[best]
+
+def write_ivf_index(product_embeddings):
+
+    ids, embeddings = product_embeddings["ids"], product_embeddings["embeddings"]
+
+    # Rows of deleted products stay in the embeddings until their rebuild
+    if "live" in product_embeddings:
+        ids, embeddings = ids[product_embeddings["live"]], embeddings[product_embeddings["live"]]
+
+    ivf = build_ivf(ids, embeddings, nlist=settings.SEMANTIC_SEARCH_IVF_NLIST)
+
+    _write_ivf(ivf, meta={"trained_rows": len(ids)})
+
+def _write_ivf(ivf, meta):
+
+    ids = ivf["ids"]
+    id_rows = np.argsort(ids, kind='stable')
+    capacity = get_delta_capacity(len(ids))
+    writer = BundleWriter(get_index_path(IVF_INDEX))
+
+    try:
+
+        for name in ("centroids", "ids", "offsets"):
+            writer.add(name, ivf[name])
+
+        # Entries of a product are found through its id, ids sorted
+        writer.add("sorted_ids", ids[id_rows])
+        writer.add("id_rows", id_rows)
+        writer.add("deleted", np.zeros(len(ids), dtype=np.uint8))
+
+        writer.add("delta_ids", np.empty(0, dtype=np.int64), capacity=capacity)
+        writer.add("delta_lists", np.empty(0, dtype=np.int32), capacity=capacity)
+        writer.add("delta_deleted", np.empty(0, dtype=np.uint8), capacity=capacity)
+
+        writer.commit(meta)
+
+    except BaseException:
+        writer.abort()
+        raise
+
+def _merge_ivf_delta(ivf, meta, product_ids, lists):
+
+    nlist = len(ivf["centroids"])
+    base_lists = np.repeat(np.arange(nlist, dtype=np.int32), np.diff(ivf["offsets"]))
+    keep = ivf["deleted"] == 0
+    delta_keep = ivf["delta_deleted"] == 0
+
+    ids = np.concatenate([ivf["ids"][keep], ivf["delta_ids"][delta_keep], product_ids])
+    lists = np.concatenate([base_lists[keep], ivf["delta_lists"][delta_keep], lists])
+
+    _write_ivf({"centroids": np.asarray(ivf["centroids"]), **_group_lists(ids, lists, nlist)}, meta)
+
+def get_ivf_index(product_embeddings):
+
+    index_path = get_index_path(IVF_INDEX)
+    bundle = load_bundle(index_path)
+
+    if bundle is None:
+
+        with index_lock(IVF_INDEX):
+
+            bundle = load_bundle(index_path)
+
+            if bundle is None:
+                write_ivf_index(product_embeddings)
+                bundle = load_bundle(index_path)
+
+    _, ivf = bundle
+
+    return ivf
+
+def update_ivf_index(product_ids, embeddings=None):
+
+    index_path = get_index_path(IVF_INDEX)
+
+    # Built from the embeddings on the first ANN search
+    if not os.path.exists(index_path):
+        return
+
+    product_ids = np.asarray(product_ids, dtype=np.int64)
+
+    with index_lock(IVF_INDEX):
+
+        if not os.path.exists(index_path):
+            return
+
+        meta, ivf = read_bundle(index_path, mode="r+")
+
+        # Written before deltas were kept, the next search builds it again
+        if "delta_ids" not in ivf:
+            remove_bundle(index_path)
+            return
+
+        # Previous entries of the products are only flagged
+        sorted_ids = ivf["sorted_ids"]
+        positions = np.searchsorted(sorted_ids, product_ids).clip(max=max(len(sorted_ids) - 1, 0))
+        found = sorted_ids[positions] == product_ids if len(sorted_ids) else np.zeros(len(product_ids), dtype=bool)
+
+        if found.any():
+            ivf["deleted"][ivf["id_rows"][positions[found]]] = 1
+            ivf["deleted"].flush()
+
+        stale = np.flatnonzero(np.isin(ivf["delta_ids"], product_ids))
+
+        if len(stale):
+            ivf["delta_deleted"][stale] = 1
+            ivf["delta_deleted"].flush()
+
+        # Changed products join the group of their nearest centroid, the
+        # centroids themselves only move on a rebuild
+        if embeddings is None or not len(product_ids):
+            touch_bundle(index_path)
+            return
+
+        lists = assign_lists(embeddings, ivf["centroids"])
+        appended = {"delta_ids": product_ids, "delta_lists": lists, "delta_deleted": np.zeros(len(product_ids), dtype=np.uint8)}
+
+        if not append_bundle(index_path, appended):
+            _merge_ivf_delta(ivf, meta, product_ids, lists)
+
+def remove_ivf_index():
+    remove_bundle(get_index_path(IVF_INDEX))
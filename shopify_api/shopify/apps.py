@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def create_search_indexes(sender, using, **kwargs):
+    
+    from shopify.substring_search import create_substring_index
+    create_substring_index(using)
 
 
 class ShopifyConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'shopify'
+    
+    def ready(self):
+        
+        # Expression and virtual table indexes the migrations do not
+        # describe, created after every migrate
+        post_migrate.connect(create_search_indexes, sender=self)
@@ -0,0 +1,101 @@
+from django.conf import settings
+from django.utils import timezone
+from shopify.models import ProductHistory
+from datetime import timedelta
+import pandas as pd
+import glob
+import os
+
+# History past the retention lives in one directory per month, every
+# archive run adds part files named after the ids they hold. A run
+# interrupted between writing and deleting archives the same rows again,
+# reads drop the duplicate ids.
+ARCHIVE_COLUMNS = ['id', 'product_id', 'type', 'previous_quantity', 'current_quantity', 'updated_at']
+ARCHIVE_COMPRESSION = 'zstd'
+
+
+def get_month_dir(month):
+    return os.path.join(settings.PRODUCT_HISTORY_ARCHIVE_DIR, month)
+
+def get_archived_months():
+
+    if not os.path.isdir(settings.PRODUCT_HISTORY_ARCHIVE_DIR):
+        return []
+
+    return sorted(month for month in os.listdir(settings.PRODUCT_HISTORY_ARCHIVE_DIR) if os.path.isdir(get_month_dir(month)))
+
+def write_archive_part(month, frame):
+
+    month_dir = get_month_dir(month)
+    os.makedirs(month_dir, exist_ok=True)
+
+    part_path = os.path.join(month_dir, f"part-{frame['id'].iloc[0]:012d}-{frame['id'].iloc[-1]:012d}.parquet")
+    tmp_path = f"{part_path}.tmp"
+
+    frame.to_parquet(tmp_path, index=False, compression=ARCHIVE_COMPRESSION)
+    os.replace(tmp_path, part_path)
+
+    return part_path
+
+def archive_product_history(retention_days=None, batch_size=None):
+
+    retention_days = retention_days if retention_days is not None else settings.PRODUCT_HISTORY_RETENTION_DAYS
+    batch_size = batch_size or settings.PRODUCT_HISTORY_ARCHIVE_BATCH_SIZE
+
+    cutoff = timezone.now() - timedelta(days=retention_days)
+    expired = ProductHistory.objects.filter(updated_at__lt=cutoff)
+    archived = 0
+
+    while True:
+
+        batch = list(expired.order_by('id').values_list(*ARCHIVE_COLUMNS)[:batch_size])
+
+        if not batch:
+            break
+
+        frame = pd.DataFrame(batch, columns=ARCHIVE_COLUMNS)
+        frame['updated_at'] = pd.to_datetime(frame['updated_at'], utc=True)
+
+        for month, rows in frame.groupby(frame['updated_at'].dt.strftime('%Y-%m')):
+            write_archive_part(month, rows)
+
+        # The batch is every expired row in this id range, one ranged
+        # delete removes it without listing the ids
+        expired.filter(id__gte=batch[0][0], id__lte=batch[-1][0]).delete()
+        archived += len(batch)
+
+    return archived
+
+def as_utc(value):
+
+    value = pd.Timestamp(value)
+
+    return value.tz_localize('UTC') if value.tzinfo is None else value.tz_convert('UTC')
+
+def get_archive_months(start, end):
+
+    months = pd.period_range(start.tz_localize(None), end.tz_localize(None), freq='M')
+
+    return [month.strftime('%Y-%m') for month in months]
+
+def read_archived_history(start, end, product_ids=None):
+
+    # Rows with start <= updated_at < end, only the months of the range
+    # are opened and filtered while they are read
+    start, end = as_utc(start), as_utc(end)
+
+    filters = [('updated_at', '>=', start), ('updated_at', '<', end)]
+
+    if product_ids is not None:
+        filters.append(('product_id', 'in', list(product_ids)))
+
+    frames = [
+        pd.read_parquet(part_path, filters=filters)
+        for month in get_archive_months(start, end)
+        for part_path in sorted(glob.glob(os.path.join(get_month_dir(month), "part-*.parquet")))
+    ]
+
+    if not frames:
+        return pd.DataFrame({column: pd.Series(dtype='object') for column in ARCHIVE_COLUMNS})
+
+    return pd.concat(frames, ignore_index=True).drop_duplicates('id').sort_values(['updated_at', 'id'], ignore_index=True)
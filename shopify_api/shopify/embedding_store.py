@@ -0,0 +1,361 @@
+from django.conf import settings
+from contextlib import contextmanager
+import numpy as np
+import fcntl
+import glob
+import json
+import os
+import struct
+import uuid
+
+# A bundle is one file: magic, header length, JSON header, then every array
+# as raw little-endian bytes at an aligned offset. Arrays are opened with
+# np.memmap, so every process maps the same page-cache copy instead of
+# unpickling its own.
+#
+# Every full write creates a new generation file and then atomically swaps
+# the <name>.idx symlink to it. Readers that resolved the old link keep
+# serving that generation until their next lookup.
+#
+# A section may reserve room for more rows than its shape holds. Rows are
+# appended into that tail in place and the header is rewritten with the new
+# shapes, readers keep mapping the shapes of the header they read.
+BUNDLE_MAGIC = b'SHPIDX1\n'
+HEADER_ALIGNMENT = 4096
+ARRAY_ALIGNMENT = 64
+
+_open_bundles = {}
+
+
+def _align(size, alignment):
+    return -(-size // alignment) * alignment
+
+def new_revision():
+    return uuid.uuid4().hex
+
+def get_index_dir():
+
+    os.makedirs(settings.EMBEDDING_INDEX_DIR, exist_ok=True)
+
+    return settings.EMBEDDING_INDEX_DIR
+
+def get_index_path(name):
+    return os.path.join(get_index_dir(), f"{name}.idx")
+
+def get_generation_path(path, generation):
+
+    root, ext = os.path.splitext(path)
+
+    return f"{root}.{generation}{ext}"
+
+@contextmanager
+def index_lock(name, blocking=True):
+
+    with open(os.path.join(get_index_dir(), f"{name}.lock"), "w") as lock_file:
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _publish(path, tmp_path, generation):
+
+    generation_path = get_generation_path(path, generation)
+    previous_path = os.path.realpath(path) if os.path.islink(path) else None
+
+    os.replace(tmp_path, generation_path)
+
+    link_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.link"
+    os.symlink(os.path.basename(generation_path), link_path)
+    os.replace(link_path, path)
+
+    _open_bundles.pop(path, None)
+
+    # The previous generation stays for readers that resolved the old link
+    # just before the swap, older ones are only held open by live mappings
+    for stale_path in glob.glob(get_generation_path(path, "*")):
+        if stale_path not in (generation_path, previous_path):
+            os.remove(stale_path)
+
+def write_bundle(path, arrays, meta=None):
+
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    meta = {**(meta or {}), "revision": new_revision()}
+
+    header_size = HEADER_ALIGNMENT
+
+    # The header holds the array offsets, which depend on the header size
+    while True:
+
+        offset = header_size
+        sections = {}
+
+        for name, array in arrays.items():
+            sections[name] = {"offset": offset, "dtype": array.dtype.str, "shape": list(array.shape)}
+            offset += _align(array.nbytes, ARRAY_ALIGNMENT)
+
+        header = json.dumps({"meta": meta, "sections": sections}).encode()
+
+        if len(BUNDLE_MAGIC) + 8 + len(header) <= header_size:
+            break
+
+        header_size = _align(len(BUNDLE_MAGIC) + 8 + len(header), HEADER_ALIGNMENT)
+
+    # Write then rename so readers never map a half written file, mappings
+    # of the previous file stay valid until they are dropped. Threads of one
+    # process write to their own temp file too
+    tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+
+    with open(tmp_path, "wb") as f:
+
+        f.write(BUNDLE_MAGIC + struct.pack("<Q", len(header)) + header)
+
+        for name, array in arrays.items():
+            f.seek(sections[name]["offset"])
+            f.write(array.tobytes())
+
+        f.truncate(offset)
+        f.flush()
+        os.fsync(f.fileno())
+
+    _publish(path, tmp_path, meta["revision"])
+
+
+class BundleWriter:
+
+    # Builds a bundle section by section so large arrays can be filled in
+    # place through a mapping instead of being held in memory first
+    def __init__(self, path):
+
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        self.offset = HEADER_ALIGNMENT
+        self.sections = {}
+        self.file = open(self.tmp_path, "wb+")
+
+    def allocate(self, name, shape, dtype, capacity=None):
+
+        dtype = np.dtype(dtype)
+        capacity = max(capacity or 0, shape[0])
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        reserved = int(np.prod((capacity,) + tuple(shape[1:]), dtype=np.int64)) * dtype.itemsize
+
+        self.sections[name] = {"offset": self.offset, "dtype": dtype.str, "shape": list(shape), "capacity": capacity}
+        self.offset += _align(reserved, ARRAY_ALIGNMENT)
+        self.file.truncate(self.offset)
+
+        if not nbytes:
+            return np.empty(shape, dtype=dtype)
+
+        return np.memmap(self.tmp_path, dtype=dtype, mode="r+", offset=self.sections[name]["offset"], shape=tuple(shape))
+
+    def add(self, name, array, capacity=None):
+
+        array = np.ascontiguousarray(array)
+
+        self.allocate(name, array.shape, array.dtype, capacity=capacity)
+        self.file.seek(self.sections[name]["offset"])
+        self.file.write(array.tobytes())
+
+    def resize(self, name, rows):
+
+        # Only shrinks, the unused tail stays in the file for appends
+        self.sections[name]["shape"][0] = min(rows, self.sections[name]["shape"][0])
+
+    def commit(self, meta=None):
+
+        meta = {**(meta or {}), "revision": new_revision()}
+        header = json.dumps({"meta": meta, "sections": self.sections}).encode()
+
+        if len(BUNDLE_MAGIC) + 8 + len(header) > HEADER_ALIGNMENT:
+            self.abort()
+            raise ValueError(f"Header of {self.path} does not fit in {HEADER_ALIGNMENT} bytes")
+
+        self.file.seek(0)
+        self.file.write(BUNDLE_MAGIC + struct.pack("<Q", len(header)) + header)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+        _publish(self.path, self.tmp_path, meta["revision"])
+
+    def abort(self):
+
+        self.file.close()
+
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def _read_header(path):
+
+    with open(path, "rb") as f:
+
+        if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+            raise ValueError(f"{path} is not an index bundle")
+
+        header_length, = struct.unpack("<Q", f.read(8))
+
+        return json.loads(f.read(header_length))
+
+def read_bundle(path, mode="r"):
+
+    header = _read_header(path)
+    arrays = {}
+
+    for name, section in header["sections"].items():
+
+        shape = tuple(section["shape"])
+
+        if not np.prod(shape, dtype=np.int64):
+            arrays[name] = np.empty(shape, dtype=section["dtype"])
+            continue
+
+        arrays[name] = np.memmap(path, dtype=section["dtype"], mode=mode, offset=section["offset"], shape=shape)
+
+    return header["meta"], arrays
+
+def _write_header(path, header):
+
+    # Rewritten inside the space reserved before the first array
+    encoded = json.dumps(header).encode()
+
+    reserved = min([section["offset"] for section in header["sections"].values()] or [HEADER_ALIGNMENT])
+
+    if len(BUNDLE_MAGIC) + 8 + len(encoded) > reserved:
+        raise ValueError(f"Header of {path} does not fit in {reserved} bytes")
+
+    with open(path, "r+b") as f:
+        f.write(BUNDLE_MAGIC + struct.pack("<Q", len(encoded)) + encoded)
+        f.flush()
+        os.fsync(f.fileno())
+
+    _open_bundles.pop(path, None)
+
+def touch_bundle(path, field="revision", meta=None):
+
+    # Arrays changed in place through a mapping get a new revision
+    header = _read_header(path)
+    header["meta"].update(meta or {})
+    header["meta"][field] = new_revision()
+
+    _write_header(path, header)
+
+def append_bundle(path, arrays, meta=None):
+
+    # Rows are written into the reserved tail of every section first, the
+    # header then makes them visible. False when a section has no room left
+    # or holds narrower values, the caller writes a larger bundle instead
+    header = _read_header(path)
+    sections = header["sections"]
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+    for name, array in arrays.items():
+
+        section = sections[name]
+        dtype = np.dtype(section["dtype"])
+
+        if section["shape"][0] + len(array) > section.get("capacity", section["shape"][0]):
+            return False
+
+        if dtype.kind == "S" and array.dtype.itemsize > dtype.itemsize:
+            return False
+
+    with open(path, "r+b") as f:
+
+        for name, array in arrays.items():
+
+            section = sections[name]
+            dtype = np.dtype(section["dtype"])
+            row_bytes = int(np.prod(section["shape"][1:], dtype=np.int64)) * dtype.itemsize
+
+            f.seek(section["offset"] + section["shape"][0] * row_bytes)
+            f.write(array.astype(dtype, copy=False).tobytes())
+
+            section["shape"][0] += len(array)
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    header["meta"].update(meta or {})
+    header["meta"]["revision"] = new_revision()
+
+    _write_header(path, header)
+
+    return True
+
+def find_rows(arrays, product_ids):
+
+    # Rows before the tail are sorted by id, appended rows are looked up
+    # through tail_rows (their positions ordered by id) when present. Rows
+    # flagged in deleted are never returned
+    ids = arrays["ids"]
+    deleted = arrays.get("deleted")
+    tail_rows = arrays.get("tail_rows")
+    product_ids = np.asarray(product_ids, dtype=np.int64)
+    head = len(ids) - (len(tail_rows) if tail_rows is not None else 0)
+
+    positions = np.searchsorted(ids[:head], product_ids).clip(max=max(head - 1, 0))
+    found = ids[:head][positions] == product_ids if head else np.zeros(len(product_ids), dtype=bool)
+
+    if deleted is not None and head:
+        found &= deleted[positions] == 0
+
+    if tail_rows is not None and len(tail_rows):
+
+        tail_positions = np.searchsorted(arrays["tail_ids"], product_ids).clip(max=len(tail_rows) - 1)
+        tail_found = ~found & (arrays["tail_ids"][tail_positions] == product_ids)
+        positions = np.where(tail_found, tail_rows[tail_positions], positions)
+
+        if deleted is not None:
+            tail_found &= deleted[positions] == 0
+
+        found |= tail_found
+
+    return positions, found
+
+def load_bundle(path, attempts=3):
+
+    # Reopened only when the link points to another generation or the file
+    # was touched, otherwise the mapping from the previous call is reused
+    for attempt in range(attempts):
+
+        generation_path = os.path.realpath(path)
+
+        try:
+
+            stat = os.stat(generation_path)
+            key = (generation_path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            cached = _open_bundles.get(path)
+
+            if cached is None or cached[0] != key:
+                cached = (key, read_bundle(generation_path))
+                _open_bundles[path] = cached
+
+            return cached[1]
+
+        # Pruned after the link was resolved, or a header being touched
+        except (FileNotFoundError, ValueError):
+
+            if not os.path.lexists(path):
+                _open_bundles.pop(path, None)
+                return None
+
+            if attempt == attempts - 1:
+                raise
+
+def remove_bundle(path):
+
+    _open_bundles.pop(path, None)
+
+    for generation_path in glob.glob(get_generation_path(path, "*")):
+        os.remove(generation_path)
+
+    if os.path.lexists(path):
+        os.remove(path)
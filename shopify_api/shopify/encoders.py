@@ -0,0 +1,148 @@
+from django.conf import settings
+from functools import lru_cache
+import numpy as np
+
+# Doc.vector only averages the static word vectors, none of the trained
+# pipeline components are needed for it
+SPACY_EXCLUDED_COMPONENTS = ["tok2vec", "tagger", "parser", "attribute_ruler", "lemmatizer", "ner", "senter"]
+
+INT8_MAX = 127
+
+
+def normalize_embeddings(embeddings):
+
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+
+    # Names without any known word have a zero vector, they score 0
+    return np.divide(embeddings, norms, out=np.zeros_like(embeddings), where=norms > 0)
+
+def quantize_embeddings(embeddings):
+
+    # One scale per row maps its largest component to 127
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    scales = np.abs(embeddings).max(axis=1, initial=0) / INT8_MAX
+    scales[scales == 0] = 1
+
+    codes = np.rint(embeddings / scales[:, None]).astype(np.int8)
+
+    return codes, scales.astype(np.float32)
+
+def _batches(texts, batch_size):
+
+    batch = []
+
+    for text in texts:
+
+        batch.append(text)
+
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+@lru_cache(maxsize=None)
+def get_nlp():
+
+    import spacy
+
+    return spacy.load(settings.SPACY_MODEL, exclude=SPACY_EXCLUDED_COMPONENTS)
+
+
+class SpacyEncoder:
+
+    name = "spacy"
+
+    def __init__(self, model):
+        self.model = model
+
+    @property
+    def identifier(self):
+        return f"{self.name}:{self.model}"
+
+    @property
+    def dimension(self):
+        return get_nlp().vocab.vectors_length
+
+    def encode(self, texts):
+
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+
+        return normalize_embeddings([doc.vector for doc in get_nlp().pipe(texts)])
+
+    def encode_stream(self, texts, batch_size, n_process=1):
+
+        batch = []
+
+        for doc in get_nlp().pipe(texts, batch_size=batch_size, n_process=n_process):
+
+            batch.append(doc.vector)
+
+            if len(batch) == batch_size:
+                yield normalize_embeddings(batch)
+                batch = []
+
+        if batch:
+            yield normalize_embeddings(batch)
+
+
+class SentenceTransformerEncoder:
+
+    name = "sentence-transformers"
+
+    def __init__(self, model):
+        self.model = model
+
+    @property
+    def identifier(self):
+        return f"{self.name}:{self.model}"
+
+    @property
+    def transformer(self):
+        return _load_sentence_transformer(self.model)
+
+    @property
+    def dimension(self):
+        return self.transformer.get_sentence_embedding_dimension()
+
+    def encode(self, texts):
+
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+
+        return normalize_embeddings(self.transformer.encode(
+            list(texts),
+            batch_size=settings.SEMANTIC_SEARCH_ENCODER_BATCH_SIZE,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        ))
+
+    def encode_stream(self, texts, batch_size, n_process=1):
+
+        # The model batches on its own device, extra processes would each
+        # load another copy of it
+        for batch in _batches(texts, batch_size):
+            yield self.encode(batch)
+
+
+@lru_cache(maxsize=None)
+def _load_sentence_transformer(model):
+
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(model, device=settings.SEMANTIC_SEARCH_ENCODER_DEVICE)
+
+ENCODERS = {
+    SpacyEncoder.name: lambda: SpacyEncoder(settings.SPACY_MODEL),
+    SentenceTransformerEncoder.name: lambda: SentenceTransformerEncoder(settings.SENTENCE_TRANSFORMERS_MODEL),
+}
+
+def get_encoder():
+
+    if settings.SEMANTIC_SEARCH_ENCODER not in ENCODERS:
+        raise ValueError(f"Unknown SEMANTIC_SEARCH_ENCODER {settings.SEMANTIC_SEARCH_ENCODER!r}, expected one of {', '.join(ENCODERS)}")
+
+    return ENCODERS[settings.SEMANTIC_SEARCH_ENCODER]()
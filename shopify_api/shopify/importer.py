@@ -0,0 +1,675 @@
+from shopify.models import MockProductData, Product, ProductHistory
+from shopify.rollups import record_history_rollups
+from shopify.insights import record_stock_changes
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from datetime import timedelta
+import pandas as pd
+import hashlib
+import heapq
+import os
+import time
+
+REQUIRED_COLUMNS = ['sku', 'name', 'quantity', 'price']
+
+CSV = 'csv'
+PARQUET = 'parquet'
+ARROW = 'arrow'
+
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+ARROW_EXTENSIONS = ('.arrow', '.arrows', '.feather', '.ipc')
+
+PARQUET_MAGIC = b'PAR1'
+ARROW_FILE_MAGIC = b'ARROW1'
+ARROW_STREAM_MAGIC = b'\xff\xff\xff\xff'
+
+SKU_LOOKUP_BATCH_SIZE = 500
+SHARD_POSITION_COLUMN = '_position'
+BULK_BATCH_SIZE = 1000
+
+
+def get_missing_column(columns):
+
+    for col in REQUIRED_COLUMNS:
+
+        if col not in columns:
+            return col
+
+    return None
+
+def detect_file_format(file_path):
+
+    extension = os.path.splitext(file_path)[1].lower()
+
+    if extension in PARQUET_EXTENSIONS:
+        return PARQUET
+
+    if extension in ARROW_EXTENSIONS:
+        return ARROW
+
+    with open(file_path, 'rb') as f:
+        magic = f.read(6)
+
+    if magic[:4] == PARQUET_MAGIC:
+        return PARQUET
+
+    if magic == ARROW_FILE_MAGIC or magic[:4] == ARROW_STREAM_MAGIC:
+        return ARROW
+
+    return CSV
+
+def _open_arrow(file_path):
+
+    import pyarrow as pa
+
+    source = pa.memory_map(file_path)
+    is_file_format = source.read(6) == ARROW_FILE_MAGIC
+    source.seek(0)
+
+    return pa.ipc.open_file(source) if is_file_format else pa.ipc.open_stream(source)
+
+def _iter_arrow_batches(reader):
+
+    if hasattr(reader, 'get_batch'):
+
+        for index in range(reader.num_record_batches):
+            yield reader.get_batch(index)
+
+    else:
+        yield from reader
+
+def _read_schema(file_path, file_format):
+
+    if file_format == PARQUET:
+        import pyarrow.parquet as pq
+        return pq.read_schema(file_path)
+
+    return _open_arrow(file_path).schema
+
+def read_columns(file_path):
+
+    file_format = detect_file_format(file_path)
+
+    if file_format == CSV:
+        return pd.read_csv(file_path, nrows=0).columns.str.lower()
+
+    return pd.Index(_read_schema(file_path, file_format).names).str.lower()
+
+def hash_file(file_path):
+
+    digest = hashlib.sha256()
+
+    with open(file_path, 'rb') as f:
+
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def release_stalled_imports(content_hash, exclude_id=None):
+
+    # A worker that died mid import leaves it in PROCESSING, which would hold
+    # the content hash forever. Without progress for PRODUCT_IMPORT_STALL_TIMEOUT
+    # it is failed, so the same file can be uploaded again
+    stalled_before = timezone.now() - timedelta(seconds=settings.PRODUCT_IMPORT_STALL_TIMEOUT)
+
+    return MockProductData.objects.filter(
+        Q(progress_updated_at__lt=stalled_before) | Q(progress_updated_at__isnull=True, updated_at__lt=stalled_before),
+        content_hash=content_hash,
+        status=MockProductData.PROCESSING
+    ).exclude(id=exclude_id).update(
+        status=MockProductData.FAILED,
+        failure_reason="Stalled, no progress before a new upload of the same file",
+        updated_at=timezone.now()
+    )
+
+def find_duplicate_import(content_hash, exclude_id=None):
+
+    release_stalled_imports(content_hash, exclude_id=exclude_id)
+
+    return MockProductData.objects.filter(
+        content_hash=content_hash,
+        status__in=MockProductData.ACTIVE_STATUSES
+    ).exclude(id=exclude_id).order_by('id').first()
+
+def count_rows(file_path):
+
+    file_format = detect_file_format(file_path)
+
+    if file_format == PARQUET:
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(file_path).metadata.num_rows
+
+    if file_format == ARROW:
+        return sum(batch.num_rows for batch in _iter_arrow_batches(_open_arrow(file_path)))
+
+    lines = 0
+    last_byte = b'\n'
+
+    with open(file_path, 'rb') as f:
+
+        for block in iter(lambda: f.read(1 << 20), b''):
+            lines += block.count(b'\n')
+            last_byte = block[-1:]
+
+    if last_byte != b'\n':
+        lines += 1
+
+    # Header line is not a row
+    return max(lines - 1, 0)
+
+def start_progress(mock_data, file_path):
+
+    mock_data.total_rows = count_rows(file_path)
+    mock_data.rows_read = 0
+    mock_data.rows_created = 0
+    mock_data.rows_updated = 0
+    mock_data.rows_discarded = 0
+    mock_data.started_at = timezone.now()
+    mock_data.progress_updated_at = mock_data.started_at
+
+    mock_data.save(update_fields=[
+        'total_rows', 'rows_read', 'rows_created', 'rows_updated',
+        'rows_discarded', 'started_at', 'progress_updated_at', 'updated_at'
+    ])
+
+
+class ImportProgress:
+
+    # Counters of a chunk are saved on the import state row together with
+    # its checkpoint, so a retry never loses them. A shard row only holds
+    # counters not yet added to the shared import row, they are moved there
+    # with a single F() UPDATE at most once per PRODUCT_IMPORT_PROGRESS_INTERVAL,
+    # so shards don't queue up behind each other on every chunk
+    COUNTERS = ('rows_read', 'rows_created', 'rows_updated', 'rows_discarded')
+
+    def __init__(self, import_state, interval=None):
+
+        self.import_state = import_state
+        self.sharded = not isinstance(import_state, MockProductData)
+        self.interval = settings.PRODUCT_IMPORT_PROGRESS_INTERVAL if interval is None else interval
+        self.last_flush = time.monotonic()
+
+    def add(self, rows_read, summary):
+
+        # Runs inside the transaction of the chunk, the returned fields are
+        # saved with its checkpoint
+        self.import_state.rows_read += rows_read
+        self.import_state.rows_created += len(summary.get('created', []))
+        self.import_state.rows_updated += len(summary.get('updated', []))
+        self.import_state.rows_discarded += len(summary.get('discarded', []))
+
+        if not self.sharded:
+            self.import_state.progress_updated_at = timezone.now()
+            return list(self.COUNTERS) + ['progress_updated_at']
+
+        if time.monotonic() - self.last_flush >= self.interval:
+            self.move_counters()
+
+        return list(self.COUNTERS)
+
+    def move_counters(self):
+
+        counters = {field: getattr(self.import_state, field) for field in self.COUNTERS}
+
+        if any(counters.values()):
+            MockProductData.objects.filter(pk=self.import_state.mock_data_id).update(
+                progress_updated_at=timezone.now(),
+                **{field: F(field) + value for field, value in counters.items()}
+            )
+
+        for field in self.COUNTERS:
+            setattr(self.import_state, field, 0)
+
+        self.last_flush = time.monotonic()
+
+    def flush(self):
+
+        if not self.sharded:
+            return
+
+        with transaction.atomic():
+            self.move_counters()
+            self.import_state.save(update_fields=list(self.COUNTERS) + ['updated_at'])
+
+
+def _iter_csv_chunks(file_path, chunk_size, offset):
+
+    # Types are inferred per chunk, a numeric sku column with a gap would
+    # turn into floats in that chunk only, so text columns are read as str
+    header = pd.read_csv(file_path, nrows=0).columns
+    dtype = {column: str for column in header if column.lower() in ('sku', 'name')}
+
+    # Blank lines are kept as all-null rows (and skipped later) so the row
+    # offset always lines up with skiprows on resume
+    reader = pd.read_csv(
+        file_path,
+        chunksize=chunk_size,
+        skiprows=range(1, offset + 1),
+        skip_blank_lines=False,
+        dtype=dtype
+    )
+
+    for chunk in reader:
+
+        chunk.index += offset
+        chunk.columns = chunk.columns.str.lower()
+
+        yield chunk
+
+def _iter_record_batches(file_path, file_format, columns, chunk_size, offset):
+
+    import pyarrow as pa
+
+    if file_format == PARQUET:
+
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(file_path, memory_map=True)
+        metadata = parquet_file.metadata
+
+        # Row groups that end before the checkpoint are never decoded
+        row_groups = []
+        position = 0
+
+        for index in range(metadata.num_row_groups):
+
+            num_rows = metadata.row_group(index).num_rows
+
+            if not row_groups and position + num_rows <= offset:
+                position += num_rows
+                continue
+
+            row_groups.append(index)
+
+        if not row_groups:
+            return
+
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, row_groups=row_groups, columns=columns):
+            yield position, batch
+            position += batch.num_rows
+
+        return
+
+    position = 0
+
+    for batch in _iter_arrow_batches(_open_arrow(file_path)):
+
+        # Projection without copying the column buffers
+        batch = pa.RecordBatch.from_arrays(
+            [batch.column(batch.schema.get_field_index(column)) for column in columns],
+            names=columns
+        )
+
+        yield position, batch
+        position += batch.num_rows
+
+def _nullable_integer(data_type):
+
+    import pyarrow as pa
+
+    # Integer columns with gaps stay integers instead of becoming floats
+    return pd.Int64Dtype() if pa.types.is_integer(data_type) else None
+
+def _iter_columnar_chunks(file_path, file_format, chunk_size, offset, extra_columns=()):
+
+    names = {name.lower(): name for name in _read_schema(file_path, file_format).names}
+    columns = [names[column] for column in REQUIRED_COLUMNS if column in names] + list(extra_columns)
+
+    for position, batch in _iter_record_batches(file_path, file_format, columns, chunk_size, offset):
+
+        for start in range(max(offset - position, 0), batch.num_rows, chunk_size):
+
+            chunk = batch.slice(start, chunk_size).to_pandas(types_mapper=_nullable_integer)
+
+            chunk.columns = chunk.columns.str.lower()
+            chunk.index = pd.RangeIndex(position + start, position + start + len(chunk))
+
+            yield chunk
+
+def iter_product_chunks(file_path, chunk_size, offset=0):
+
+    file_format = detect_file_format(file_path)
+
+    if file_format == CSV:
+        return _iter_csv_chunks(file_path, chunk_size, offset)
+
+    return _iter_columnar_chunks(file_path, file_format, chunk_size, offset)
+
+def assign_shards(chunk, shard_count):
+
+    # hash_pandas_object is stable across processes, unlike hash()
+    keys = chunk['sku'].astype(str).str.strip()
+
+    return pd.util.hash_pandas_object(keys, index=False).values % shard_count
+
+def get_shard_path(file_path, shard, file_format=None):
+
+    # Shards of Parquet and Arrow sources are Arrow IPC files, so column
+    # types survive the partition instead of being inferred again from text
+    file_format = file_format or detect_file_format(file_path)
+    extension = 'csv' if file_format == CSV else 'arrow'
+
+    return f"{file_path}.shard-{shard}.{extension}"
+
+def _partition_csv(file_path, shard_count, chunk_size, tmp_paths):
+
+    shard_files = [open(tmp_path, 'w', newline='') for tmp_path in tmp_paths]
+
+    try:
+
+        header = True
+
+        for chunk in _iter_csv_chunks(file_path, chunk_size, 0):
+
+            # Blank rows are skipped by the upsert anyway
+            chunk = chunk[~chunk.isnull().all(axis=1)]
+            shards = assign_shards(chunk, shard_count)
+
+            for shard, shard_file in enumerate(shard_files):
+                chunk[shards == shard].to_csv(shard_file, header=header, index_label=SHARD_POSITION_COLUMN)
+
+            header = False
+
+    finally:
+
+        for shard_file in shard_files:
+            shard_file.close()
+
+def _partition_columnar(file_path, file_format, shard_count, chunk_size, tmp_paths):
+
+    import pyarrow as pa
+
+    schema = _read_schema(file_path, file_format)
+    names = {name.lower(): name for name in schema.names}
+    columns = [names[column] for column in REQUIRED_COLUMNS if column in names]
+
+    shard_schema = pa.schema([schema.field(column) for column in columns] + [pa.field(SHARD_POSITION_COLUMN, pa.int64())])
+    writers = [pa.ipc.new_file(tmp_path, shard_schema) for tmp_path in tmp_paths]
+
+    try:
+
+        for position, batch in _iter_record_batches(file_path, file_format, columns, chunk_size, 0):
+
+            # pandas only decides which rows go where, the arrow columns
+            # themselves are written unchanged
+            chunk = batch.to_pandas(types_mapper=_nullable_integer)
+            chunk.columns = chunk.columns.str.lower()
+
+            keep = ~chunk.isnull().all(axis=1).values
+            shards = assign_shards(chunk, shard_count)
+
+            rows = pa.RecordBatch.from_arrays(
+                batch.columns + [pa.array(range(position, position + batch.num_rows), type=pa.int64())],
+                schema=shard_schema
+            )
+
+            for shard, writer in enumerate(writers):
+
+                mask = keep & (shards == shard)
+
+                if mask.any():
+                    writer.write_batch(rows.filter(pa.array(mask)))
+
+    finally:
+
+        for writer in writers:
+            writer.close()
+
+def partition_shards(file_path, shard_count, chunk_size):
+
+    # The source file is parsed once, every shard then reads only its own
+    # rows. The original row position is kept in a column so shard
+    # summaries still merge in file order
+    file_format = detect_file_format(file_path)
+    shard_paths = [get_shard_path(file_path, shard, file_format) for shard in range(shard_count)]
+    tmp_paths = [f"{shard_path}.tmp" for shard_path in shard_paths]
+
+    if file_format == CSV:
+        _partition_csv(file_path, shard_count, chunk_size, tmp_paths)
+    else:
+        _partition_columnar(file_path, file_format, shard_count, chunk_size, tmp_paths)
+
+    for tmp_path, shard_path in zip(tmp_paths, shard_paths):
+        os.replace(tmp_path, shard_path)
+
+    return shard_paths
+
+def iter_shard_chunks(shard_path, chunk_size, offset=0):
+
+    if detect_file_format(shard_path) == CSV:
+
+        # Nothing was written for a file without rows
+        if not os.path.getsize(shard_path):
+            return
+
+        chunks = _iter_csv_chunks(shard_path, chunk_size, offset)
+
+    else:
+        chunks = _iter_columnar_chunks(shard_path, ARROW, chunk_size, offset, extra_columns=[SHARD_POSITION_COLUMN])
+
+    for chunk in chunks:
+        chunk.index = pd.Index(chunk.pop(SHARD_POSITION_COLUMN).astype('int64').values)
+        yield chunk
+
+def remove_shard_files(file_path, shard_count):
+
+    for shard in range(shard_count):
+
+        # Both extensions, the source may already be gone
+        for file_format in (CSV, ARROW):
+
+            shard_path = get_shard_path(file_path, shard, file_format)
+
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
+
+def merge_shard_summaries(summaries):
+
+    merged = {}
+
+    for key in ('created', 'updated', 'discarded'):
+
+        entries = heapq.merge(*[summary.get(key, []) for summary in summaries], key=lambda item: item[0])
+        merged[key] = [entry for _, entry in entries]
+
+    return merged
+
+def merge_summaries(summaries):
+
+    merged = {key: [] for key in ('created', 'updated', 'discarded')}
+
+    for summary in summaries:
+        for key, entries in summary.items():
+            merged.setdefault(key, []).extend(entries)
+
+    return merged
+
+def _is_blank(column):
+    return column.isnull() | ~column.where(column.notnull(), '').astype(bool)
+
+def _json_safe(record):
+    return {key: None if pd.isnull(value) else value for key, value in record.items()}
+
+def _as_integer(column):
+
+    numbers = pd.to_numeric(column, errors='coerce')
+
+    return numbers, numbers.notnull() & (numbers % 1 == 0)
+
+def _load_existing_products(skus):
+
+    records = []
+
+    # One sku__in query per batch, lowest pk wins like `.first()` did
+    for start in range(0, len(skus), SKU_LOOKUP_BATCH_SIZE):
+
+        existing = Product.objects.filter(
+            sku__in=skus[start:start + SKU_LOOKUP_BATCH_SIZE]
+        ).order_by('pk').values_list('id', 'sku', 'name', 'quantity', 'price')
+
+        records.extend(existing)
+
+    existing_df = pd.DataFrame.from_records(
+        records,
+        columns=['product_id', 'lookup_sku', 'existing_name', 'existing_quantity', 'existing_price']
+    )
+
+    return existing_df.drop_duplicates('lookup_sku')
+
+def _iter_products(skus):
+
+    for start in range(0, len(skus), SKU_LOOKUP_BATCH_SIZE):
+        yield from Product.objects.filter(sku__in=skus[start:start + SKU_LOOKUP_BATCH_SIZE])
+
+def _update_products(matched, entries):
+
+    quantity_changed = matched['quantity'] != matched['existing_quantity']
+    price_changed = matched['price'] != matched['existing_price']
+
+    now = timezone.now()
+    products = []
+    histories = []
+
+    for record in matched[quantity_changed | price_changed].to_dict('records'):
+
+        previous_quantity = int(record['existing_quantity'])
+        previous_price = int(record['existing_price'])
+
+        changes = []
+
+        if previous_quantity != record['quantity']:
+            changes.append(f"Quantity From: {previous_quantity} >>> To: {record['quantity']}")
+
+        if previous_price != record['price']:
+            changes.append(f"Price From: {previous_price} >>> To: {record['price']}")
+
+        entries['updated'].append((record['position'], {
+            'sku': record['lookup_sku'],
+            'name': record['existing_name'],
+            'changes': "\n".join(changes),
+        }))
+
+        product = Product(
+            id=int(record['product_id']),
+            sku=record['lookup_sku'],
+            name=record['existing_name'],
+            quantity=int(record['quantity']),
+            price=int(record['price']),
+            updated_at=now
+        )
+
+        products.append(product)
+        histories.extend(product.get_history_changes(previous_quantity, previous_price))
+
+    Product.objects.bulk_update(products, ['quantity', 'price', 'updated_at'], batch_size=BULK_BATCH_SIZE)
+    ProductHistory.objects.bulk_create(histories, batch_size=BULK_BATCH_SIZE)
+    record_history_rollups(histories)
+
+    record_stock_changes(changed=[
+        (int(previous), int(current)) for previous, current in zip(matched['existing_quantity'][quantity_changed], matched['quantity'][quantity_changed])
+    ])
+
+    from shopify.utils import update_cache_columns
+    update_cache_columns(products)
+
+def _create_products(new, entries):
+
+    # Same rules ProductSerializer applies, evaluated for the whole frame at once
+    sku = new['sku'].astype(str).str.strip()
+    name = new['name'].astype(str).str.strip()
+    quantity, quantity_valid = _as_integer(new['quantity'])
+    price, price_valid = _as_integer(new['price'])
+
+    valid = (sku != '') & (name != '') & quantity_valid & price_valid
+
+    for record in new.loc[~valid, REQUIRED_COLUMNS + ['position']].to_dict('records'):
+        position = record.pop('position')
+        entries['discarded'].append((position, _json_safe(record)))
+
+    products = []
+
+    for position, product_sku, product_name, product_quantity, product_price in zip(
+        new['position'][valid], sku[valid], name[valid], quantity[valid], price[valid]
+    ):
+
+        product = Product(
+            sku=product_sku,
+            name=product_name,
+            quantity=int(product_quantity),
+            price=int(product_price)
+        )
+
+        products.append(product)
+
+        entries['created'].append((position, {
+            'sku': product.sku,
+            'name': product.name,
+            'price': product.price,
+            'quantity': product.quantity,
+        }))
+
+    Product.objects.bulk_create(products, batch_size=BULK_BATCH_SIZE)
+    record_stock_changes(added=[product.quantity for product in products])
+
+    return [product.sku for product in products]
+
+def _upsert_wave(rows, entries):
+
+    existing = _load_existing_products(rows['lookup_sku'].unique().tolist())
+
+    merged = rows.merge(existing, how='left', on='lookup_sku', indicator=True)
+
+    _update_products(merged[merged['_merge'] == 'both'], entries)
+
+    return _create_products(merged[merged['_merge'] == 'left_only'], entries)
+
+def upsert_products(df, with_positions=False):
+
+    entries = {
+        'created': [],
+        'updated': [],
+        'discarded': [],
+    }
+
+    df = df[~df.isnull().all(axis=1)]
+
+    invalid = _is_blank(df['sku']) | _is_blank(df['name']) | df['quantity'].isnull() | df['price'].isnull()
+
+    for position, row in zip(df.index[invalid.values], df[invalid].to_dict('records')):
+        entries['discarded'].append((position, _json_safe(row)))
+
+    rows = df.loc[~invalid, REQUIRED_COLUMNS].copy()
+    rows['position'] = rows.index
+    rows['lookup_sku'] = rows['sku'].astype(str).str.strip()
+
+    # A SKU repeated in the file updates the product its earlier row wrote,
+    # so every repeat goes into a later wave
+    occurrence = rows.groupby('lookup_sku').cumcount()
+    waves = int(occurrence.max()) + 1 if len(rows) else 0
+
+    created_skus = []
+
+    for wave in range(waves):
+        created_skus.extend(_upsert_wave(rows[occurrence == wave], entries))
+
+    # Updates only touch quantity and price, so only new products need
+    # an embedding. They are read once the chunk commits
+    if created_skus:
+        from shopify.utils import update_cache_embeddings
+        update_cache_embeddings(_iter_products(created_skus))
+
+    summary = {}
+
+    for key, values in entries.items():
+
+        values = sorted(values, key=lambda item: item[0])
+
+        if with_positions:
+            summary[key] = [[int(position), entry] for position, entry in values]
+        else:
+            summary[key] = [entry for _, entry in values]
+
+    return summary
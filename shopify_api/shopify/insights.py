@@ -0,0 +1,177 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+from shopify.models import Product, ProductCounter, ProductInsightsSnapshot
+from shopify.utils import detect_trending_products
+from datetime import timedelta
+import logging
+import random
+
+log = logging.getLogger("django")
+
+PRODUCTS_COUNTER = "products"
+
+
+def get_low_stock_counter(threshold):
+    return f"low_stock_below_{threshold}"
+
+def record_stock_changes(added=(), removed=(), changed=()):
+
+    # Only the configured threshold is counted incrementally, changed holds
+    # (previous, current) quantities
+    threshold = settings.PRODUCT_INSIGHTS_LOW_STOCK_THRESHOLD
+
+    deltas = {
+        PRODUCTS_COUNTER: len(added) - len(removed),
+        get_low_stock_counter(threshold): (
+            sum(quantity < threshold for quantity in added)
+            - sum(quantity < threshold for quantity in removed)
+            + sum((current < threshold) - (previous < threshold) for previous, current in changed)
+        )
+    }
+
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+
+    # Applied once the product rows commit, an import transaction doesn't
+    # hold the counter rows until its end and a rollback leaves them alone
+    if deltas:
+        transaction.on_commit(lambda: _add_to_counters(deltas))
+
+def _add_to_counters(deltas):
+
+    # Counters that were never read yet are counted on their first read
+    stripe = random.randrange(settings.PRODUCT_INSIGHTS_COUNTER_STRIPES)
+
+    for name, delta in deltas.items():
+        ProductCounter.objects.filter(name=name, stripe=stripe).update(value=F('value') + delta)
+
+def _create_counters(values):
+
+    # The first stripe holds the count, rows that already exist are kept
+    ProductCounter.objects.bulk_create([
+        ProductCounter(name=name, stripe=stripe, value=value if stripe == 0 else 0)
+        for name, value in values.items()
+        for stripe in range(settings.PRODUCT_INSIGHTS_COUNTER_STRIPES)
+    ], ignore_conflicts=True)
+
+def _read_counters(names):
+    return dict(ProductCounter.objects.filter(name__in=names).values('name').annotate(total=Sum('value')).values_list('name', 'total'))
+
+def _count_stock(threshold):
+    return Product.objects.aggregate(products=Count('id'), low_stock=Count('id', filter=Q(quantity__lt=threshold)))
+
+def get_stock_counts(threshold):
+
+    counted = threshold == settings.PRODUCT_INSIGHTS_LOW_STOCK_THRESHOLD
+    low_stock_counter = get_low_stock_counter(threshold)
+
+    if counted:
+
+        counters = _read_counters([PRODUCTS_COUNTER, low_stock_counter])
+
+        if len(counters) == 2:
+            return counters[PRODUCTS_COUNTER], counters[low_stock_counter]
+
+    counts = _count_stock(threshold)
+
+    if counted:
+        _create_counters({PRODUCTS_COUNTER: counts["products"], low_stock_counter: counts["low_stock"]})
+
+    return counts["products"], counts["low_stock"]
+
+def recount_stock_counters():
+
+    # Deltas lost between a commit and its counter update, or applied while
+    # a counter was first counted, are corrected on the first stripe
+    threshold = settings.PRODUCT_INSIGHTS_LOW_STOCK_THRESHOLD
+    low_stock_counter = get_low_stock_counter(threshold)
+
+    _create_counters({PRODUCTS_COUNTER: 0, low_stock_counter: 0})
+
+    counts = _count_stock(threshold)
+    counters = _read_counters([PRODUCTS_COUNTER, low_stock_counter])
+
+    for name, count in ((PRODUCTS_COUNTER, counts["products"]), (low_stock_counter, counts["low_stock"])):
+        if count != counters[name]:
+            ProductCounter.objects.filter(name=name, stripe=0).update(value=F('value') + count - counters[name])
+
+def compute_product_insights(low_stock_threshold, trending_days, trending_top_n):
+
+    products, low_stock = get_stock_counts(low_stock_threshold)
+    trending_products = detect_trending_products(top_n=trending_top_n, days=trending_days)
+
+    return {
+        "low_stock_percentage": round(low_stock / products * 100, 2) if products else 0,
+        "trending_products": [
+            {
+                "name" : product.name,
+                "price" : product.price,
+                "sku" : product.sku
+            }
+            for product in trending_products
+        ]
+    }
+
+def get_insights_params(low_stock_threshold=None, trending_days=None, trending_top_n=None):
+
+    return {
+        "low_stock_threshold": settings.PRODUCT_INSIGHTS_LOW_STOCK_THRESHOLD if low_stock_threshold is None else low_stock_threshold,
+        "trending_days": trending_days or settings.PRODUCT_INSIGHTS_TRENDING_DAYS,
+        "trending_top_n": trending_top_n or settings.PRODUCT_INSIGHTS_TRENDING_TOP_N,
+    }
+
+def get_insights_key(params):
+    return ":".join(f"{name}={params[name]}" for name in sorted(params))
+
+def refresh_product_insights(**params):
+
+    params = get_insights_params(**params)
+
+    # Stamped with the start of the computation, changes made while it
+    # runs make the snapshot older, never younger
+    computed_at = timezone.now()
+    insights = compute_product_insights(**params)
+
+    ProductInsightsSnapshot.objects.update_or_create(
+        key=get_insights_key(params),
+        defaults={"insights": insights, "computed_at": computed_at, "refresh_requested_at": None}
+    )
+
+    return insights
+
+def _request_refresh(snapshot, params, now):
+
+    # The first request past the TTL claims the refresh, the others keep
+    # serving the snapshot until it lands. A refresh that never lands ends
+    # with the stale TTL, the next request then computes it itself
+    claimed = ProductInsightsSnapshot.objects.filter(
+        key=snapshot.key, computed_at=snapshot.computed_at, refresh_requested_at__isnull=True
+    ).update(refresh_requested_at=now)
+
+    if not claimed:
+        return
+
+    from shopify.tasks import async_refresh_product_insights
+
+    try:
+        async_refresh_product_insights.delay(**params)
+    except Exception:
+        log.warning("Could not queue the product insights refresh", exc_info=True)
+
+def get_product_insights(low_stock_threshold=None, trending_days=None, trending_top_n=None):
+
+    params = get_insights_params(low_stock_threshold, trending_days, trending_top_n)
+    snapshot = ProductInsightsSnapshot.objects.filter(key=get_insights_key(params)).first()
+
+    now = timezone.now()
+    ttl = timedelta(seconds=settings.PRODUCT_INSIGHTS_CACHE_TTL)
+    stale_ttl = timedelta(seconds=settings.PRODUCT_INSIGHTS_STALE_TTL)
+
+    if snapshot is None or now - snapshot.computed_at > ttl + stale_ttl:
+        return refresh_product_insights(**params)
+
+    if now - snapshot.computed_at > ttl:
+        _request_refresh(snapshot, params, now)
+
+    return snapshot.insights
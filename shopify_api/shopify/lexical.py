@@ -0,0 +1,265 @@
+from django.conf import settings
+from shopify.models import Product
+from shopify.embedding_store import get_index_path, index_lock, load_bundle, read_bundle, write_bundle, remove_bundle
+from hashlib import blake2b
+import numpy as np
+import logging
+import os
+import re
+
+log = logging.getLogger("django")
+
+# Inverted index over product names and skus: every word and every
+# character trigram of a word is a term, hashed to an int64 key. Postings
+# are stored grouped by key, offsets[i]:offsets[i + 1] slices the product
+# ids of keys[i].
+#
+# The base index is only rebuilt in full. Products changed since then are
+# kept in a small delta index, their base postings are ignored through
+# the stale ids until the next full build. Every delta write gets the next
+# sequence number, a background build keeps the changes applied after it
+# read the products.
+LEXICAL_INDEX = "product_lexical"
+LEXICAL_DELTA = "product_lexical_delta"
+
+TOKEN_PATTERN = re.compile(r"[0-9a-z]+")
+
+
+def get_terms(text):
+
+    terms = set()
+
+    for token in TOKEN_PATTERN.findall(text.lower()):
+
+        terms.add(f"w:{token}")
+
+        padded = f" {token} "
+        terms.update(f"t:{padded[index:index + 3]}" for index in range(len(padded) - 2))
+
+    return terms
+
+def hash_terms(terms):
+
+    return np.unique(np.array([
+        int.from_bytes(blake2b(term.encode(), digest_size=8).digest(), "little", signed=True) for term in terms
+    ], dtype=np.int64))
+
+def get_product_terms(name, sku):
+    return hash_terms(get_terms(name) | get_terms(sku))
+
+def _empty_postings():
+    return {"keys": np.empty(0, dtype=np.int64), "offsets": np.zeros(1, dtype=np.int64), "ids": np.empty(0, dtype=np.int64)}
+
+def _group_postings(keys, ids):
+
+    if not len(keys):
+        return _empty_postings()
+
+    order = np.lexsort((ids, keys))
+    keys, ids = keys[order], ids[order]
+
+    unique_keys, starts = np.unique(keys, return_index=True)
+
+    return {"keys": unique_keys, "offsets": np.append(starts, len(keys)).astype(np.int64), "ids": ids}
+
+def build_postings(product_ids, names, skus):
+
+    term_keys = [get_product_terms(name, sku) for name, sku in zip(names, skus)]
+
+    if not term_keys:
+        return _empty_postings()
+
+    return _group_postings(
+        np.concatenate(term_keys),
+        np.repeat(np.asarray(product_ids, dtype=np.int64), [len(keys) for keys in term_keys])
+    )
+
+def _flatten_postings(postings):
+    return np.repeat(postings["keys"], np.diff(postings["offsets"])), postings["ids"]
+
+def _lookup(postings, query_keys):
+
+    keys = postings["keys"]
+
+    if not len(keys):
+        return [np.empty(0, dtype=np.int64) for _ in query_keys]
+
+    positions = np.searchsorted(keys, query_keys).clip(max=len(keys) - 1)
+    offsets = postings["offsets"]
+
+    return [
+        postings["ids"][offsets[position]:offsets[position + 1]] if keys[position] == key else np.empty(0, dtype=np.int64)
+        for position, key in zip(positions, query_keys)
+    ]
+
+def _empty_delta():
+    return {**_empty_postings(), "stale": np.empty(0, dtype=np.int64), "stale_sequence": np.empty(0, dtype=np.int64)}
+
+def _build_base_postings():
+
+    product_ids, names, skus = [], [], []
+
+    for product_id, name, sku in Product.objects.order_by('id').values_list('id', 'name', 'sku').iterator(chunk_size=settings.SEMANTIC_SEARCH_BUILD_BATCH_SIZE):
+        product_ids.append(product_id)
+        names.append(name)
+        skus.append(sku)
+
+    return build_postings(product_ids, names, skus), len(product_ids)
+
+def write_lexical_index():
+
+    postings, products = _build_base_postings()
+
+    write_bundle(get_index_path(LEXICAL_INDEX), postings, meta={"products": products})
+    write_bundle(get_index_path(LEXICAL_DELTA), _empty_delta())
+
+def get_lexical_index():
+
+    index_path = get_index_path(LEXICAL_INDEX)
+    delta_path = get_index_path(LEXICAL_DELTA)
+
+    if load_bundle(index_path) is None or load_bundle(delta_path) is None:
+
+        with index_lock(LEXICAL_INDEX):
+
+            if load_bundle(index_path) is None or load_bundle(delta_path) is None:
+                write_lexical_index()
+
+    return load_bundle(index_path), load_bundle(delta_path)
+
+def _get_stale_sequence(delta):
+
+    # Deltas written before sequences were kept count as the oldest changes
+    return delta.get("stale_sequence", np.zeros(len(delta["stale"]), dtype=np.int64))
+
+def update_lexical_index(products=(), removed_ids=()):
+
+    index_path = get_index_path(LEXICAL_INDEX)
+
+    # Built from the database on the first hybrid search
+    if not os.path.exists(index_path):
+        return
+
+    products = list(products)
+    product_ids = np.unique(np.array([product.id for product in products] + list(removed_ids), dtype=np.int64))
+
+    with index_lock(LEXICAL_INDEX):
+
+        delta_path = get_index_path(LEXICAL_DELTA)
+
+        if not os.path.exists(index_path) or not os.path.exists(delta_path):
+            return
+
+        meta, delta = read_bundle(delta_path)
+        sequence = meta.get("sequence", 0) + 1
+
+        unchanged = ~np.isin(delta["stale"], product_ids)
+        stale = np.concatenate([delta["stale"][unchanged], product_ids])
+        stale_sequence = np.concatenate([_get_stale_sequence(delta)[unchanged], np.full(len(product_ids), sequence, dtype=np.int64)])
+        order = np.argsort(stale, kind='stable')
+
+        keys, ids = _flatten_postings(delta)
+        keep = ~np.isin(ids, product_ids)
+
+        changed = build_postings([product.id for product in products], [product.name for product in products], [product.sku for product in products])
+        changed_keys, changed_ids = _flatten_postings(changed)
+
+        postings = _group_postings(np.concatenate([keys[keep], changed_keys]), np.concatenate([ids[keep], changed_ids]))
+
+        # Past the limit the delta slows every search down, one background
+        # build merges it. Saves keep extending it meanwhile
+        compact = len(stale) > settings.SEMANTIC_SEARCH_LEXICAL_DELTA_LIMIT and not meta.get("rebuild_requested")
+
+        write_bundle(
+            delta_path,
+            {**postings, "stale": stale[order], "stale_sequence": stale_sequence[order]},
+            meta={"sequence": sequence, "rebuild_requested": bool(meta.get("rebuild_requested") or compact)}
+        )
+
+    if compact:
+
+        from shopify.tasks import async_compact_lexical_index
+
+        try:
+            async_compact_lexical_index.delay()
+        except Exception:
+            log.warning("Could not queue the lexical index rebuild", exc_info=True)
+
+def compact_lexical_index():
+
+    index_path = get_index_path(LEXICAL_INDEX)
+    delta_path = get_index_path(LEXICAL_DELTA)
+
+    with index_lock(LEXICAL_INDEX):
+
+        if not os.path.exists(index_path) or not os.path.exists(delta_path):
+            return
+
+        sequence = read_bundle(delta_path)[0].get("sequence", 0)
+
+    # Built without the lock, saves are not held up by the full read
+    postings, products = _build_base_postings()
+
+    with index_lock(LEXICAL_INDEX):
+
+        if not os.path.exists(delta_path):
+            return
+
+        meta, delta = read_bundle(delta_path)
+
+        # Changes applied after the products were read may be missing from
+        # the new base, they stay in the delta
+        newer = _get_stale_sequence(delta) > sequence
+        stale = delta["stale"][newer]
+
+        keys, ids = _flatten_postings(delta)
+        keep = np.isin(ids, stale)
+
+        write_bundle(index_path, postings, meta={"products": products})
+        write_bundle(
+            delta_path,
+            {**_group_postings(keys[keep], ids[keep]), "stale": stale, "stale_sequence": _get_stale_sequence(delta)[newer]},
+            meta={"sequence": meta.get("sequence", 0)}
+        )
+
+def search_lexical(query):
+
+    (meta, base), (_, delta) = get_lexical_index()
+
+    query_keys = hash_terms(get_terms(query))
+
+    if not len(query_keys):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    base_matches = _lookup(base, query_keys)
+    delta_matches = _lookup(delta, query_keys)
+
+    # Rare terms such as a sku fragment weigh more than common ones
+    products = meta["products"] + len(delta["stale"])
+    document_frequency = np.array([len(a) + len(b) for a, b in zip(base_matches, delta_matches)], dtype=np.float32)
+    weights = np.log1p(products / np.maximum(document_frequency, 1)).astype(np.float32)
+
+    matched_ids, matched_weights = [], []
+
+    for base_ids, delta_ids, weight in zip(base_matches, delta_matches, weights):
+
+        base_ids = base_ids[~np.isin(base_ids, delta["stale"])] if len(delta["stale"]) else base_ids
+
+        for term_ids in (base_ids, delta_ids):
+            matched_ids.append(term_ids)
+            matched_weights.append(np.full(len(term_ids), weight, dtype=np.float32))
+
+    matched_ids = np.concatenate(matched_ids)
+
+    if not len(matched_ids):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    product_ids, inverse = np.unique(matched_ids, return_inverse=True)
+    scores = np.bincount(inverse, weights=np.concatenate(matched_weights)) / weights.sum()
+
+    return product_ids, scores.astype(np.float32)
+
+def remove_lexical_index():
+
+    remove_bundle(get_index_path(LEXICAL_INDEX))
+    remove_bundle(get_index_path(LEXICAL_DELTA))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from shopify.rollups import backfill_history_rollups
+from datetime import timedelta
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Rebuild the hourly and daily ProductHistory rollups from the raw and archived history rows"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument("--batch-size", type=int, default=10000)
+        parser.add_argument("--days", type=int, help="Only rebuild the last N days, defaults to the whole history")
+
+    def handle(self, *args, **options):
+
+        since = timezone.now() - timedelta(days=options["days"]) if options["days"] else None
+
+        started = time.perf_counter()
+        rows = backfill_history_rollups(batch_size=options["batch_size"], since=since)
+
+        self.stdout.write(f"Rolled up {rows} history rows in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,83 @@
+from django.core.management.base import BaseCommand
+from shopify.ann import build_ivf, default_nlist, search_ivf, top_k
+from shopify.utils import get_cached_product_embeddings
+from shopify.encoders import normalize_embeddings
+import numpy as np
+import time
+
+
+def clustered_embeddings(rng, size, dim, clusters):
+
+    # Product names group into topics, uniform noise would make every
+    # partitioning look equally bad
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(clusters, size=size)] + 0.5 * rng.standard_normal((size, dim)).astype(np.float32)
+
+    return normalize_embeddings(vectors)
+
+def per_query_ms(function, queries):
+
+    started = time.perf_counter()
+    results = [function(query) for query in queries]
+
+    return results, (time.perf_counter() - started) * 1000 / len(queries)
+
+
+class Command(BaseCommand):
+
+    help = "Measure recall and latency of the IVF backend against the exhaustive semantic search"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument("--products", type=int, default=100000)
+        parser.add_argument("--dim", type=int, default=300)
+        parser.add_argument("--clusters", type=int, default=1000)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--top-n", type=int, default=10)
+        parser.add_argument("--nlist", type=int, nargs="+", help="Defaults to 4 * sqrt(products)")
+        parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32, 64])
+        parser.add_argument("--from-index", action="store_true", help="Use the product embeddings index instead of synthetic vectors")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+
+        rng = np.random.default_rng(options["seed"])
+        top_n = options["top_n"]
+
+        if options["from_index"]:
+            # Sorted live rows, appended and deleted rows wait for a rebuild
+            product_embeddings = get_cached_product_embeddings()
+            rows = np.argsort(product_embeddings["ids"], kind='stable')
+            rows = rows[product_embeddings["live"][rows]] if "live" in product_embeddings else rows
+            ids, embeddings = product_embeddings["ids"][rows], np.asarray(product_embeddings["embeddings"][rows])
+        else:
+            embeddings = clustered_embeddings(rng, options["products"], options["dim"], options["clusters"])
+            ids = np.arange(len(embeddings), dtype=np.int64)
+
+        # Queries are perturbed products, close to real neighbours but never
+        # an exact copy of one
+        picked = embeddings[rng.integers(len(embeddings), size=options["queries"])]
+        queries = normalize_embeddings(picked + 0.3 * rng.standard_normal(picked.shape).astype(np.float32) / np.sqrt(embeddings.shape[1]))
+
+        expected, exact_ms = per_query_ms(lambda query: set(top_k(embeddings @ query, top_n).tolist()), queries)
+
+        self.stdout.write(f"{len(ids)} products, exhaustive search {exact_ms:.2f} ms/query")
+        self.stdout.write(f"{'nlist':>7} {'nprobe':>7} {'build s':>8} {'recall':>7} {'ms/query':>9} {'speedup':>8}")
+
+        for nlist in options["nlist"] or [default_nlist(len(ids))]:
+
+            started = time.perf_counter()
+            ivf = build_ivf(ids, embeddings, nlist=nlist, seed=options["seed"])
+            build_seconds = time.perf_counter() - started
+
+            for nprobe in options["nprobe"]:
+
+                if nprobe > nlist:
+                    continue
+
+                found, ivf_ms = per_query_ms(lambda query: set(search_ivf(ivf, {"ids": ids, "embeddings": embeddings}, query, top_n, nprobe)[0].tolist()), queries)
+                recall = np.mean([len(hits & truth) / len(truth) for hits, truth in zip(found, expected)])
+
+                self.stdout.write(
+                    f"{nlist:>7} {nprobe:>7} {build_seconds:>8.1f} {recall:>7.3f} {ivf_ms:>9.2f} {exact_ms / ivf_ms:>7.1f}x"
+                )
@@ -0,0 +1,98 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from contextlib import contextmanager
+from django.test.utils import override_settings
+from shopify.models import Product
+from shopify.substring_search import filter_contains
+import numpy as np
+import time
+
+WORDS = ["wireless", "phone", "laptop", "cable", "charger", "gaming", "smart", "watch", "tablet", "speaker", "usb", "case", "screen", "mouse", "keyboard"]
+
+
+def best_time(function, repeat):
+
+    timings = []
+
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - started)
+
+    return result, min(timings)
+
+@contextmanager
+def plain_scan():
+
+    # The GIN indexes serve icontains as is on PostgreSQL, the scan is
+    # measured with bitmap scans disabled for the transaction
+    with override_settings(PRODUCT_SUBSTRING_INDEX=False):
+
+        if connection.vendor != "postgresql":
+            yield
+            return
+
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_bitmapscan TO off")
+
+        try:
+            yield
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_bitmapscan TO on")
+
+def seed_products(count, seed):
+
+    rng = np.random.default_rng(seed)
+
+    Product.objects.bulk_create([
+        Product(
+            name=" ".join(rng.choice(WORDS, size=3)),
+            sku=f"BENCH-{index:08d}",
+            price=int(rng.integers(1, 10000)),
+            quantity=int(rng.integers(0, 100))
+        )
+        for index in range(count)
+    ], batch_size=5000)
+
+
+class Command(BaseCommand):
+
+    help = "Compare the indexed name and sku substring filters against the plain icontains scan"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument("--seed-products", type=int, default=0, help="Add synthetic products for the run, rolled back afterwards")
+        parser.add_argument("--name", nargs="+", default=["phone", "gaming lap", "wire"])
+        parser.add_argument("--sku", nargs="+", default=["0004217", "BENCH-0001"])
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+
+        with transaction.atomic():
+
+            if options["seed_products"]:
+                seed_products(options["seed_products"], options["seed"])
+
+            self.stdout.write(f"{Product.objects.count()} products")
+            self.stdout.write(f"{'field':>5} {'value':>12} {'rows':>7} {'scan ms':>9} {'index ms':>9} {'speedup':>8}")
+
+            for field in ("name", "sku"):
+
+                for value in options[field]:
+
+                    with plain_scan():
+                        scanned, scan_seconds = best_time(lambda: list(filter_contains(Product.objects.all(), field, value).values_list('id', flat=True)), options["repeat"])
+
+                    indexed, index_seconds = best_time(lambda: list(filter_contains(Product.objects.all(), field, value).values_list('id', flat=True)), options["repeat"])
+
+                    if sorted(scanned) != sorted(indexed):
+                        self.stderr.write(f"{field}={value!r}: indexed filter returned {len(indexed)} rows, the scan {len(scanned)}")
+
+                    self.stdout.write(
+                        f"{field:>5} {value:>12} {len(indexed):>7} {scan_seconds * 1000:>9.2f} {index_seconds * 1000:>9.2f} {scan_seconds / index_seconds:>7.1f}x"
+                    )
+
+            # Synthetic products never outlive the run
+            transaction.set_rollback(True)
@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand
+from shopify.ann import top_k
+from shopify.encoders import normalize_embeddings
+import numpy as np
+import time
+
+
+def loop_ranking(query_embedding, product_embeddings, top_n):
+
+    # The per-product ranking semantic_search used before the matrix cache
+    similarities = []
+
+    for product_embedding in product_embeddings:
+        similarity = np.dot(query_embedding, product_embedding) / (np.linalg.norm(query_embedding) * np.linalg.norm(product_embedding))
+        similarities.append(similarity)
+
+    ranked = sorted(enumerate(similarities), key=lambda x: x[1], reverse=True)
+
+    return [index for index, _ in ranked[:top_n]]
+
+def matrix_ranking(query_embedding, embeddings, top_n):
+    return top_k(embeddings @ normalize_embeddings(query_embedding), top_n)
+
+def best_time(function, repeat):
+
+    timings = []
+
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+
+    return min(timings)
+
+
+class Command(BaseCommand):
+
+    help = "Compare the per-product loop against the matrix top-k ranking used by semantic_search"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+        parser.add_argument("--dim", type=int, default=300)
+        parser.add_argument("--top-n", type=int, default=10)
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+
+        rng = np.random.default_rng(options["seed"])
+        top_n = options["top_n"]
+
+        self.stdout.write(f"{'products':>10} {'loop ms':>10} {'matrix ms':>10} {'speedup':>8}")
+
+        for size in options["sizes"]:
+
+            vectors = rng.standard_normal((size, options["dim"])).astype(np.float32)
+            query = rng.standard_normal(options["dim"]).astype(np.float32)
+
+            product_embeddings = list(vectors)
+            embeddings = normalize_embeddings(vectors)
+
+            expected = loop_ranking(query, product_embeddings, top_n)
+
+            if list(matrix_ranking(query, embeddings, top_n)) != expected:
+                self.stderr.write(f"Rankings differ for {size} products")
+
+            loop_seconds = best_time(lambda: loop_ranking(query, product_embeddings, top_n), options["repeat"])
+            matrix_seconds = best_time(lambda: matrix_ranking(query, embeddings, top_n), options["repeat"])
+
+            self.stdout.write(
+                f"{size:>10} {loop_seconds * 1000:>10.2f} {matrix_seconds * 1000:>10.2f} {loop_seconds / matrix_seconds:>7.1f}x"
+            )
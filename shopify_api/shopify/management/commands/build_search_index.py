@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from shopify.tasks import async_build_search_index
+from shopify.utils import build_product_embeddings
+import time
+
+
+class Command(BaseCommand):
+
+    help = "Rebuild the semantic search index from every product, ahead of the first search"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument("--batch-size", type=int, default=settings.SEMANTIC_SEARCH_BUILD_BATCH_SIZE)
+        parser.add_argument("--processes", type=int, default=settings.SEMANTIC_SEARCH_BUILD_PROCESSES)
+        parser.add_argument("--async", dest="run_async", action="store_true", help="Queue the rebuild on a Celery worker")
+
+    def handle(self, *args, **options):
+
+        if options["run_async"]:
+            result = async_build_search_index.delay(batch_size=options["batch_size"], n_process=options["processes"])
+            self.stdout.write(f"Queued search index build {result.id}")
+            return
+
+        started = time.perf_counter()
+        products = build_product_embeddings(batch_size=options["batch_size"], n_process=options["processes"])
+
+        if products is None:
+            self.stdout.write("Another search index build is running, skipped")
+            return
+
+        self.stdout.write(f"Indexed {products} products in {time.perf_counter() - started:.1f}s")
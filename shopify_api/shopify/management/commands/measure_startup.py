@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.utils import timezone
+import subprocess
+import json
+import sys
+
+# Runs in a fresh interpreter so modules already imported by manage.py
+# don't hide the cost being measured
+PROBE = """
+import json, os, resource, sys, time
+started = time.perf_counter()
+import django
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "shopify_api.settings")
+django.setup()
+setup_seconds = time.perf_counter() - started
+import shopify.views
+import_seconds = time.perf_counter() - started
+spacy_loaded_on_import = "spacy" in sys.modules
+from shopify.encoders import get_nlp
+get_nlp()
+model_seconds = time.perf_counter() - started - import_seconds
+json.dump({
+    "django_setup_seconds": setup_seconds,
+    "import_views_seconds": import_seconds,
+    "spacy_model_seconds": model_seconds,
+    "spacy_loaded_on_import": spacy_loaded_on_import,
+    "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+}, sys.stdout)
+"""
+
+
+class Command(BaseCommand):
+
+    help = "Measure how long a fresh process takes to import the app and to load the spaCy model"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--output", help="Append the result as a JSON line to this file")
+
+    def handle(self, *args, **options):
+
+        runs = []
+
+        for _ in range(options["repeat"]):
+
+            result = subprocess.run([sys.executable, "-c", PROBE], cwd=settings.BASE_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+            runs.append(json.loads(result.stdout))
+
+        result = {key: min(run[key] for run in runs) for key in runs[0] if key.endswith(("_seconds", "_kb"))}
+        result["spacy_loaded_on_import"] = any(run["spacy_loaded_on_import"] for run in runs)
+        result["measured_at"] = timezone.now().isoformat()
+        result["spacy_model"] = settings.SPACY_MODEL
+
+        for key, value in result.items():
+            self.stdout.write(f"{key:>22}: {value}")
+
+        if options["output"]:
+            with open(options["output"], "a") as f:
+                f.write(json.dumps(result) + "\n")
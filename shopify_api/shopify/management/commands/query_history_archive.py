@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from shopify.archive import read_archived_history
+
+
+class Command(BaseCommand):
+
+    help = "Read archived ProductHistory rows of a date range, as CSV on stdout or into a file"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument("--start", required=True, help="First day of the range, e.g. 2024-01-01")
+        parser.add_argument("--end", required=True, help="Day after the range, e.g. 2024-02-01")
+        parser.add_argument("--product", type=int, action="append", dest="products", help="Only this product id, repeatable")
+        parser.add_argument("--output", help="Write CSV, or Parquet for a .parquet path, instead of printing")
+
+    def handle(self, *args, **options):
+
+        history = read_archived_history(options["start"], options["end"], product_ids=options["products"])
+
+        if not options["output"]:
+            self.stdout.write(history.to_csv(index=False))
+            return
+
+        if options["output"].endswith(".parquet"):
+            history.to_parquet(options["output"], index=False)
+        else:
+            history.to_csv(options["output"], index=False)
+
+        self.stdout.write(f"Wrote {len(history)} archived rows to {options['output']}")
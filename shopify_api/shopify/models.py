@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.contrib.postgres.fields import JSONField
 
@@ -18,53 +20,199 @@ class Product(models.Model):
     def __str__(self):
         return self.name
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        
+        instance = super(Product, cls).from_db(db, field_names, values)
+        
+        # Snapshot of the loaded row, save() diffs against it instead of
+        # reading the row again
+        instance._loaded_values = {
+            name: value for name, value in zip(field_names, values) if value is not models.DEFERRED
+        }
+        
+        return instance
+    
+    def refresh_from_db(self, using=None, fields=None):
+        
+        super(Product, self).refresh_from_db(using=using, fields=fields)
+        
+        # The refreshed values are what the row holds now, a later save
+        # diffs against them instead of the values loaded before
+        if fields is not None:
+            refreshed = [self._meta.get_field(name).attname for name in fields]
+        else:
+            refreshed = [field.attname for field in self._meta.concrete_fields]
+        
+        loaded_values = dict(getattr(self, '_loaded_values', None) or {})
+        loaded_values.update({name: self.__dict__[name] for name in refreshed if name in self.__dict__})
+        
+        self._loaded_values = loaded_values
+    
+    def get_current_values(self):
+        
+        # Deferred fields that were never loaded or assigned are left out
+        return {
+            field.attname: self.__dict__[field.attname]
+            for field in self._meta.concrete_fields if field.attname in self.__dict__
+        }
+    
+    def get_loaded_values(self):
+        
+        loaded_values = getattr(self, '_loaded_values', None)
+        
+        if loaded_values is None and self.pk:
+            loaded_values = Product.objects.filter(pk=self.pk).values(
+                *[field.attname for field in self._meta.concrete_fields]
+            ).first()
+        
+        return loaded_values
+    
+    def get_changed_fields(self, loaded_values):
+        
+        # A deferred field assigned without being loaded has nothing to
+        # compare with, it is written like a change
+        return [
+            name for name, value in self.get_current_values().items()
+            if name not in ('id', 'updated_at') and (name not in loaded_values or loaded_values[name] != value)
+        ]
+    
+    def get_history_changes(self, previous_quantity, previous_price):
+        
+        # None marks a field that was not changed
+        histories = []
+        
+        if previous_quantity is not None and previous_quantity != self.quantity:
+            histories.append(ProductHistory(
+                product=self,
+                previous_quantity=previous_quantity,
+                current_quantity=self.quantity,
+                type=ProductHistory.STOCK_CHANGE
+            ))
+        
+        if previous_price is not None and previous_price != self.price:
+            histories.append(ProductHistory(
+                product=self,
+                previous_quantity=previous_price,
+                current_quantity=self.price,
+                type=ProductHistory.PRICE_CHANGE
+            ))
+        
+        return histories
+    
     def save(self, *args, **kwargs):
         
-        if self.pk:
+        histories = []
+        changed_fields = None
+        requested_fields = kwargs.get('update_fields')
+        adding = self._state.adding
+        loaded_values = self.get_loaded_values() if self.pk else None
+        
+        if loaded_values is not None and not kwargs.get('force_insert'):
             
-            previous_instance = Product.objects.get(pk=self.pk)
+            changed_fields = self.get_changed_fields(loaded_values)
             
-            if previous_instance.quantity != self.quantity:
-                ProductHistory.objects.create(
-                    product=self,
-                    previous_quantity=previous_instance.quantity,
-                    current_quantity=self.quantity,
-                    type=ProductHistory.STOCK_CHANGE
-                )
+            if requested_fields is not None:
+                changed_fields = [name for name in changed_fields if name in requested_fields]
             
-            elif previous_instance.price != self.price:
-                ProductHistory.objects.create(
-                    product=self,
-                    previous_quantity=previous_instance.price,
-                    current_quantity=self.price,
-                    type=ProductHistory.PRICE_CHANGE
-                )
-        
-        from shopify.utils import remove_cache_embeddings
-        remove_cache_embeddings()
+            if not changed_fields:
+                return
+            
+            if requested_fields is None:
+                kwargs['update_fields'] = changed_fields + ['updated_at']
+            
+            # History and counters need the previous stock and price of a
+            # deferred field that was assigned without being loaded
+            missing = [name for name in ('quantity', 'price') if name in changed_fields and name not in loaded_values]
+            
+            if missing:
+                loaded_values = {**loaded_values, **(Product.objects.filter(pk=self.pk).values(*missing).first() or {})}
+            
+            histories = self.get_history_changes(
+                loaded_values['quantity'] if 'quantity' in changed_fields else None,
+                loaded_values['price'] if 'price' in changed_fields else None
+            )
         
         super(Product, self).save(*args, **kwargs)
         
+        ProductHistory.objects.bulk_create(histories)
+        
+        if histories:
+            from shopify.rollups import record_history_rollups
+            record_history_rollups(histories)
+        
+        from shopify.insights import record_stock_changes
+        
+        if adding:
+            record_stock_changes(added=[self.quantity])
+        elif changed_fields and 'quantity' in changed_fields:
+            record_stock_changes(changed=[(loaded_values['quantity'], self.quantity)])
+        
+        # Only a new product or a renamed one needs a fresh embedding,
+        # stock and price changes only patch the filter columns
+        if changed_fields is None or 'name' in changed_fields or 'sku' in changed_fields:
+            from shopify.utils import update_cache_embeddings
+            update_cache_embeddings([self])
+        
+        elif 'price' in changed_fields or 'quantity' in changed_fields:
+            from shopify.utils import update_cache_columns
+            update_cache_columns([self])
+        
+        saved_values = self.get_current_values()
+        
+        # Fields left out of update_fields still differ from the row
+        if requested_fields is not None and loaded_values is not None:
+            saved_values = {**loaded_values, **{
+                name: value for name, value in saved_values.items() if name in requested_fields or name == 'updated_at'
+            }}
+        
+        self._loaded_values = saved_values
+        
     class Meta:
         permissions = [
             ("can_view_product", "Can read product"),
             ("can_edit_product", "Can edit product"),
         ]
+        indexes = [
+            # Key of the updated_at cursor pages
+            models.Index(fields=['updated_at', 'id'], name='product_updated_id_idx')
+        ]
+
+
+@receiver(post_delete, sender=Product)
+def remove_deleted_product_embedding(sender, instance, **kwargs):
+    
+    from shopify.utils import remove_cache_embeddings
+    remove_cache_embeddings([instance.pk])
+    
+    from shopify.insights import record_stock_changes
+    record_stock_changes(removed=[instance.quantity])
+        
         
+# Module level so the unique constraint in MockProductData.Meta can use it,
+# a nested Meta does not see the attributes of its model class
+ACTIVE_IMPORT_STATUSES = ['PENDING', 'PROCESSING', 'COMPLETED']
+
+
 class MockProductData(models.Model):
     
     PENDING = 'PENDING'
     PROCESSING = 'PROCESSING'
     COMPLETED = 'COMPLETED'
     FAILED = 'FAILED'
+    DUPLICATE = 'DUPLICATE'
     
     STATUS_CHOICES = [
         (PENDING, 'Pending'),
         (PROCESSING, 'Processing'),
         (COMPLETED, 'Completed'),
         (FAILED, 'Failed'),
+        (DUPLICATE, 'Duplicate'),
     ]
     
+    # Statuses whose content hash blocks another upload of the same file
+    ACTIVE_STATUSES = ACTIVE_IMPORT_STATUSES
+    
     file = models.FileField(upload_to='mock_product_data/')
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
     failure_reason = models.TextField(null=True, blank=True)
@@ -72,11 +220,87 @@ class MockProductData(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     celery_task_id = models.CharField(max_length=256, null=True, blank=True)
     changes_summary = JSONField(default=dict, blank=True)
+    processed_rows = models.PositiveIntegerField(default=0)
+    total_rows = models.PositiveIntegerField(null=True, blank=True)
+    rows_read = models.PositiveIntegerField(default=0)
+    rows_created = models.PositiveIntegerField(default=0)
+    rows_updated = models.PositiveIntegerField(default=0)
+    rows_discarded = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    progress_updated_at = models.DateTimeField(null=True, blank=True)
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    duplicate_of = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='duplicates')
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['content_hash'],
+                condition=models.Q(status__in=ACTIVE_IMPORT_STATUSES),
+                name='unique_active_mock_product_content_hash'
+            )
+        ]
+    
+    @property
+    def rows_per_second(self):
+        
+        if not self.started_at or not self.progress_updated_at:
+            return 0
+        
+        elapsed = (self.progress_updated_at - self.started_at).total_seconds()
+        
+        return round(self.rows_read / elapsed, 2) if elapsed > 0 else 0
+    
+    @property
+    def eta_seconds(self):
+        
+        if self.status != self.PROCESSING or self.total_rows is None or not self.rows_per_second:
+            return None
+        
+        return round(max(self.total_rows - self.rows_read, 0) / self.rows_per_second)
 
     def __str__(self):
         return f"MockProductData {self.id} - {self.status}"
     
 
+class MockProductDataShard(models.Model):
+    
+    mock_data = models.ForeignKey(MockProductData, on_delete=models.CASCADE, related_name='shards')
+    shard = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=MockProductData.STATUS_CHOICES, default=MockProductData.PENDING)
+    failure_reason = models.TextField(null=True, blank=True)
+    processed_rows = models.PositiveIntegerField(default=0)
+    # Progress of committed chunks not yet added to the import row
+    rows_read = models.PositiveIntegerField(default=0)
+    rows_created = models.PositiveIntegerField(default=0)
+    rows_updated = models.PositiveIntegerField(default=0)
+    rows_discarded = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ('mock_data', 'shard')
+    
+    def __str__(self):
+        return f"MockProductData {self.mock_data_id} shard {self.shard} - {self.status}"
+
+
+class MockProductDataChunk(models.Model):
+    
+    # Summary of one committed chunk, saved with its checkpoint and
+    # assembled into changes_summary once when the import completes
+    mock_data = models.ForeignKey(MockProductData, on_delete=models.CASCADE, related_name='chunks')
+    shard = models.PositiveIntegerField(null=True, blank=True)
+    first_row = models.PositiveIntegerField()
+    changes_summary = JSONField(default=dict, blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['mock_data', 'shard', 'first_row'], name='mock_data_chunk_idx')
+        ]
+    
+    def __str__(self):
+        return f"MockProductData {self.mock_data_id} chunk at row {self.first_row}"
+    
+
 class ProductHistory(models.Model):
     
     STOCK_CHANGE = "STOCK"
@@ -92,9 +316,99 @@ class ProductHistory(models.Model):
     previous_quantity = models.IntegerField()
     current_quantity = models.IntegerField()
     updated_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            # Window queries and the archive range over updated_at and
+            # group by product, the history of one product reads by time
+            models.Index(fields=['updated_at', 'product'], name='history_updated_product_idx'),
+            models.Index(fields=['product', 'updated_at'], name='history_product_updated_idx')
+        ]
 
     def __str__(self):
         return f"Product: {self.product.name}"
+
+
+class ProductHistoryRollup(models.Model):
+    
+    # Changes of one product and type within one bucket, total_change sums
+    # the absolute deltas and net_change the signed ones
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    type = models.CharField(max_length=50, choices=ProductHistory.CHANGE_TYPES)
+    bucket = models.DateTimeField()
+    total_change = models.BigIntegerField(default=0)
+    net_change = models.BigIntegerField(default=0)
+    changes = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        abstract = True
+    
+    def __str__(self):
+        return f"Product {self.product_id} {self.type} at {self.bucket}"
+
+
+class ProductHistoryHourly(ProductHistoryRollup):
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'type', 'bucket'], name='unique_product_history_hourly')
+        ]
+        indexes = [
+            models.Index(fields=['bucket', 'product'], name='history_hourly_bucket_idx')
+        ]
+
+
+class ProductHistoryDaily(ProductHistoryRollup):
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'type', 'bucket'], name='unique_product_history_daily')
+        ]
+        indexes = [
+            models.Index(fields=['bucket', 'product'], name='history_daily_bucket_idx')
+        ]
+
+
+class ProductEmbedding(models.Model):
+    
+    # Normalized float32 vector of the product name, reused by rebuilds as
+    # long as the name hash and the encoder are unchanged
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True, related_name='embedding')
+    encoder = models.CharField(max_length=256)
+    text_hash = models.CharField(max_length=64)
+    vector = models.BinaryField()
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"Embedding of product {self.product_id}"
+    
+class ProductCounter(models.Model):
+    
+    # Running totals kept up to date by product writes, read instead of
+    # counting the catalog. A counter is split over stripe rows summed on
+    # read, concurrent writers mostly update different rows
+    name = models.CharField(max_length=64)
+    stripe = models.PositiveSmallIntegerField(default=0)
+    value = models.BigIntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'stripe'], name='unique_product_counter_stripe')
+        ]
+    
+    def __str__(self):
+        return f"{self.name}[{self.stripe}]: {self.value}"
+
+
+class ProductInsightsSnapshot(models.Model):
+    
+    key = models.CharField(max_length=256, primary_key=True)
+    insights = JSONField(default=dict)
+    computed_at = models.DateTimeField()
+    refresh_requested_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"Insights {self.key} at {self.computed_at}"
     
 class Discount(models.Model):
     
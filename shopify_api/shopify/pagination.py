@@ -0,0 +1,175 @@
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from django.db import connection
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
+import json
+
+# Keyset pagination: a page is the rows after the key of the last row
+# shown, read through the ordering index. Deep pages cost the same as the
+# first one, there is no OFFSET and by default no COUNT.
+ORDERINGS = {
+    "id": ("id",),
+    "updated_at": ("updated_at", "id"),
+}
+
+COUNT_NONE = "none"
+COUNT_APPROXIMATE = "approximate"
+COUNT_EXACT = "exact"
+COUNT_MODES = (COUNT_NONE, COUNT_APPROXIMATE, COUNT_EXACT)
+
+
+class PaginationError(Exception):
+    pass
+
+
+def get_approximate_count(queryset):
+
+    # The planner estimate costs nothing on PostgreSQL, other databases
+    # count for real
+    if connection.vendor != "postgresql":
+        return queryset.count()
+
+    sql, params = queryset.query.sql_with_params()
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class KeysetPagination(BasePagination):
+
+    page_size = 10
+    cursor_query_param = "cursor"
+    ordering_query_param = "ordering"
+    count_query_param = "count"
+
+    def get_ordering(self, request):
+
+        ordering = request.query_params.get(self.ordering_query_param, "id")
+        fields = ORDERINGS.get(ordering.lstrip("-"))
+
+        if fields is None:
+            raise PaginationError(f"ordering must be one of {', '.join(ORDERINGS)}, optionally prefixed with -.")
+
+        return fields, ordering.startswith("-")
+
+    def get_count_mode(self, request):
+
+        count_mode = request.query_params.get(self.count_query_param, COUNT_NONE)
+
+        if count_mode not in COUNT_MODES:
+            raise PaginationError(f"count must be one of {', '.join(COUNT_MODES)}.")
+
+        return count_mode
+
+    def encode_cursor(self, values, reverse):
+
+        cursor = {"v": [value.isoformat() if hasattr(value, "isoformat") else value for value in values], "r": reverse}
+
+        return urlsafe_b64encode(json.dumps(cursor, separators=(",", ":")).encode()).decode()
+
+    def decode_cursor(self, request, fields):
+
+        encoded = request.query_params.get(self.cursor_query_param)
+
+        if not encoded:
+            return None, False
+
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode()))
+            values = [parse_datetime(value) if field == "updated_at" else int(value) for field, value in zip(fields, cursor["v"])]
+            reverse = bool(cursor.get("r"))
+        except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+            raise PaginationError("Invalid cursor.")
+
+        if len(values) != len(fields) or None in values:
+            raise PaginationError("Invalid cursor.")
+
+        return values, reverse
+
+    def get_key_filter(self, fields, values, greater):
+
+        # (a, b) > (x, y) written as a > x OR (a = x AND b > y)
+        lookup = "gt" if greater else "lt"
+        key_filter = Q()
+
+        for index, field in enumerate(fields):
+            key_filter |= Q(**dict(zip(fields[:index], values[:index])), **{f"{field}__{lookup}": values[index]})
+
+        return key_filter
+
+    def get_count(self, queryset, count_mode):
+
+        if count_mode == COUNT_EXACT:
+            return queryset.count()
+
+        if count_mode == COUNT_APPROXIMATE:
+            return get_approximate_count(queryset)
+
+        return None
+
+    def paginate_queryset(self, queryset, request, view=None):
+
+        self.request = request
+
+        fields, descending = self.get_ordering(request)
+        count_mode = self.get_count_mode(request)
+        values, reverse = self.decode_cursor(request, fields)
+
+        self.fields = fields
+        self.count = self.get_count(queryset, count_mode)
+
+        # A previous page reads backwards from its cursor and is flipped
+        # into display order afterwards
+        backwards = descending != reverse
+
+        if values is not None:
+            queryset = queryset.filter(self.get_key_filter(fields, values, greater=not backwards))
+
+        rows = list(queryset.order_by(*[f"-{field}" if backwards else field for field in fields])[:self.page_size + 1])
+
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+
+        if reverse:
+            rows.reverse()
+
+        has_next, has_previous = (values is not None, has_more) if reverse else (has_more, values is not None)
+
+        self.next_cursor = self.encode_cursor(self.get_key(rows[-1]), False) if has_next and rows else None
+        self.previous_cursor = self.encode_cursor(self.get_key(rows[0]), True) if has_previous and rows else None
+
+        return rows
+
+    def get_key(self, row):
+        return [getattr(row, field) for field in self.fields]
+
+    def get_link(self, cursor):
+
+        if cursor is None:
+            return None
+
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+
+        response = {
+            "next": self.get_link(self.next_cursor),
+            "previous": self.get_link(self.previous_cursor),
+        }
+
+        if self.count is not None:
+            response["count"] = self.count
+
+        response["results"] = data
+
+        return Response(response)
@@ -0,0 +1,248 @@
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from shopify.models import Product, ProductHistory, ProductHistoryDaily, ProductHistoryHourly
+from shopify.archive import get_archived_months, read_archived_history
+from datetime import timedelta
+import pandas as pd
+
+# ProductHistory pre-aggregated per product, change type and bucket. Rows
+# are added to as history is written, window queries read a few rollup
+# rows per product instead of every change.
+HOUR = "hour"
+DAY = "day"
+
+ROLLUPS = {
+    HOUR: ProductHistoryHourly,
+    DAY: ProductHistoryDaily,
+}
+
+# Windows up to this long read the hourly rollups, longer ones the daily
+HOURLY_WINDOW = timedelta(days=7)
+
+
+def get_bucket(timestamp, period):
+
+    bucket = timestamp.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+    return bucket.replace(hour=0) if period == DAY else bucket
+
+def aggregate_histories(histories, period):
+
+    totals = {}
+
+    for product_id, change_type, previous, current, updated_at in histories:
+
+        key = (product_id, change_type, get_bucket(updated_at, period))
+        total_change, net_change, changes = totals.get(key, (0, 0, 0))
+
+        totals[key] = (total_change + abs(current - previous), net_change + current - previous, changes + 1)
+
+    return totals
+
+def supports_upsert():
+
+    # ON CONFLICT ... DO UPDATE needs SQLite 3.24, the Python 3.6 of Debian
+    # stretch links 3.16
+    if connection.vendor == "sqlite":
+        return connection.Database.sqlite_version_info >= (3, 24, 0)
+
+    return connection.vendor == "postgresql"
+
+def _add_to_rollups(model, totals):
+
+    # Added to the bucket with an UPDATE, created when it doesn't exist
+    # yet. A writer that created it first makes get_or_create return it,
+    # the totals are then added to that row
+    with transaction.atomic():
+
+        for (product_id, change_type, bucket), (total_change, net_change, changes) in sorted(totals.items()):
+
+            increments = {
+                "total_change": F('total_change') + total_change,
+                "net_change": F('net_change') + net_change,
+                "changes": F('changes') + changes
+            }
+
+            rollups = model.objects.filter(product_id=product_id, type=change_type, bucket=bucket)
+
+            if rollups.update(**increments):
+                continue
+
+            _, created = model.objects.get_or_create(
+                product_id=product_id, type=change_type, bucket=bucket,
+                defaults={"total_change": total_change, "net_change": net_change, "changes": changes}
+            )
+
+            if not created:
+                rollups.update(**increments)
+
+def _upsert_rollups(model, totals):
+
+    if not totals:
+        return
+
+    if not supports_upsert():
+        _add_to_rollups(model, totals)
+        return
+
+    table = connection.ops.quote_name(model._meta.db_table)
+
+    # One statement adds to an existing bucket, concurrent writers never
+    # overwrite each other
+    sql = (
+        f"INSERT INTO {table} (product_id, type, bucket, total_change, net_change, changes) VALUES (%s, %s, %s, %s, %s, %s) "
+        f"ON CONFLICT (product_id, type, bucket) DO UPDATE SET "
+        f"total_change = {table}.total_change + excluded.total_change, "
+        f"net_change = {table}.net_change + excluded.net_change, "
+        f"changes = {table}.changes + excluded.changes"
+    )
+
+    params = [
+        (product_id, change_type, connection.ops.adapt_datetimefield_value(bucket), *values)
+        for (product_id, change_type, bucket), values in sorted(totals.items())
+    ]
+
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+def record_rollup_rows(rows):
+
+    rows = list(rows)
+
+    for period, model in ROLLUPS.items():
+        _upsert_rollups(model, aggregate_histories(rows, period))
+
+def record_history_rollups(histories):
+
+    record_rollup_rows(
+        (history.product_id, history.type, history.previous_quantity, history.current_quantity, history.updated_at)
+        for history in histories
+    )
+
+def _backfill_archived(start, end, batch_size):
+
+    # Rows archived before end, the oldest row still in the table. Rows of
+    # an interrupted archive run are still in the table too and only read
+    # from there
+    end = pd.Timestamp(end)
+    rows = 0
+
+    for month in get_archived_months():
+
+        month_start = pd.Timestamp(f"{month}-01", tz='UTC')
+        range_start = month_start if start is None else max(month_start, pd.Timestamp(start))
+        range_end = min(month_start + pd.offsets.MonthBegin(1), end)
+
+        if range_start >= range_end:
+            continue
+
+        frame = read_archived_history(range_start, range_end)
+
+        for offset in range(0, len(frame), batch_size):
+
+            batch = frame.iloc[offset:offset + batch_size]
+
+            record_rollup_rows(zip(
+                batch['product_id'].tolist(),
+                batch['type'].tolist(),
+                batch['previous_quantity'].tolist(),
+                batch['current_quantity'].tolist(),
+                batch['updated_at'].dt.to_pydatetime()
+            ))
+
+        rows += len(frame)
+
+    return rows
+
+def prune_hourly_rollups(retention_days=None):
+
+    retention_days = retention_days if retention_days is not None else settings.PRODUCT_HISTORY_HOURLY_ROLLUP_RETENTION_DAYS
+
+    # Never shorter than the windows read from the hourly rollups
+    retention = max(timedelta(days=retention_days), HOURLY_WINDOW + timedelta(days=1))
+    deleted, _ = ProductHistoryHourly.objects.filter(bucket__lt=get_bucket(timezone.now() - retention, DAY)).delete()
+
+    return deleted
+
+def backfill_history_rollups(batch_size=10000, since=None):
+
+    start = get_bucket(since, DAY) if since is not None else None
+    histories = ProductHistory.objects.order_by('id')
+
+    if start is not None:
+        histories = histories.filter(updated_at__gte=start)
+
+    # Rows written from here on are rolled up by their own save, the
+    # backfill stops at the last row that exists now
+    with transaction.atomic():
+
+        for model in ROLLUPS.values():
+
+            rollups = model.objects.all()
+
+            if start is not None:
+                rollups = rollups.filter(bucket__gte=start)
+
+            rollups.delete()
+
+        last_id = histories.values_list('id', flat=True).last()
+        first_hot = ProductHistory.objects.order_by('updated_at').values_list('updated_at', flat=True).first()
+
+    # History moved to the archive is rolled up from there, the deleted
+    # buckets are rebuilt in full
+    rows = _backfill_archived(start, first_hot or timezone.now(), batch_size)
+    after = 0
+
+    while last_id is not None and after < last_id:
+
+        batch = list(histories.filter(id__gt=after, id__lte=last_id).values_list(
+            'id', 'product_id', 'type', 'previous_quantity', 'current_quantity', 'updated_at'
+        )[:batch_size])
+
+        if not batch:
+            break
+
+        record_rollup_rows(row[1:] for row in batch)
+
+        after = batch[-1][0]
+        rows += len(batch)
+
+    prune_hourly_rollups()
+
+    return rows
+
+def get_window_totals(days, now=None):
+
+    # The period follows the requested length, not the distance from a since
+    # computed by the caller a moment earlier
+    window = timedelta(days=days)
+    period = HOUR if window <= HOURLY_WINDOW else DAY
+    since = (now or timezone.now()) - window
+
+    # The window starts at the bucket holding since, at most one bucket
+    # longer than asked
+    return ROLLUPS[period].objects.filter(bucket__gte=get_bucket(since, period)).values('product')
+
+def get_top_changed_products(days, top_n, now=None):
+
+    ranked = list(
+        get_window_totals(days, now=now)
+        .annotate(total=Sum('total_change'))
+        .filter(total__gt=0)
+        .order_by('-total', 'product')
+        .values_list('product', 'total')[:top_n]
+    )
+
+    products = Product.objects.in_bulk([product_id for product_id, _ in ranked])
+
+    trending = []
+
+    for product_id, total in ranked:
+
+        if product_id in products:
+            products[product_id].total_change = total
+            trending.append(products[product_id])
+
+    return trending
@@ -0,0 +1,218 @@
+from django.conf import settings
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+import threading
+import logging
+import json
+import time
+
+log = logging.getLogger("django")
+
+REDIS_KEY_PREFIX = "semantic_search"
+
+
+class LRUCache:
+
+    def __init__(self, maxsize, ttl):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+
+        with self._lock:
+
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[1]
+
+    def set(self, key, value):
+
+        with self._lock:
+
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "maxsize": self.maxsize}
+
+
+class RedisCache:
+
+    # Shared by every worker, errors only cost the lookup, never the search
+    def __init__(self, prefix):
+
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def get(self, key):
+
+        client = get_redis()
+
+        if client is None:
+            return None
+
+        try:
+            value = client.get(f"{REDIS_KEY_PREFIX}:{self.prefix}:{key}")
+        except Exception:
+            log.warning("Semantic search cache read failed", exc_info=True)
+            self.errors += 1
+            return None
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return value
+
+    def set(self, key, value):
+
+        client = get_redis()
+
+        if client is None:
+            return
+
+        try:
+            client.set(f"{REDIS_KEY_PREFIX}:{self.prefix}:{key}", value, ex=settings.SEMANTIC_SEARCH_CACHE_TTL)
+        except Exception:
+            log.warning("Semantic search cache write failed", exc_info=True)
+            self.errors += 1
+
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "errors": self.errors}
+
+
+@lru_cache(maxsize=None)
+def get_redis():
+
+    if not settings.SEMANTIC_SEARCH_CACHE_REDIS_URL:
+        return None
+
+    import redis
+
+    return redis.Redis.from_url(settings.SEMANTIC_SEARCH_CACHE_REDIS_URL, socket_timeout=0.05)
+
+
+query_vectors = LRUCache(settings.SEMANTIC_SEARCH_QUERY_CACHE_SIZE, settings.SEMANTIC_SEARCH_CACHE_TTL)
+results = LRUCache(settings.SEMANTIC_SEARCH_RESULT_CACHE_SIZE, settings.SEMANTIC_SEARCH_CACHE_TTL)
+shared_query_vectors = RedisCache("vector")
+shared_results = RedisCache("results")
+
+
+def normalize_query(query):
+    return " ".join(query.split())
+
+def _lookup_query_vector(query):
+
+    vector = query_vectors.get(query)
+
+    if vector is not None:
+        return vector
+
+    shared = shared_query_vectors.get(query)
+
+    if shared is not None:
+        vector = np.frombuffer(shared, dtype=np.float32)
+        query_vectors.set(query, vector)
+
+    return vector
+
+def _store_query_vector(query, vector):
+
+    query_vectors.set(query, vector)
+    shared_query_vectors.set(query, vector.astype(np.float32).tobytes())
+
+def get_query_vector(query, encode, namespace=""):
+
+    # Namespaced by encoder, vectors of different models never mix
+    vector = _lookup_query_vector(f"{namespace}:{query}")
+
+    if vector is None:
+        vector = encode(query)
+        _store_query_vector(f"{namespace}:{query}", vector)
+
+    return vector
+
+def get_query_vectors(queries, encode_many, namespace=""):
+
+    vectors = {query: _lookup_query_vector(f"{namespace}:{query}") for query in queries}
+    missing = [query for query, vector in vectors.items() if vector is None]
+
+    # Every query not cached yet is encoded in one batch
+    if missing:
+        for query, vector in zip(missing, encode_many(missing)):
+            vectors[query] = vector
+            _store_query_vector(f"{namespace}:{query}", vector)
+
+    return np.stack([vectors[query] for query in queries]) if queries else np.empty((0, 0), dtype=np.float32)
+
+def get_results(key):
+
+    cached = results.get(key)
+
+    if cached is not None:
+        return cached
+
+    shared = shared_results.get(key)
+
+    if shared is None:
+        return None
+
+    cached = [tuple(result) for result in json.loads(shared)]
+    results.set(key, cached)
+
+    return cached
+
+def set_results(key, ranked):
+
+    results.set(key, ranked)
+    shared_results.set(key, json.dumps(ranked))
+
+def clear_search_caches():
+
+    for cache in (query_vectors, results, shared_query_vectors, shared_results):
+        cache.clear()
+
+def get_search_cache_stats():
+
+    # Counters belong to this worker process, Redis only stores the entries
+    return {
+        "query_vectors": query_vectors.stats(),
+        "results": results.stats(),
+        "redis": {
+            "enabled": bool(settings.SEMANTIC_SEARCH_CACHE_REDIS_URL),
+            "query_vectors": shared_query_vectors.stats(),
+            "results": shared_results.stats()
+        }
+    }
@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from shopify.models import Product
+from shopify.models import Product, MockProductData
 from rest_framework.validators import UniqueValidator
 
 class ProductSerializer(serializers.Serializer):
@@ -14,4 +14,15 @@ class ProductSerializer(serializers.Serializer):
         fields = ['sku', 'name', 'quantity', "price"]
         
     def create(self, validated_data):
-        return Product.objects.create(**validated_data)
\ No newline at end of file
+        return Product.objects.create(**validated_data)
+        
+class MockProductDataProgressSerializer(serializers.ModelSerializer):
+    
+    class Meta:
+        model = MockProductData
+        fields = [
+            'id', 'status', 'celery_task_id', 'failure_reason', 'duplicate_of', 'total_rows',
+            'rows_read', 'rows_created', 'rows_updated', 'rows_discarded',
+            'rows_per_second', 'eta_seconds', 'started_at', 'progress_updated_at'
+        ]
+        read_only_fields = fields
\ No newline at end of file
@@ -0,0 +1,114 @@
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.db.models.expressions import RawSQL
+from shopify.models import Product
+import logging
+
+log = logging.getLogger("django")
+
+# icontains compiles to LIKE '%value%', which no btree index can serve.
+# PostgreSQL gets pg_trgm GIN indexes on the exact UPPER(column) expression
+# icontains filters on, so the same query uses them unchanged. SQLite gets
+# an FTS5 trigram table over name and sku, kept in sync by triggers, whose
+# matches narrow the rows LIKE still checks.
+SEARCH_FIELDS = ("name", "sku")
+FTS_TABLE = "shopify_product_fts"
+
+# Trigram queries need at least one trigram, shorter values scan
+MIN_TRIGRAM_LENGTH = 3
+
+
+def _create_sqlite_index(connection):
+
+    product_table = Product._meta.db_table
+
+    with connection.cursor() as cursor:
+
+        created = FTS_TABLE not in connection.introspection.table_names(cursor)
+
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            f"name, sku, content='{product_table}', content_rowid='id', tokenize='trigram')"
+        )
+
+        cursor.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON {product_table} BEGIN "
+            f"INSERT INTO {FTS_TABLE}(rowid, name, sku) VALUES (new.id, new.name, new.sku); END"
+        )
+
+        cursor.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON {product_table} BEGIN "
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, sku) VALUES ('delete', old.id, old.name, old.sku); END"
+        )
+
+        # Price and stock updates leave the search table alone
+        cursor.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF name, sku ON {product_table} BEGIN "
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, sku) VALUES ('delete', old.id, old.name, old.sku); "
+            f"INSERT INTO {FTS_TABLE}(rowid, name, sku) VALUES (new.id, new.name, new.sku); END"
+        )
+
+        if created:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+def _create_postgresql_index(connection):
+
+    product_table = connection.ops.quote_name(Product._meta.db_table)
+
+    with connection.cursor() as cursor:
+
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+        for field in SEARCH_FIELDS:
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS shopify_product_{field}_trgm_idx ON {product_table} "
+                f"USING gin (UPPER({connection.ops.quote_name(field)}::text) gin_trgm_ops)"
+            )
+
+def create_substring_index(using="default"):
+
+    connection = connections[using]
+
+    # Needs SQLite 3.34 for the trigram tokenizer and the pg_trgm
+    # extension on PostgreSQL, searches keep scanning without them
+    try:
+        if connection.vendor == "sqlite":
+            _create_sqlite_index(connection)
+        elif connection.vendor == "postgresql":
+            _create_postgresql_index(connection)
+        else:
+            return
+    except DatabaseError:
+        log.warning("Could not create the product substring index", exc_info=True)
+        return
+
+    connection._product_fts_table = connection.vendor == "sqlite"
+
+def has_fts_table(connection):
+
+    # Looked up once per connection, the table only appears on migrate
+    if not hasattr(connection, "_product_fts_table"):
+        with connection.cursor() as cursor:
+            connection._product_fts_table = FTS_TABLE in connection.introspection.table_names(cursor)
+
+    return connection._product_fts_table
+
+def get_fts_query(field, value):
+
+    # One quoted phrase per column, trigram phrases match anywhere inside
+    return f'{field} : "{value.replace(chr(34), chr(34) * 2)}"'
+
+def filter_contains(queryset, field, value):
+
+    queryset = queryset.filter(**{f"{field}__icontains": value})
+    connection = connections[queryset.db]
+
+    if not settings.PRODUCT_SUBSTRING_INDEX or connection.vendor != "sqlite" or len(value) < MIN_TRIGRAM_LENGTH:
+        return queryset
+
+    if not has_fts_table(connection):
+        return queryset
+
+    # The trigram match picks the candidate rows, icontains still decides
+    # so results are exactly the ones of the plain scan
+    return queryset.filter(id__in=RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [get_fts_query(field, value)]))
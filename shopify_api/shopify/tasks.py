@@ -1,14 +1,27 @@
 from shopify_api.celery import app
-from shopify.models import MockProductData, Product
+from celery import chord, group
+from shopify.models import MockProductData, MockProductDataChunk, MockProductDataShard
 import os
 from django.core.files import File
 import pandas as pd
-from shopify.serializers import ProductSerializer
+from shopify.importer import (
+    get_missing_column, read_columns, iter_product_chunks, iter_shard_chunks,
+    partition_shards, get_shard_path, remove_shard_files,
+    merge_summaries, merge_shard_summaries, upsert_products,
+    start_progress, ImportProgress, hash_file, find_duplicate_import
+)
+from shopify.utils import build_product_embeddings
+from shopify.lexical import compact_lexical_index
+from shopify.insights import recount_stock_counters, refresh_product_insights
+from shopify.archive import archive_product_history
+from shopify.rollups import prune_hourly_rollups
+from multiprocessing import current_process
 from django.utils import timezone
 from datetime import timedelta
 from core.email_util import send_email
 import traceback
-from django.db import transaction
+from django.db import transaction, IntegrityError
+from django.conf import settings
 import logging
 
 log = logging.getLogger("django")
@@ -24,13 +37,39 @@ def async_import_mock_products_file(self, file_path):
     
     try:
         
-        with transaction.atomic():
+        if not os.path.exists(file_path):
+            mock_product_obj.status = MockProductData.FAILED
+            mock_product_obj.failure_reason = f"Failed to import file. No file on path {file_path}"
+            mock_product_obj.save()
+            return
         
-            if not os.path.exists(file_path):
-                mock_product_obj.status = MockProductData.FAILED
-                mock_product_obj.failure_reason = f"Failed to import file. No file on path {file_path}"
-                mock_product_obj.save()
+        content_hash = hash_file(file_path)
+        duplicate = find_duplicate_import(content_hash, exclude_id=mock_product_obj.id)
+        
+        if not duplicate:
+            
+            # The partial unique index on content_hash catches an identical
+            # upload racing this one between the lookup and the save
+            try:
+                with transaction.atomic():
+                    mock_product_obj.content_hash = content_hash
+                    mock_product_obj.save()
+            except IntegrityError:
+                duplicate = find_duplicate_import(content_hash, exclude_id=mock_product_obj.id)
                 
+                if not duplicate:
+                    raise
+        
+        if duplicate:
+            mock_product_obj.status = MockProductData.DUPLICATE
+            mock_product_obj.content_hash = content_hash
+            mock_product_obj.duplicate_of = duplicate
+            mock_product_obj.failure_reason = f"Duplicate of #{duplicate.id}"
+            mock_product_obj.save()
+            return mock_product_obj.failure_reason
+        
+        with transaction.atomic():
+            
             with open(file_path, 'rb') as f:
                 
                 file_name = os.path.basename(file_path)
@@ -46,116 +85,210 @@ def async_import_mock_products_file(self, file_path):
         mock_product_obj.save()
 
 
-@app.task(bind=True)
-def async_validate_and_populate_mock_products(self, mock_data_id):
+@app.task(bind=True, max_retries=3, default_retry_delay=60)
+def async_validate_and_populate_mock_products(self, mock_data_id, chunk_size=None, shard=None):
     
     mock_data = MockProductData.objects.get(id=mock_data_id)
     
-    if mock_data.status == MockProductData.FAILED:
+    if mock_data.status in (MockProductData.FAILED, MockProductData.DUPLICATE):
         return
     
-    mock_data.status = MockProductData.PROCESSING
-    mock_data.save()
+    # A shard keeps its own status, checkpoint and summary, the parent row is
+    # only finalized by async_finalize_sharded_mock_products
+    if shard is None:
+        import_state = mock_data
+    else:
+        import_state, _ = MockProductDataShard.objects.get_or_create(mock_data=mock_data, shard=shard)
+    
+    import_state.status = MockProductData.PROCESSING
+    import_state.save(update_fields=['status', 'updated_at'])
+    
+    chunk_size = chunk_size or settings.PRODUCT_IMPORT_CHUNK_SIZE
+    progress = ImportProgress(import_state)
     
     try:
         
-        with transaction.atomic():
+        file_path = mock_data.file.path
+        
+        missing_column = get_missing_column(read_columns(file_path))
         
-            file_path = mock_data.file.path
-            df = pd.read_csv(file_path)
+        if missing_column:
             
-            required_columns = ['sku', 'name', 'quantity', 'price']
-            df.columns = df.columns.str.lower()
+            import_state.status = MockProductData.FAILED
+            import_state.failure_reason = f"Missing column: {missing_column}"
+            import_state.save(update_fields=['status', 'failure_reason', 'updated_at'])
+            return
+        
+        chunks = MockProductDataChunk.objects.filter(mock_data=mock_data, shard=shard)
+        
+        if not import_state.processed_rows:
             
-            for col in required_columns:
-                
-                if col not in df.columns:
-                    
-                    mock_data.status = MockProductData.FAILED
-                    mock_data.failure_reason = f"Missing column: {col}"
-                    mock_data.save()
-                    return
+            chunks.delete()
             
-            updated_products = []
-            newly_created_products = []
-            discarded_products = []
+            if shard is None:
+                start_progress(mock_data, file_path)
+        
+        # A shard reads the rows partition_shards wrote for it, its
+        # checkpoint counts rows of that file
+        if shard is None:
+            chunk_iterator = iter_product_chunks(file_path, chunk_size, offset=import_state.processed_rows)
+        else:
+            chunk_iterator = iter_shard_chunks(get_shard_path(file_path, shard), chunk_size, offset=import_state.processed_rows)
+        
+        # Every chunk commits with its checkpoint and its own summary row, a
+        # retry resumes after the last committed row instead of starting over
+        for chunk in chunk_iterator:
             
-            for index, row in df.iterrows():
-                
-                if row.isnull().all():
-                    continue
+            first_row = import_state.processed_rows
+            processed_rows = first_row + len(chunk)
+            
+            with transaction.atomic():
                 
-                if not row['sku'] or not row['name'] or pd.isnull(row['quantity']) or pd.isnull(row['price']):
-                    discarded_products.append(row.to_dict())
-                    continue
+                chunk_summary = upsert_products(chunk, with_positions=shard is not None)
                 
-                product_data = {
-                    'sku': row['sku'],
-                    'name': row['name'],
-                    'quantity': row['quantity'],
-                    'price': row['price']
-                }
+                if any(chunk_summary.values()):
+                    MockProductDataChunk.objects.create(mock_data=mock_data, shard=shard, first_row=first_row, changes_summary=chunk_summary)
                 
-                existing_product = Product.objects.filter(sku=row['sku'])
+                progress_fields = progress.add(len(chunk), chunk_summary)
                 
-                if existing_product.exists():
-                    
-                    existing_product = existing_product.first()
-                    
-                    changes = []
-                    
-                    if existing_product.quantity != row['quantity']:
-                        changes.append(f"Quantity From: {existing_product.quantity} >>> To: {row['quantity']}")
-                        
-                    if existing_product.price != row['price']:
-                        changes.append(f"Price From: {existing_product.price} >>> To: {row['price']}")
-                    
-                    if changes:
-                        
-                        updated_products.append({
-                            'sku': existing_product.sku,
-                            'name': existing_product.name,
-                            'changes': "\n".join(changes),
-                        })
-                    
-                        existing_product.quantity = row['quantity']
-                        existing_product.price = row['price']
-                        existing_product.save()
-                                    
-                else:
-                    
-                    serializer = ProductSerializer(data=product_data)
-                    
-                    if not serializer.is_valid():
-                        discarded_products.append(product_data)
-                        continue
-                        
-                    serializer.save()
-                    
-                    newly_created_products.append({
-                        'sku': serializer.instance.sku,
-                        'name': serializer.instance.name,
-                        'price': serializer.instance.price,
-                        'quantity': serializer.instance.quantity,
-                    })
-                    
-                                                
-            mock_data.status = MockProductData.COMPLETED
+                import_state.processed_rows = processed_rows
+                import_state.save(update_fields=['processed_rows', 'updated_at'] + progress_fields)
+        
+        progress.flush()
+        
+        # Sharded summaries are assembled by async_finalize_sharded_mock_products
+        if shard is None:
             
-            mock_data.changes_summary = {
-                'created': newly_created_products,
-                'updated': updated_products,
-                'discarded': discarded_products,
-            }
-            mock_data.save()
+            with transaction.atomic():
+                import_state.changes_summary = merge_summaries(
+                    summary for summary in chunks.order_by('first_row').values_list('changes_summary', flat=True).iterator()
+                )
+                import_state.status = MockProductData.COMPLETED
+                import_state.save(update_fields=['changes_summary', 'status', 'updated_at'])
+                chunks.delete()
+        
+        else:
+            import_state.status = MockProductData.COMPLETED
+            import_state.save(update_fields=['status', 'updated_at'])
     
     except Exception as e:
         
         log.exception(traceback.format_exc())
         
+        if not self.request.called_directly and self.request.retries < self.max_retries:
+            raise self.retry(exc=e)
+        
+        import_state.status = MockProductData.FAILED
+        import_state.failure_reason = str(e)
+        import_state.save(update_fields=['status', 'failure_reason', 'updated_at'])
+
+
+@app.task(bind=True)
+def async_validate_and_populate_mock_products_sharded(self, mock_data_id, shard_count=None, chunk_size=None):
+    
+    mock_data = MockProductData.objects.get(id=mock_data_id)
+    
+    if mock_data.status in (MockProductData.FAILED, MockProductData.DUPLICATE):
+        return
+    
+    shard_count = shard_count or settings.PRODUCT_IMPORT_SHARD_COUNT
+    
+    chunk_size = chunk_size or settings.PRODUCT_IMPORT_CHUNK_SIZE
+    
+    mock_data.status = MockProductData.PROCESSING
+    mock_data.save()
+    
+    start_progress(mock_data, mock_data.file.path)
+    
+    # Shards split rows by SKU hash, so no two shards ever write the same
+    # product. The file is parsed once here instead of once per shard
+    partition_shards(mock_data.file.path, shard_count, chunk_size)
+    
+    for shard in range(shard_count):
+        MockProductDataShard.objects.get_or_create(mock_data=mock_data, shard=shard)
+    
+    shard_tasks = group(
+        async_validate_and_populate_mock_products.s(
+            mock_data_id,
+            chunk_size=chunk_size,
+            shard=shard
+        )
+        for shard in range(shard_count)
+    )
+    
+    chord(shard_tasks)(async_finalize_sharded_mock_products.s(mock_data_id))
+
+
+@app.task(bind=True)
+def async_finalize_sharded_mock_products(self, shard_results, mock_data_id):
+    
+    mock_data = MockProductData.objects.get(id=mock_data_id)
+    shards = list(mock_data.shards.order_by('shard'))
+    
+    failed_shards = [shard for shard in shards if shard.status != MockProductData.COMPLETED]
+    
+    # A new run partitions the file again
+    remove_shard_files(mock_data.file.path, len(shards))
+    
+    if failed_shards:
+        
         mock_data.status = MockProductData.FAILED
-        mock_data.failure_reason = str(e)
+        mock_data.failure_reason = "\n".join(
+            f"Shard {shard.shard}: {shard.failure_reason or shard.status}" for shard in failed_shards
+        )
+        mock_data.save()
+        return
+    
+    chunks = mock_data.chunks.order_by('shard', 'first_row')
+    
+    with transaction.atomic():
+        
+        mock_data.status = MockProductData.COMPLETED
+        mock_data.processed_rows = sum(shard.processed_rows for shard in shards)
+        mock_data.changes_summary = merge_shard_summaries(list(chunks.values_list('changes_summary', flat=True)))
         mock_data.save()
+        
+        chunks.delete()
+
+
+@app.task(bind=True)
+def async_build_search_index(self, batch_size=None, n_process=None):
+    
+    # Prefork pool workers are daemonic and may not start their own processes
+    if current_process().daemon:
+        n_process = 1
+    
+    return build_product_embeddings(batch_size=batch_size, n_process=n_process)
+
+
+@app.task(bind=True)
+def async_compact_lexical_index(self):
+    compact_lexical_index()
+
+
+@app.task(bind=True)
+def async_refresh_product_insights(self, low_stock_threshold=None, trending_days=None, trending_top_n=None):
+    
+    # Queued at most once per snapshot TTL, counter drift is corrected as often
+    recount_stock_counters()
+    
+    refresh_product_insights(
+        low_stock_threshold=low_stock_threshold,
+        trending_days=trending_days,
+        trending_top_n=trending_top_n
+    )
+
+
+@app.task(bind=True)
+def async_archive_product_history(self, retention_days=None, batch_size=None):
+    
+    archived = archive_product_history(retention_days=retention_days, batch_size=batch_size)
+    log.info(f"Archived {archived} product history rows")
+    
+    pruned = prune_hourly_rollups()
+    log.info(f"Deleted {pruned} expired hourly history rollups")
+    
+    return archived
 
 
 @app.task(bind=True)
@@ -176,6 +309,7 @@ def async_generate_inventory_update_report(self):
         
         created_products = []
         updated_products = []
+        discarded_products = []
         
         for mock_data in completed_mock_data:
             
@@ -201,6 +335,19 @@ def async_generate_inventory_update_report(self):
                 }
 
                 updated_products.append(updated_product)
+            
+            # Rows without a SKU or name, or without a whole quantity and
+            # price, are not imported at all
+            for product in changes_summary.get('discarded', []):
+                
+                discarded_product = {
+                    "Name" : product.get("name"),
+                    "SKU": product.get("sku"),
+                    "Price" : product.get('price', ''),
+                    "Quantity" : product.get('quantity', '')
+                }
+                
+                discarded_products.append(discarded_product)
         
         if created_products:
             
@@ -211,6 +358,10 @@ def async_generate_inventory_update_report(self):
             df_updated = pd.DataFrame(updated_products)
             df_updated.to_excel(writer, sheet_name='Updated', index=False)
         
+        if discarded_products:
+            df_discarded = pd.DataFrame(discarded_products)
+            df_discarded.to_excel(writer, sheet_name='Discarded', index=False)
+        
     send_email(
         subject="Inventory Update Report Last 7 days",
         body="Here is you shopify store inventory update made in past 7 days.\n Note : THIS IS UPDATE IS BASED ON MOCK PRODUCTS FILE UPLOAD",
@@ -1,11 +1,30 @@
 from rest_framework.test import APITestCase
 from rest_framework import status
 from django.urls import reverse
-from shopify.models import Product, MockProductData
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.db.models import F, Sum
+from django.utils import timezone
+from shopify.models import Product, MockProductData, MockProductDataChunk, MockProductDataShard, ProductCounter, ProductEmbedding, ProductHistory, ProductHistoryDaily, ProductHistoryHourly
+from shopify.rollups import backfill_history_rollups
+from shopify.insights import get_stock_counts
+from shopify.archive import archive_product_history, read_archived_history
+from shopify.importer import partition_shards, iter_shard_chunks
+from shopify.substring_search import FTS_TABLE, filter_contains, has_fts_table
+from shopify.ann import get_ivf_index, remove_ivf_index
+from shopify.lexical import compact_lexical_index, get_lexical_index, search_lexical
+from shopify.encoders import SpacyEncoder, get_nlp
+from shopify.search_cache import clear_search_caches
+from shopify.embedding_store import get_index_path, index_lock
+from shopify.utils import EMBEDDINGS_INDEX, REBUILD_LOCK, build_product_embeddings, detect_trending_products, encode_names, encode_query, get_cached_product_bundle, get_cached_product_embeddings, get_filter_mask, rank_products, remove_cache_embeddings, semantic_search, semantic_search_batch
 from rest_framework.authtoken.models import Token
 from django.contrib.auth.models import User, Permission, Group
+from unittest import mock
+from datetime import datetime, timedelta
 import os
 import pandas as pd
+import numpy as np
 import tempfile
 from shopify.tasks import *
 
@@ -31,9 +50,7 @@ class TestShopify(APITestCase):
         
         self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
         
-        cache_path = "/tmp/product_embeddings_cache.pkl"
-        if os.path.exists(cache_path):
-            os.remove(cache_path)
+        remove_cache_embeddings()
             
     def test_product_search(self):
         
@@ -130,4 +147,976 @@ class TestShopify(APITestCase):
             
             async_generate_inventory_update_report()
             
-            os.remove(tmp_file.name)
\ No newline at end of file
+            os.remove(tmp_file.name)
+
+    def test_inventory_report_lists_discarded_rows(self):
+        
+        df = pd.DataFrame({
+            'sku': ['REP-1', None, 'REP-3'],
+            'name': ['Reported Product', 'No Sku', '   '],
+            'quantity': [1, 2, 3],
+            'price': [10, 20, 30]
+        })
+        
+        with tempfile.NamedTemporaryFile(delete=False, mode='w', newline='', suffix='.csv') as tmp_file:
+            df.to_csv(tmp_file, index=False)
+        
+        async_import_mock_products_file(tmp_file.name)
+        mock_products = MockProductData.objects.all().order_by("-id").first()
+        async_validate_and_populate_mock_products(mock_products.id)
+        
+        sheets = {}
+        
+        # The report file is removed once sent, read it while it is attached
+        def read_report(file_path, **kwargs):
+            sheets.update(pd.read_excel(file_path, sheet_name=None))
+        
+        with mock.patch('shopify.tasks.send_email', side_effect=read_report):
+            async_generate_inventory_update_report()
+        
+        self.assertEqual(sheets['Created']['SKU'].tolist(), ['REP-1'])
+        self.assertEqual(sheets['Discarded']['Name'].tolist(), ['No Sku', '   '])
+        
+        os.remove(tmp_file.name)
+
+    def test_validate_mock_products_bulk_summary(self):
+        
+        Product.objects.create(name="Existing Product", sku="EX-1", price=100, quantity=10)
+        Product.objects.create(name="Unchanged Product", sku="EX-2", price=50, quantity=5)
+        
+        df = pd.DataFrame({
+            'SKU': ['EX-1', 'NEW-1', 'EX-2', None, 'NEW-1', 'NEW-2'],
+            'Name': ['Existing Product', 'New Product', 'Unchanged Product', 'No Sku', 'New Product', '   '],
+            'Quantity': [20, 5, 5, 1, 7, 3],
+            'Price': [120, 300, 50, 10, 300, 40]
+        })
+        
+        with tempfile.NamedTemporaryFile(delete=False, mode='w', newline='', suffix='.csv') as tmp_file:
+            df.to_csv(tmp_file, index=False)
+        
+        async_import_mock_products_file(tmp_file.name)
+        mock_products = MockProductData.objects.all().order_by("-id").first()
+        
+        async_validate_and_populate_mock_products(mock_products.id)
+        mock_products.refresh_from_db()
+        
+        summary = mock_products.changes_summary
+        
+        self.assertEqual(mock_products.status, MockProductData.COMPLETED)
+        self.assertEqual(summary['created'], [{'sku': 'NEW-1', 'name': 'New Product', 'price': 300, 'quantity': 5}])
+        self.assertEqual([product['sku'] for product in summary['updated']], ['EX-1', 'NEW-1'])
+        self.assertEqual(summary['updated'][0]['changes'], "Quantity From: 10 >>> To: 20\nPrice From: 100 >>> To: 120")
+        self.assertEqual(len(summary['discarded']), 2)
+        
+        self.assertEqual(Product.objects.get(sku="NEW-1").quantity, 7)
+        self.assertEqual(ProductHistory.objects.filter(product__sku="EX-1").count(), 2)
+        
+        os.remove(tmp_file.name)
+
+    def test_validate_mock_products_resumes_from_checkpoint(self):
+        
+        df = pd.DataFrame({
+            'sku': ['CH-1', 'CH-2', 'CH-3', 'CH-4', 'CH-5'],
+            'name': ['Chunk 1', 'Chunk 2', 'Chunk 3', 'Chunk 4', 'Chunk 5'],
+            'quantity': [1, 2, 3, 4, 5],
+            'price': [10, 20, 30, 40, 50]
+        })
+        
+        with tempfile.NamedTemporaryFile(delete=False, mode='w', newline='', suffix='.csv') as tmp_file:
+            df.to_csv(tmp_file, index=False)
+        
+        async_import_mock_products_file(tmp_file.name)
+        mock_products = MockProductData.objects.all().order_by("-id").first()
+        
+        # Simulate a run that committed the first two rows before dying
+        mock_products.processed_rows = 2
+        mock_products.save()
+        MockProductDataChunk.objects.create(mock_data=mock_products, first_row=0, changes_summary={'created': [{'sku': 'CH-1'}, {'sku': 'CH-2'}], 'updated': [], 'discarded': []})
+        
+        async_validate_and_populate_mock_products(mock_products.id, chunk_size=2)
+        mock_products.refresh_from_db()
+        
+        self.assertEqual(mock_products.status, MockProductData.COMPLETED)
+        self.assertEqual(mock_products.processed_rows, 5)
+        self.assertEqual([product['sku'] for product in mock_products.changes_summary['created']], ['CH-1', 'CH-2', 'CH-3', 'CH-4', 'CH-5'])
+        self.assertFalse(Product.objects.filter(sku__in=['CH-1', 'CH-2']).exists())
+        self.assertEqual(Product.objects.filter(sku__in=['CH-3', 'CH-4', 'CH-5']).count(), 3)
+        
+        # Chunk summaries are only kept until the import completes
+        self.assertFalse(MockProductDataChunk.objects.filter(mock_data=mock_products).exists())
+        
+        os.remove(tmp_file.name)
+
+    def test_validate_mock_products_keeps_numeric_skus(self):
+        
+        # The second chunk has a gap in the sku column
+        with tempfile.NamedTemporaryFile(delete=False, mode='w', newline='', suffix='.csv') as tmp_file:
+            tmp_file.write("sku,name,quantity,price\n0123,Numeric 1,1,10\n456,Numeric 2,2,20\n789,Numeric 3,3,30\n,Numeric 4,4,40\n")
+        
+        async_import_mock_products_file(tmp_file.name)
+        mock_products = MockProductData.objects.all().order_by("-id").first()
+        
+        async_validate_and_populate_mock_products(mock_products.id, chunk_size=2)
+        
+        self.assertEqual(sorted(Product.objects.filter(name__startswith='Numeric').values_list('sku', flat=True)), ['0123', '456', '789'])
+        
+        os.remove(tmp_file.name)
+
+    def test_validate_mock_products_sharded(self):
+        
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        for suffix, prefix in (('.csv', 'SH'), ('.parquet', 'SHP')):
+            
+            Product.objects.create(name="Sharded Existing", sku=f"{prefix}-0", price=10, quantity=1)
+            
+            skus = [f'{prefix}-{index}' for index in range(8)]
+            quantities = list(range(2, 10))
+            
+            # The quantity gap of a Parquet source must not turn the other
+            # rows into floats on their way through the shard files
+            if suffix == '.parquet':
+                skus.append(f'{prefix}-8')
+                quantities.append(None)
+            
+            table = pa.table({
+                'sku': skus,
+                'name': [f'Sharded {index}' for index in range(len(skus))],
+                'quantity': pa.array(quantities, type=pa.int64()),
+                'price': pa.array([10] * len(skus), type=pa.int64())
+            })
+            
+            tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
+            
+            if suffix == '.csv':
+                table.to_pandas().to_csv(tmp_file.name, index=False)
+            else:
+                pq.write_table(table, tmp_file.name, row_group_size=4)
+            
+            async_import_mock_products_file(tmp_file.name)
+            mock_products = MockProductData.objects.all().order_by("-id").first()
+            
+            # Partition once, then run every shard inline, the way the chord
+            # would on separate workers
+            shard_paths = partition_shards(mock_products.file.path, 3, 3)
+            
+            self.assertEqual(sum(len(chunk) for shard_path in shard_paths for chunk in iter_shard_chunks(shard_path, 3)), len(skus))
+            
+            for shard in range(3):
+                async_validate_and_populate_mock_products(mock_products.id, chunk_size=3, shard=shard)
+            
+            async_finalize_sharded_mock_products([], mock_products.id)
+            mock_products.refresh_from_db()
+            
+            self.assertEqual(mock_products.status, MockProductData.COMPLETED)
+            self.assertEqual(MockProductDataShard.objects.filter(mock_data=mock_products).count(), 3)
+            self.assertEqual([product['sku'] for product in mock_products.changes_summary['created']], [f'{prefix}-{index}' for index in range(1, 8)])
+            self.assertEqual(mock_products.changes_summary['updated'][0]['sku'], f'{prefix}-0')
+            self.assertEqual(mock_products.changes_summary['updated'][0]['changes'], "Quantity From: 1 >>> To: 2")
+            self.assertEqual(len(mock_products.changes_summary['discarded']), len(skus) - 8)
+            self.assertEqual((mock_products.rows_read, mock_products.rows_created, mock_products.rows_updated), (len(skus), 7, 1))
+            self.assertFalse(MockProductDataShard.objects.filter(mock_data=mock_products, rows_read__gt=0).exists())
+            self.assertEqual(Product.objects.filter(sku__startswith=f'{prefix}-').count(), 8)
+            self.assertFalse(any(os.path.exists(shard_path) for shard_path in shard_paths))
+            
+            os.remove(tmp_file.name)
+
+    def test_import_progress(self):
+        
+        df = pd.DataFrame({
+            'sku': ['PR-1', 'PR-2', None],
+            'name': ['Progress 1', 'Progress 2', 'Progress 3'],
+            'quantity': [1, 2, 3],
+            'price': [10, 20, 30]
+        })
+        
+        with tempfile.NamedTemporaryFile(delete=False, mode='w', newline='', suffix='.csv') as tmp_file:
+            df.to_csv(tmp_file, index=False)
+        
+        async_import_mock_products_file(tmp_file.name)
+        mock_products = MockProductData.objects.all().order_by("-id").first()
+        
+        async_validate_and_populate_mock_products(mock_products.id, chunk_size=2)
+        
+        response = self.client.get(reverse('import-progress', args=[mock_products.id]))
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["import"]["total_rows"], 3)
+        self.assertEqual(response.data["import"]["rows_read"], 3)
+        self.assertEqual(response.data["import"]["rows_created"], 2)
+        self.assertEqual(response.data["import"]["rows_discarded"], 1)
+        self.assertIsNone(response.data["import"]["eta_seconds"])
+        
+        MockProductData.objects.filter(id=mock_products.id).update(celery_task_id="progress-task")
+        
+        response = self.client.get(reverse('import-progress-by-task', args=["progress-task"]))
+        self.assertEqual(response.data["import"]["id"], mock_products.id)
+        
+        response = self.client.get(reverse('import-progress-by-task', args=["missing-task"]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        
+        os.remove(tmp_file.name)
+
+    def test_import_duplicate_file(self):
+        
+        df = pd.DataFrame({
+            'sku': ['DUP-1'],
+            'name': ['Duplicate Product'],
+            'quantity': [1],
+            'price': [10]
+        })
+        
+        with tempfile.NamedTemporaryFile(delete=False, mode='w', newline='', suffix='.csv') as tmp_file:
+            df.to_csv(tmp_file, index=False)
+        
+        async_import_mock_products_file(tmp_file.name)
+        first_import = MockProductData.objects.all().order_by("-id").first()
+        
+        # Still in flight
+        result = async_import_mock_products_file(tmp_file.name)
+        in_flight_duplicate = MockProductData.objects.all().order_by("-id").first()
+        
+        self.assertEqual(result, f"Duplicate of #{first_import.id}")
+        self.assertEqual(in_flight_duplicate.status, MockProductData.DUPLICATE)
+        self.assertEqual(in_flight_duplicate.duplicate_of, first_import)
+        self.assertFalse(in_flight_duplicate.file)
+        
+        async_validate_and_populate_mock_products(first_import.id)
+        async_import_mock_products_file(tmp_file.name)
+        completed_duplicate = MockProductData.objects.all().order_by("-id").first()
+        
+        async_validate_and_populate_mock_products(completed_duplicate.id)
+        completed_duplicate.refresh_from_db()
+        
+        self.assertEqual(completed_duplicate.status, MockProductData.DUPLICATE)
+        self.assertEqual(completed_duplicate.duplicate_of, first_import)
+        self.assertEqual(Product.objects.filter(sku="DUP-1").count(), 1)
+        
+        os.remove(tmp_file.name)
+
+    def test_import_stalled_duplicate_file(self):
+        
+        df = pd.DataFrame({
+            'sku': ['STALL-1'],
+            'name': ['Stalled Product'],
+            'quantity': [1],
+            'price': [10]
+        })
+        
+        with tempfile.NamedTemporaryFile(delete=False, mode='w', newline='', suffix='.csv') as tmp_file:
+            df.to_csv(tmp_file, index=False)
+        
+        async_import_mock_products_file(tmp_file.name)
+        stalled_import = MockProductData.objects.all().order_by("-id").first()
+        
+        # The worker died after its last progress write two hours ago
+        MockProductData.objects.filter(id=stalled_import.id).update(
+            status=MockProductData.PROCESSING,
+            progress_updated_at=timezone.now() - timedelta(hours=2)
+        )
+        
+        async_import_mock_products_file(tmp_file.name)
+        new_import = MockProductData.objects.all().order_by("-id").first()
+        stalled_import.refresh_from_db()
+        
+        self.assertEqual(stalled_import.status, MockProductData.FAILED)
+        self.assertEqual(new_import.status, MockProductData.PENDING)
+        self.assertIsNone(new_import.duplicate_of)
+        
+        async_validate_and_populate_mock_products(new_import.id)
+        new_import.refresh_from_db()
+        
+        self.assertEqual(new_import.status, MockProductData.COMPLETED)
+        self.assertEqual(Product.objects.filter(sku="STALL-1").count(), 1)
+        
+        os.remove(tmp_file.name)
+
+    def test_validate_mock_products_columnar_formats(self):
+        
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        table = pa.table({
+            'SKU': ['COL-1', 'COL-2', 'COL-3'],
+            'Name': ['Columnar 1', 'Columnar 2', 'Columnar 3'],
+            'Quantity': pa.array([5, None, 7], type=pa.int64()),
+            'Price': pa.array([100, 200, 300], type=pa.int64()),
+            'Description': ['not', 'read', 'at all']
+        })
+        
+        parquet_file = tempfile.NamedTemporaryFile(delete=False, suffix='.parquet')
+        pq.write_table(table, parquet_file.name, row_group_size=2)
+        
+        # No extension, detected from the Arrow IPC magic bytes
+        arrow_file = tempfile.NamedTemporaryFile(delete=False)
+        
+        with pa.OSFile(arrow_file.name, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table.slice(0, 2))
+        
+        for file_path in (parquet_file.name, arrow_file.name):
+            
+            async_import_mock_products_file(file_path)
+            mock_products = MockProductData.objects.all().order_by("-id").first()
+            
+            async_validate_and_populate_mock_products(mock_products.id, chunk_size=2)
+            mock_products.refresh_from_db()
+            
+            self.assertEqual(mock_products.status, MockProductData.COMPLETED)
+            self.assertEqual(mock_products.changes_summary['discarded'], [{'sku': 'COL-2', 'name': 'Columnar 2', 'quantity': None, 'price': 200}])
+            
+            os.remove(file_path)
+        
+        self.assertEqual(mock_products.changes_summary['created'], [])
+        self.assertEqual(list(Product.objects.filter(sku__startswith='COL-').order_by('sku').values_list('quantity', flat=True)), [5, 7])
+
+    def test_product_save_tracks_changes_without_select(self):
+        
+        Product.objects.create(name="Tracked Product", sku="TR-1", price=100, quantity=10)
+        product = Product.objects.get(sku="TR-1")
+        
+        with self.assertNumQueries(0):
+            product.save()
+        
+        product.quantity = 20
+        product.price = 150
+        
+        # One UPDATE, one bulk INSERT for both history rows and one upsert
+        # per rollup table
+        with self.assertNumQueries(4):
+            product.save()
+        
+        self.assertEqual(
+            sorted(ProductHistory.objects.filter(product=product).values_list('type', 'previous_quantity', 'current_quantity')),
+            [(ProductHistory.PRICE_CHANGE, 100, 150), (ProductHistory.STOCK_CHANGE, 10, 20)]
+        )
+        
+        with self.assertNumQueries(0):
+            product.save()
+        
+        # A refresh replaces the snapshot, setting the old value back is a change
+        Product.objects.filter(pk=product.pk).update(quantity=30)
+        product.refresh_from_db()
+        product.quantity = 20
+        product.save()
+        
+        self.assertEqual(Product.objects.get(pk=product.pk).quantity, 20)
+        
+        # Assigning a deferred field is written without loading it first
+        deferred = Product.objects.only('name').get(pk=product.pk)
+        deferred.quantity = 5
+        deferred.save()
+        
+        self.assertEqual(Product.objects.get(pk=product.pk).quantity, 5)
+        self.assertTrue(ProductHistory.objects.filter(product=product, previous_quantity=20, current_quantity=5).exists())
+
+    def test_embedding_cache_updates_incrementally(self):
+        
+        product = Product.objects.create(name="red shoe", sku="EM-1", price=100, quantity=10)
+        other_product = Product.objects.create(name="blue shirt", sku="EM-2", price=100, quantity=10)
+        
+        def cached_embeddings():
+            product_embeddings = get_cached_product_embeddings()
+            live = product_embeddings["deleted"] == 0
+            return dict(zip(product_embeddings["ids"][live].tolist(), product_embeddings["embeddings"][live]))
+        
+        embeddings = cached_embeddings()
+        other_vector = embeddings[other_product.id]
+        
+        # Served straight from the shared memory-mapped index file
+        self.assertIsInstance(get_cached_product_embeddings()["embeddings"], np.memmap)
+        
+        # Index files are only written once the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            product.quantity = 5
+            product.price = 80
+            product.save()
+        
+        self.assertTrue((cached_embeddings()[product.id] == embeddings[product.id]).all())
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            product.name = "green phone"
+            product.save()
+        
+        embeddings = cached_embeddings()
+        self.assertFalse((embeddings[product.id] == embeddings[other_product.id]).all())
+        self.assertTrue((embeddings[other_product.id] == other_vector).all())
+        
+        with self.captureOnCommitCallbacks() as callbacks:
+            new_product = Product.objects.create(name="smart bulb", sku="EM-3", price=100, quantity=10)
+        
+        self.assertNotIn(new_product.id, cached_embeddings())
+        
+        for callback in callbacks:
+            callback()
+        
+        self.assertIn(new_product.id, cached_embeddings())
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            other_product.delete()
+        
+        self.assertEqual(set(cached_embeddings()), {product.id, new_product.id})
+    
+    @override_settings(SEMANTIC_SEARCH_COMPACT_MIN_ROWS=2, SEMANTIC_SEARCH_COMPACT_RATIO=0)
+    def test_embedding_cache_appends_and_flags_deletes(self):
+        
+        products = [Product.objects.create(name=name, sku=f"TL-{index}", price=100, quantity=10) for index, name in enumerate(["red phone", "blue phone", "usb cable"])]
+        
+        product_ids = [product.id for product in products]
+        
+        get_cached_product_bundle()
+        generation = os.path.realpath(get_index_path(EMBEDDINGS_INDEX))
+        
+        with mock.patch("shopify.tasks.async_build_search_index.delay") as delay:
+            
+            with self.captureOnCommitCallbacks(execute=True):
+                new_product = Product.objects.create(name="smart phone", sku="TL-LONGER-THAN-THE-OTHERS", price=100, quantity=10)
+            
+            with self.captureOnCommitCallbacks(execute=True):
+                products[0].delete()
+            
+            # Written into the rows reserved in the same generation
+            self.assertEqual(os.path.realpath(get_index_path(EMBEDDINGS_INDEX)), generation)
+            
+            meta, cached = get_cached_product_bundle()
+            self.assertEqual(cached["ids"].tolist(), product_ids + [new_product.id])
+            self.assertEqual(cached["live"].tolist(), [False, True, True, True])
+            
+            rows, _ = rank_products(encode_query("phone"), cached, 4, backend="exact", mask=get_filter_mask(cached, None))
+            self.assertEqual(sorted(cached["ids"][rows].tolist()), product_ids[1:] + [new_product.id])
+            delay.assert_not_called()
+            
+            # Past the threshold one rebuild is requested for the generation
+            with self.captureOnCommitCallbacks(execute=True):
+                Product.objects.create(name="power cable", sku="TL-4", price=100, quantity=10)
+            
+            with self.captureOnCommitCallbacks(execute=True):
+                products[1].delete()
+            
+            delay.assert_called_once_with()
+            self.assertTrue(get_cached_product_bundle()[0]["rebuild_requested"])
+        
+        build_product_embeddings(n_process=1)
+        
+        meta, cached = get_cached_product_bundle()
+        self.assertEqual(cached["ids"].tolist(), list(Product.objects.order_by('id').values_list('id', flat=True)))
+        self.assertEqual(meta["sorted_rows"], 3)
+        self.assertNotIn("live", cached)
+        self.assertNotIn("rebuild_requested", meta)
+    
+    def test_spacy_model_loads_lazily(self):
+        
+        self.assertEqual(get_nlp(), get_nlp())
+        self.assertEqual(get_nlp.cache_info().currsize, 1)
+        self.assertNotIn("parser", get_nlp().pipe_names)
+        self.assertNotIn("ner", get_nlp().pipe_names)
+        self.assertTrue(get_nlp()("phone").has_vector)
+    
+    def test_build_search_index_in_batches(self):
+        
+        names = ["red phone", "blue laptop", "green tablet", "smart watch", "usb cable"]
+        
+        for index, name in enumerate(names):
+            Product.objects.create(name=name, sku=f"BLD-{index}", price=100, quantity=10)
+        
+        self.assertEqual(build_product_embeddings(batch_size=2, n_process=1), len(names))
+        
+        cached = get_cached_product_embeddings()
+        
+        self.assertEqual(cached["ids"].tolist(), list(Product.objects.order_by('id').values_list('id', flat=True)))
+        self.assertEqual(cached["skus"].tolist(), [f"BLD-{index}".encode() for index in range(len(names))])
+        self.assertTrue(np.allclose(cached["embeddings"], encode_names(names)))
+    
+    @override_settings(SEMANTIC_SEARCH_BACKEND="ivf", SEMANTIC_SEARCH_IVF_NLIST=2, SEMANTIC_SEARCH_IVF_NPROBE=2)
+    def test_semantic_search_ivf_backend(self):
+        
+        names = ["red phone", "blue phone", "green laptop", "gaming laptop", "usb cable", "power cable"]
+        
+        for index, name in enumerate(names):
+            Product.objects.create(name=name, sku=f"ANN-{index}", price=100, quantity=10)
+        
+        # Probing every group gives the exhaustive ranking
+        self.assertEqual(
+            [product.sku for product, _ in semantic_search("phone", top_n=3)],
+            [product.sku for product, _ in semantic_search("phone", top_n=3, backend="exact")]
+        )
+        
+        def indexed_ids():
+            ivf = get_ivf_index(get_cached_product_embeddings())
+            return set(ivf["ids"][ivf["deleted"] == 0].tolist()) | set(ivf["delta_ids"][ivf["delta_deleted"] == 0].tolist())
+        
+        ivf = get_ivf_index(get_cached_product_embeddings())
+        self.assertEqual(len(ivf["centroids"]), 2)
+        generation = os.path.realpath(get_index_path("product_ivf"))
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            new_product = Product.objects.create(name="wireless phone", sku="ANN-6", price=100, quantity=10)
+        
+        self.assertIn(new_product.id, indexed_ids())
+        self.assertEqual(
+            [product.sku for product, _ in semantic_search("wireless phone", top_n=1)],
+            [new_product.sku]
+        )
+        
+        new_product_id = new_product.id
+        renamed = Product.objects.get(sku="ANN-0")
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            new_product.delete()
+            renamed.name = "power cable"
+            renamed.save()
+        
+        self.assertNotIn(new_product_id, indexed_ids())
+        self.assertEqual(len(indexed_ids()), len(names))
+        
+        # Deltas are written into the same generation until a rebuild
+        self.assertEqual(os.path.realpath(get_index_path("product_ivf")), generation)
+        
+        # A full delta is merged into the lists, the centroids stay
+        with override_settings(SEMANTIC_SEARCH_COMPACT_MIN_ROWS=1, SEMANTIC_SEARCH_COMPACT_RATIO=0), mock.patch("shopify.tasks.async_build_search_index.delay"):
+            
+            remove_ivf_index()
+            centroids = np.array(get_ivf_index(get_cached_product_embeddings())["centroids"])
+            
+            with self.captureOnCommitCallbacks(execute=True):
+                added = [Product.objects.create(name=f"phone case {index}", sku=f"ANN-D{index}", price=100, quantity=10) for index in range(3)]
+            
+            ivf = get_ivf_index(get_cached_product_embeddings())
+            self.assertTrue(np.allclose(ivf["centroids"], centroids))
+            self.assertEqual(len(ivf["delta_ids"]), 0)
+            self.assertTrue({product.id for product in added}.issubset(ivf["ids"].tolist()))
+    
+    def test_semantic_search_caches_repeated_queries(self):
+        
+        product = Product.objects.create(name="red phone", sku="QC-1", price=100, quantity=10)
+        Product.objects.create(name="usb cable", sku="QC-2", price=100, quantity=10)
+        
+        clear_search_caches()
+        
+        first = semantic_search("red  phone", top_n=1)
+        
+        with self.assertNumQueries(1):
+            self.assertEqual(semantic_search(" red phone ", top_n=1), first)
+        
+        response = self.client.get(reverse("semantic-search-cache"))
+        self.assertEqual(response.data["cache"]["results"]["hits"], 1)
+        self.assertEqual(response.data["cache"]["query_vectors"]["misses"], 1)
+        
+        # A rename writes a new index revision, the cached ranking is dropped
+        with self.captureOnCommitCallbacks(execute=True):
+            product.name = "usb charger"
+            product.save()
+        
+        semantic_search("red phone", top_n=1)
+        
+        response = self.client.get(reverse("semantic-search-cache"))
+        self.assertEqual(response.data["cache"]["results"]["misses"], 2)
+        self.assertEqual(response.data["cache"]["query_vectors"]["hits"], 1)
+    
+    def test_search_index_rebuild_swaps_generations(self):
+        
+        product = Product.objects.create(name="red phone", sku="GEN-1", price=100, quantity=10)
+        
+        previous = get_cached_product_embeddings()
+        index_path = get_index_path(EMBEDDINGS_INDEX)
+        previous_generation = os.path.realpath(index_path)
+        
+        self.assertTrue(os.path.islink(index_path))
+        
+        # Only one rebuild runs at a time
+        with index_lock(REBUILD_LOCK):
+            self.assertIsNone(build_product_embeddings(n_process=1))
+        
+        Product.objects.create(name="usb cable", sku="GEN-2", price=100, quantity=10)
+        self.assertEqual(build_product_embeddings(n_process=1), 2)
+        
+        # Arrays mapped from the previous generation stay readable
+        self.assertNotEqual(os.path.realpath(index_path), previous_generation)
+        self.assertEqual(previous["ids"].tolist(), [product.id])
+        self.assertEqual(len(get_cached_product_embeddings()["ids"]), 2)
+        
+        build_product_embeddings(n_process=1)
+        self.assertFalse(os.path.exists(previous_generation))
+    
+    def test_hybrid_search_with_filters(self):
+        
+        phone = Product.objects.create(name="red phone", sku="HYB-100", price=300, quantity=10)
+        cheap_phone = Product.objects.create(name="blue phone", sku="HYB-200", price=50, quantity=0)
+        cable = Product.objects.create(name="usb cable", sku="HYB-300", price=20, quantity=5)
+        
+        url = reverse("semantic_search")
+        
+        response = self.client.get(url, {"q": "hyb-300", "mode": "hybrid"})
+        self.assertEqual(response.data["results"][0]["sku"], cable.sku)
+        
+        response = self.client.get(url, {"q": "phone", "in_stock": "true", "max_price": 500})
+        self.assertEqual([result["sku"] for result in response.data["results"]], [phone.sku, cable.sku])
+        
+        # Stock changes reach the filter columns without a rebuild
+        with self.captureOnCommitCallbacks(execute=True):
+            cheap_phone.quantity = 3
+            cheap_phone.save()
+        
+        response = self.client.get(url, {"q": "phone", "in_stock": "true", "max_price": 100, "mode": "hybrid"})
+        self.assertEqual(response.data["results"][0]["sku"], cheap_phone.sku)
+        self.assertNotIn(phone.sku, [result["sku"] for result in response.data["results"]])
+        
+        # Renames reach the lexical index
+        with self.captureOnCommitCallbacks(execute=True):
+            cable.name = "usb charger"
+            cable.save()
+        
+        response = self.client.get(url, {"q": "charger", "mode": "hybrid"})
+        self.assertEqual(response.data["results"][0]["sku"], cable.sku)
+        
+        response = self.client.get(url, {"q": "phone", "price": "cheap"})
+        self.assertEqual(response.status_code, 400)
+    
+    @override_settings(SEMANTIC_SEARCH_LEXICAL_DELTA_LIMIT=1)
+    def test_lexical_delta_is_compacted_in_background(self):
+        
+        phone = Product.objects.create(name="red phone", sku="LXD-1", price=100, quantity=10)
+        cable = Product.objects.create(name="usb cable", sku="LXD-2", price=100, quantity=10)
+        
+        get_cached_product_bundle()
+        search_lexical("phone")
+        
+        with mock.patch("shopify.tasks.async_compact_lexical_index.delay") as delay:
+            
+            with self.captureOnCommitCallbacks(execute=True):
+                phone.name = "red charger"
+                phone.save()
+                cable.name = "usb charger"
+                cable.save()
+            
+            # Served from the delta until the queued build lands
+            self.assertEqual(sorted(search_lexical("charger")[0].tolist()), [phone.id, cable.id])
+            self.assertEqual(delay.call_count, 1)
+        
+        compact_lexical_index()
+        
+        (meta, _), (_, delta) = get_lexical_index()
+        self.assertEqual(meta["products"], 2)
+        self.assertEqual(len(delta["stale"]), 0)
+        self.assertEqual(sorted(search_lexical("charger")[0].tolist()), [phone.id, cable.id])
+        self.assertEqual(len(search_lexical("phone")[0]), 0)
+    
+    def test_batch_semantic_search(self):
+        
+        names = ["red phone", "usb cable", "gaming laptop", "smart watch", "green tablet"]
+        
+        for index, name in enumerate(names):
+            Product.objects.create(name=name, sku=f"BAT-{index}", price=100, quantity=10)
+        
+        queries = ["phone", "laptop", "watch", "phone"]
+        
+        clear_search_caches()
+        
+        expected = [[product.sku for product, _ in semantic_search(query, top_n=3)] for query in queries]
+        
+        clear_search_caches()
+        
+        self.assertEqual(
+            [[product.sku for product, _ in results] for results in semantic_search_batch(queries, top_n=3)],
+            expected
+        )
+        
+        response = self.client.post(reverse("semantic-search-batch"), {"queries": queries, "top_n": 2}, format="json")
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result["query"] for result in response.data["results"]], queries)
+        self.assertEqual([len(result["results"]) for result in response.data["results"]], [2, 2, 2, 2])
+        
+        response = self.client.post(reverse("semantic-search-batch"), {"queries": "phone"}, format="json")
+        self.assertEqual(response.status_code, 400)
+    
+    def test_int8_quantized_index(self):
+        
+        names = ["red phone", "blue phone", "usb cable", "gaming laptop", "smart watch", "green tablet"]
+        
+        for index, name in enumerate(names):
+            Product.objects.create(name=name, sku=f"Q8-{index}", price=100, quantity=index)
+        
+        expected = [product.sku for product, _ in semantic_search("phone", top_n=3)]
+        expected_in_stock = [product.sku for product, _ in semantic_search("phone", top_n=3, filters={"in_stock": True})]
+        meta, _ = get_cached_product_bundle()
+        self.assertEqual(meta["encoder"], "spacy:en_core_web_md")
+        self.assertIsNone(meta["quantization"])
+        
+        with override_settings(SEMANTIC_SEARCH_QUANTIZATION="int8", SEMANTIC_SEARCH_RESCORE_FACTOR=2):
+            
+            # A bundle built for another storage mode is served while one
+            # background rebuild is queued
+            with mock.patch("shopify.tasks.async_build_search_index.delay") as delay:
+                self.assertEqual([product.sku for product, _ in semantic_search("phone", top_n=3)], expected)
+                self.assertEqual([product.sku for product, _ in semantic_search("phone", top_n=2)], expected[:2])
+            
+            delay.assert_called_once_with()
+            self.assertTrue(get_cached_product_bundle()[0]["rebuild_requested"])
+            
+            build_product_embeddings(n_process=1)
+            
+            self.assertEqual([product.sku for product, _ in semantic_search("phone", top_n=3)], expected)
+            
+            meta, cached = get_cached_product_bundle()
+            self.assertEqual(meta["quantization"], "int8")
+            self.assertEqual(cached["codes"].dtype, np.int8)
+            
+            self.assertEqual(
+                [[product.sku for product, _ in results] for results in semantic_search_batch(["phone"], top_n=3, filters={"in_stock": True})],
+                [expected_in_stock]
+            )
+    
+    def test_rebuild_reuses_stored_embeddings(self):
+        
+        names = ["red phone", "blue laptop", "green tablet", "usb cable"]
+        
+        for index, name in enumerate(names):
+            Product.objects.create(name=name, sku=f"PE-{index}", price=100, quantity=10)
+        
+        build_product_embeddings(batch_size=2, n_process=1)
+        
+        stored = ProductEmbedding.objects.order_by('product_id')
+        self.assertEqual(stored.count(), len(names))
+        self.assertEqual(set(stored.values_list('encoder', flat=True)), {"spacy:en_core_web_md"})
+        self.assertTrue(np.allclose(np.frombuffer(stored.first().vector, dtype=np.float32), encode_names(names[:1])[0]))
+        
+        encoded = []
+        encode_stream = SpacyEncoder.encode_stream
+        
+        def counting_encode_stream(encoder, texts, batch_size, n_process=1):
+            texts = list(texts)
+            encoded.extend(texts)
+            return encode_stream(encoder, texts, batch_size, n_process=n_process)
+        
+        # A price only bulk update rebuilds from the stored vectors alone
+        Product.objects.update(price=200)
+        Product.objects.filter(sku="PE-3").update(name="power cable")
+        
+        with mock.patch.object(SpacyEncoder, "encode_stream", counting_encode_stream):
+            self.assertEqual(build_product_embeddings(batch_size=2, n_process=1), len(names))
+        
+        self.assertEqual(encoded, ["power cable"])
+        
+        cached = get_cached_product_embeddings()
+        self.assertEqual(cached["prices"].tolist(), [200] * len(names))
+        self.assertTrue(np.allclose(cached["embeddings"], encode_names(names[:3] + ["power cable"])))
+    
+    def test_detect_trending_products_aggregates_in_database(self):
+        
+        products = [Product.objects.create(name=f"Trend {index}", sku=f"TRD-{index}", price=100, quantity=50) for index in range(3)]
+        
+        for product, quantities in zip(products, ([40, 45], [10, 60], [49])):
+            for quantity in quantities:
+                product.quantity = quantity
+                product.save()
+        
+        # Late in the day, the change from 7.5 days ago then shares its daily
+        # bucket with the start of the window and only hourly rollups leave it out
+        now = timezone.now().replace(hour=23, minute=30)
+        
+        ProductHistory.objects.filter(product=products[1]).update(updated_at=now - timedelta(days=7, hours=12))
+        backfill_history_rollups(batch_size=2)
+        
+        # One grouped query on the rollups, one for the ranked products
+        with self.assertNumQueries(2):
+            trending = detect_trending_products(top_n=2, now=now)
+        
+        self.assertEqual([product.sku for product in trending], ["TRD-0", "TRD-2"])
+        self.assertEqual(trending[0].total_change, 15)
+        
+        self.assertEqual([product.sku for product in detect_trending_products(top_n=1, days=30)], ["TRD-1"])
+    
+    def test_history_rollups_match_backfill(self):
+        
+        product = Product.objects.create(name="Rolled Product", sku="RLP-1", price=100, quantity=50)
+        
+        for quantity, price in ((40, 100), (70, 120), (65, 90)):
+            product.quantity = quantity
+            product.price = price
+            product.save()
+        
+        fields = ('product_id', 'type', 'bucket', 'total_change', 'net_change', 'changes')
+        
+        def rollups(model):
+            return sorted(model.objects.values_list(*fields))
+        
+        hourly = rollups(ProductHistoryHourly)
+        daily = rollups(ProductHistoryDaily)
+        
+        self.assertEqual(
+            [(change_type, total_change, net_change, changes) for _, change_type, _, total_change, net_change, changes in daily],
+            [(ProductHistory.PRICE_CHANGE, 50, -10, 2), (ProductHistory.STOCK_CHANGE, 45, 15, 3)]
+        )
+        
+        self.assertEqual(backfill_history_rollups(), 5)
+        self.assertEqual(rollups(ProductHistoryHourly), hourly)
+        self.assertEqual(rollups(ProductHistoryDaily), daily)
+        
+        # SQLite before 3.24 has no upsert, the ORM path gives the same rows
+        with mock.patch("shopify.rollups.supports_upsert", return_value=False):
+            self.assertEqual(backfill_history_rollups(batch_size=2), 5)
+        
+        self.assertEqual(rollups(ProductHistoryHourly), hourly)
+        self.assertEqual(rollups(ProductHistoryDaily), daily)
+    
+    def test_product_insights_cached_with_counters(self):
+        
+        insights_url = reverse('insights')
+        
+        # An empty catalog has no low stock products instead of an error
+        with override_settings(PRODUCT_INSIGHTS_CACHE_TTL=0, PRODUCT_INSIGHTS_STALE_TTL=0):
+            self.assertEqual(self.client.get(insights_url).data["low_stock_percentage"], 0)
+        
+        # Counters are updated once the writes commit
+        with self.captureOnCommitCallbacks(execute=True):
+            products = [Product.objects.create(name=f"Counted {index}", sku=f"CNT-{index}", price=100, quantity=quantity) for index, quantity in enumerate([5, 20, 30, 40])]
+        
+        self.assertEqual(get_stock_counts(10), (4, 1))
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            products[1].quantity = 2
+            products[1].save()
+            products[0].quantity = 15
+            products[0].save()
+            products[2].quantity = 3
+            products[2].save()
+            products[3].delete()
+        
+        # Kept up to date by the writes, read without counting the catalog
+        with self.assertNumQueries(1):
+            self.assertEqual(get_stock_counts(10), (3, 2))
+        
+        self.assertEqual(get_stock_counts(20), (3, 3))
+        
+        response = self.client.get(insights_url, {"low_stock_threshold": 10, "trending_top_n": 1})
+        self.assertEqual(response.data["low_stock_percentage"], 66.67)
+        self.assertEqual(len(response.data["trending_products"]), 1)
+        
+        self.assertEqual(self.client.get(insights_url, {"trending_days": 0}).status_code, 400)
+        
+        # Past the TTL the stale snapshot is served while one refresh is queued
+        with self.captureOnCommitCallbacks(execute=True):
+            products[0].quantity = 1
+            products[0].save()
+        
+        with override_settings(PRODUCT_INSIGHTS_CACHE_TTL=0), mock.patch("shopify.tasks.async_refresh_product_insights.delay") as delay:
+            
+            self.assertEqual(self.client.get(insights_url, {"trending_top_n": 1}).data["low_stock_percentage"], 66.67)
+            self.assertEqual(self.client.get(insights_url, {"trending_top_n": 1}).data["low_stock_percentage"], 66.67)
+            
+            delay.assert_called_once_with(low_stock_threshold=10, trending_days=7, trending_top_n=1)
+        
+        # The refresh task also corrects counters that drifted
+        ProductCounter.objects.filter(name="products", stripe=0).update(value=F('value') + 5)
+        
+        async_refresh_product_insights(**delay.call_args[1])
+        self.assertEqual(get_stock_counts(10), (3, 3))
+        self.assertEqual(self.client.get(insights_url, {"trending_top_n": 1}).data["low_stock_percentage"], 100)
+    
+    def test_archive_product_history(self):
+        
+        product = Product.objects.create(name="Archived Product", sku="ARC-1", price=100, quantity=50)
+        
+        for quantity in (40, 30, 20, 10):
+            product.quantity = quantity
+            product.save()
+        
+        histories = list(ProductHistory.objects.filter(product=product).order_by('id'))
+        
+        # Two rows from January, one from February, one still in retention
+        for history, updated_at in zip(histories, (datetime(2024, 1, 5), datetime(2024, 1, 20), datetime(2024, 2, 3))):
+            ProductHistory.objects.filter(id=history.id).update(updated_at=timezone.make_aware(updated_at, timezone.utc))
+        
+        with tempfile.TemporaryDirectory() as archive_dir, override_settings(PRODUCT_HISTORY_ARCHIVE_DIR=archive_dir):
+            
+            self.assertEqual(archive_product_history(retention_days=30, batch_size=2), 3)
+            
+            self.assertEqual(list(ProductHistory.objects.values_list('id', flat=True)), [histories[3].id])
+            self.assertEqual(sorted(os.listdir(archive_dir)), ["2024-01", "2024-02"])
+            
+            january = read_archived_history(datetime(2024, 1, 1), datetime(2024, 2, 1))
+            self.assertEqual(january['id'].tolist(), [histories[0].id, histories[1].id])
+            self.assertEqual(january['current_quantity'].tolist(), [40, 30])
+            
+            self.assertEqual(len(read_archived_history(datetime(2024, 1, 10), datetime(2024, 3, 1), product_ids=[product.id])), 2)
+            self.assertEqual(len(read_archived_history(datetime(2024, 1, 1), datetime(2024, 3, 1), product_ids=[product.id + 1])), 0)
+            
+            # A full backfill reads the archived rows back, hourly buckets
+            # past their retention are not kept
+            self.assertEqual(backfill_history_rollups(batch_size=2), 4)
+            
+            self.assertEqual(ProductHistoryDaily.objects.aggregate(changes=Sum('changes'))['changes'], 4)
+            self.assertEqual(ProductHistoryDaily.objects.filter(bucket__lt=datetime(2024, 3, 1, tzinfo=timezone.utc)).count(), 3)
+            self.assertFalse(ProductHistoryHourly.objects.filter(bucket__lt=datetime(2024, 3, 1, tzinfo=timezone.utc)).exists())
+    
+    def test_product_list_cursor_pagination(self):
+        
+        for index in range(25):
+            Product.objects.create(name=f"Paged {index}", sku=f"PG-{index:02d}", price=100, quantity=10)
+        
+        # Ties on updated_at are broken by id
+        Product.objects.filter(sku__lt="PG-12").update(updated_at=timezone.now() - timedelta(days=1))
+        expected = list(Product.objects.order_by('-updated_at', '-id').values_list('sku', flat=True))
+        
+        url = reverse('product-list')
+        params = {"pagination": "cursor", "ordering": "-updated_at"}
+        
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        
+        self.assertFalse(any("COUNT(" in query["sql"] for query in queries.captured_queries))
+        self.assertNotIn("count", response.data)
+        self.assertIsNone(response.data["previous"])
+        
+        pages = [response.data]
+        
+        while pages[-1]["next"]:
+            pages.append(self.client.get(pages[-1]["next"]).data)
+        
+        self.assertEqual([len(page["results"]) for page in pages], [10, 10, 5])
+        self.assertEqual([product["sku"] for page in pages for product in page["results"]], expected)
+        
+        previous = self.client.get(pages[2]["previous"]).data
+        self.assertEqual(previous["results"], pages[1]["results"])
+        self.assertEqual(self.client.get(previous["previous"]).data["results"], pages[0]["results"])
+        
+        response = self.client.get(url, {"pagination": "cursor", "sku": "PG-1", "count": "exact"})
+        self.assertEqual(response.data["count"], 10)
+        self.assertEqual([product["sku"] for product in response.data["results"]], [f"PG-{index}" for index in range(10, 20)])
+        
+        self.assertEqual(self.client.get(url, {"pagination": "cursor", "cursor": "not-a-cursor"}).status_code, 400)
+        self.assertEqual(self.client.get(url, {"pagination": "cursor", "ordering": "price"}).status_code, 400)
+    
+    def test_product_list_indexed_substring_filters(self):
+        
+        for index, name in enumerate(["Wireless Phone", "Phone Case", "USB Cable", "Gaming Laptop", "Ph"]):
+            Product.objects.create(name=name, sku=f"SUB-{index}", price=100, quantity=10)
+        
+        renamed = Product.objects.get(sku="SUB-2")
+        renamed.name = "Phone Charger"
+        renamed.save()
+        Product.objects.filter(sku="SUB-1").delete()
+        
+        def indexed_and_scanned(field, value):
+            
+            indexed = list(filter_contains(Product.objects.order_by('id'), field, value).values_list('sku', flat=True))
+            
+            with override_settings(PRODUCT_SUBSTRING_INDEX=False):
+                scanned = list(filter_contains(Product.objects.order_by('id'), field, value).values_list('sku', flat=True))
+            
+            return indexed, scanned
+        
+        # Writes, renames and deletes reach the trigram table through its triggers
+        for field, value, expected in (("name", "phone", ["SUB-0", "SUB-2"]), ("name", "PH", ["SUB-0", "SUB-2", "SUB-4"]), ("sku", "ub-3", ["SUB-3"]), ("name", "cable", [])):
+            indexed, scanned = indexed_and_scanned(field, value)
+            self.assertEqual(indexed, expected)
+            self.assertEqual(scanned, expected)
+        
+        # The trigram tokenizer needs SQLite 3.34, older builds keep scanning
+        if has_fts_table(connection):
+            self.assertIn(FTS_TABLE, str(filter_contains(Product.objects.all(), "name", "phone").query))
+        
+        response = self.client.get(reverse('product-list'), {"name": "pho", "sku": "sub"})
+        self.assertEqual(sorted(product["sku"] for product in response.data["results"]), ["SUB-0", "SUB-2"])
@@ -6,5 +6,9 @@ urlpatterns = [
     path("products/", ProductView.as_view(), name="product-list"),
     path("update/inventory/", UpdateInventory.as_view(), name="update-inventory"),
     path("products/search/", SemanticSearchAPIView.as_view(), name="semantic_search"),
-    path("products/insights/", ProductsInsights.as_view(), name="insights")
+    path("products/search/batch/", SemanticSearchBatchAPIView.as_view(), name="semantic-search-batch"),
+    path("products/search/cache/", SemanticSearchCacheStatsView.as_view(), name="semantic-search-cache"),
+    path("products/insights/", ProductsInsights.as_view(), name="insights"),
+    path("imports/<int:pk>/progress/", ImportProgressView.as_view(), name="import-progress"),
+    path("imports/task/<str:celery_task_id>/progress/", ImportProgressView.as_view(), name="import-progress-by-task")
 ]
\ No newline at end of file
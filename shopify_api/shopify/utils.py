@@ -1,93 +1,840 @@
-from shopify.models import Product, ProductHistory
+from shopify.models import Product, ProductEmbedding
+from shopify.ann import get_ivf_index, remove_ivf_index, search_ivf, top_k, update_ivf_index
+from shopify.lexical import remove_lexical_index, search_lexical, update_lexical_index, write_lexical_index
+from shopify.search_cache import get_query_vector, get_query_vectors, get_results, normalize_query, set_results
+from shopify.rollups import get_top_changed_products
+from shopify.encoders import get_encoder, quantize_embeddings
+from shopify.embedding_store import BundleWriter, append_bundle, find_rows, get_index_path, index_lock, load_bundle, read_bundle, remove_bundle, touch_bundle
 import numpy as np
-import joblib
-import spacy
-from collections import defaultdict
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from datetime import timedelta
+from hashlib import sha256
+import logging
 import os
 
+log = logging.getLogger("django")
 
-nlp = spacy.load("en_core_web_md")
+EMBEDDINGS_INDEX = "product_embeddings"
+REBUILD_LOCK = "product_embeddings_rebuild"
+PRODUCT_COLUMNS = {"ids", "skus", "embeddings", "prices", "quantities", "deleted"}
+SCORE_CHUNK_ROWS = 65536
+ID_LOOKUP_BATCH_SIZE = 500
+SKU_BYTES = 64  # room for longer skus of products appended later
+DENSE_MASK_RATIO = 0.5
 
-def get_product_embeddings():
+_row_lookups = {}
+
+def warm_up_search():
     
-    products = Product.objects.all()
-    product_names = [product.name for product in products]
+    get_encoder().encode(["warm up"])
     
-    product_embeddings = [nlp(name).vector for name in product_names]
+    cache_path = get_index_path(EMBEDDINGS_INDEX)
     
-    return product_embeddings, products
+    if os.path.exists(cache_path):
+        load_bundle(cache_path)
 
-def get_cached_product_embeddings():
+def get_index_meta():
+    
+    # Recorded in the bundle, a bundle built with another encoder or
+    # storage mode is rebuilt instead of being mixed with new vectors
+    encoder = get_encoder()
+    
+    return {
+        "encoder": encoder.identifier,
+        "dimension": encoder.dimension,
+        "quantization": settings.SEMANTIC_SEARCH_QUANTIZATION
+    }
+
+def is_current_bundle(bundle):
+    
+    if bundle is None:
+        return False
+    
+    meta, product_embeddings = bundle
+    expected = get_index_meta()
+    
+    return PRODUCT_COLUMNS.issubset(product_embeddings) and all(meta.get(key) == value for key, value in expected.items())
+
+def is_usable_bundle(bundle):
+    
+    # Another storage mode only changes how the rows are scored, vectors of
+    # another encoder can't be compared with the query
+    if bundle is None:
+        return False
+    
+    meta, product_embeddings = bundle
+    expected = get_index_meta()
+    
+    return PRODUCT_COLUMNS.issubset(product_embeddings) and all(meta.get(key) == expected[key] for key in ("encoder", "dimension"))
+
+def encode_names(names):
+    return get_encoder().encode(list(names))
+
+def get_embedding_rows(embeddings, quantized):
+    
+    rows = {"embeddings": embeddings}
+    
+    if quantized:
+        rows["codes"], rows["scales"] = quantize_embeddings(embeddings)
+    
+    return rows
+
+def encode_skus(skus):
+    return np.array([sku.encode() for sku in skus], dtype=bytes)
+
+def get_product_columns(products):
+    
+    # Per product arrays stored next to the embeddings, filters run on
+    # them without touching the database
+    return {
+        "ids": np.array([product.id for product in products], dtype=np.int64),
+        "skus": encode_skus([product.sku for product in products]),
+        "prices": np.array([product.price for product in products], dtype=np.int64),
+        "quantities": np.array([product.quantity for product in products], dtype=np.int64)
+    }
+
+def get_compact_threshold(rows):
+    return max(settings.SEMANTIC_SEARCH_COMPACT_MIN_ROWS, int(settings.SEMANTIC_SEARCH_COMPACT_RATIO * rows))
+
+def should_compact(meta, rows, tombstones):
+    
+    # One background rebuild per generation, the next one starts over
+    if meta.get("rebuild_requested"):
+        return False
+    
+    sorted_rows = meta.get("sorted_rows", rows)
+    
+    return rows - sorted_rows + tombstones > get_compact_threshold(sorted_rows)
+
+def request_index_rebuild():
+    
+    from shopify.tasks import async_build_search_index
+    
+    try:
+        async_build_search_index.delay()
+    except Exception:
+        log.warning("Could not queue the search index rebuild", exc_info=True)
+
+def get_row_lookup(meta, product_embeddings):
+    
+    # Rows appended since the last rebuild are not sorted by id, they are
+    # found through their own sorted positions. Live rows come first when
+    # the id of a deleted product was added again
+    ids = product_embeddings["ids"]
+    sorted_rows = meta.get("sorted_rows", len(ids))
+    lookup = dict(product_embeddings)
+    
+    if sorted_rows < len(ids):
+        tail_ids = np.asarray(ids[sorted_rows:])
+        order = np.lexsort((product_embeddings["deleted"][sorted_rows:], tail_ids))
+        lookup["tail_rows"] = sorted_rows + order
+        lookup["tail_ids"] = tail_ids[order]
+    
+    if meta.get("tombstones"):
+        lookup["live"] = np.asarray(product_embeddings["deleted"]) == 0
+    
+    return lookup
+
+def hash_text(text):
+    return sha256(text.encode()).hexdigest()
+
+def iter_batches(values, batch_size=ID_LOOKUP_BATCH_SIZE):
+
+    # id__in lookups stay under the bound parameter limit of older SQLite
+    for start in range(0, len(values), batch_size):
+        yield values[start:start + batch_size]
+
+def is_stored_embedding(stored, encoder, text_hash, dimension):
+    
+    stored_encoder, stored_hash, vector = stored
+    
+    return stored_encoder == encoder.identifier and stored_hash == text_hash and vector is not None and len(vector) == dimension * 4
+
+def store_product_embeddings(product_ids, text_hashes, embeddings, encoder):
+    
+    product_ids = list(product_ids)
+    existing = set()
+    
+    # Products deleted while they were encoded have nothing to attach to
+    for batch in iter_batches(product_ids):
+        existing.update(Product.objects.filter(id__in=batch).values_list('id', flat=True))
+        ProductEmbedding.objects.filter(product_id__in=batch).delete()
+    
+    ProductEmbedding.objects.bulk_create([
+        ProductEmbedding(product_id=product_id, encoder=encoder.identifier, text_hash=text_hash, vector=vector.astype(np.float32).tobytes())
+        for product_id, text_hash, vector in zip(product_ids, text_hashes, embeddings) if product_id in existing
+    ], batch_size=1000)
+
+def get_product_embeddings(products):
+    
+    encoder = get_encoder()
+    dimension = encoder.dimension
+    text_hashes = [hash_text(product.name) for product in products]
+    
+    stored = {
+        product_id: (stored_encoder, text_hash, vector)
+        for batch in iter_batches([product.id for product in products])
+        for product_id, stored_encoder, text_hash, vector in ProductEmbedding.objects.filter(
+            product_id__in=batch
+        ).values_list('product_id', 'encoder', 'text_hash', 'vector')
+    }
+    
+    embeddings = np.empty((len(products), dimension), dtype=np.float32)
+    pending = []
+    
+    for position, (product, text_hash) in enumerate(zip(products, text_hashes)):
+        
+        if product.id in stored and is_stored_embedding(stored[product.id], encoder, text_hash, dimension):
+            embeddings[position] = np.frombuffer(stored[product.id][2], dtype=np.float32)
+        else:
+            pending.append(position)
+    
+    if pending:
+        
+        embeddings[pending] = encoder.encode([products[position].name for position in pending])
+        
+        store_product_embeddings(
+            [products[position].id for position in pending],
+            [text_hashes[position] for position in pending],
+            embeddings[pending],
+            encoder
+        )
+    
+    return embeddings
+
+def _build_product_embeddings(batch_size, n_process):
+    
+    # Products created while streaming are added by their own save
+    last_id = Product.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    products = Product.objects.filter(id__lte=last_id).order_by('id')
+    total = products.count()
     
-    cache_path = "/tmp/product_embeddings_cache.pkl"
+    encoder = get_encoder()
+    meta = get_index_meta()
+    writer = BundleWriter(get_index_path(EMBEDDINGS_INDEX))
+    
+    # Saves append to the reserved rows until a compaction is requested
+    # half way through them
+    capacity = total + 2 * get_compact_threshold(total)
     
     try:
-        product_embeddings, products = joblib.load(cache_path)
-    except FileNotFoundError:
         
-        product_embeddings, products = get_product_embeddings()
-        joblib.dump((product_embeddings, products), cache_path)
+        vectors = {"embeddings": writer.allocate("embeddings", (total, encoder.dimension), np.float32, capacity=capacity)}
+        
+        if meta["quantization"] == "int8":
+            vectors["codes"] = writer.allocate("codes", (total, encoder.dimension), np.int8, capacity=capacity)
+            vectors["scales"] = writer.allocate("scales", (total,), np.float32, capacity=capacity)
+        
+        product_ids, skus, prices, quantities = [], [], [], []
+        embeddings = vectors["embeddings"]
+        pending = []
+        
+        # Stored vectors of unchanged names are copied as they are, only
+        # new and renamed products go through the encoder
+        columns = products.values_list('id', 'sku', 'name', 'price', 'quantity', 'embedding__encoder', 'embedding__text_hash', 'embedding__vector')
+        
+        for product_id, sku, name, price, quantity, *stored in columns.iterator(chunk_size=batch_size):
+            
+            if len(product_ids) == total:
+                break
+            
+            row = len(product_ids)
+            text_hash = hash_text(name)
+            
+            product_ids.append(product_id)
+            skus.append(sku)
+            prices.append(price)
+            quantities.append(quantity)
+            
+            if is_stored_embedding(stored, encoder, text_hash, meta["dimension"]):
+                embeddings[row] = np.frombuffer(stored[2], dtype=np.float32)
+            else:
+                pending.append((row, product_id, name, text_hash))
+        
+        row = len(product_ids)
+        encoded_rows = 0
+        
+        # Pipe keeps the input order, blocks line up with the pending rows
+        for encoded in encoder.encode_stream((name for _, _, name, _ in pending), batch_size, n_process=n_process):
+            
+            block = pending[encoded_rows:encoded_rows + len(encoded)]
+            encoded_rows += len(encoded)
+            
+            embeddings[[position for position, _, _, _ in block]] = encoded
+            store_product_embeddings([product_id for _, product_id, _, _ in block], [text_hash for _, _, _, text_hash in block], encoded, encoder)
+        
+        if "codes" in vectors:
+            for start in range(0, row, SCORE_CHUNK_ROWS):
+                vectors["codes"][start:start + SCORE_CHUNK_ROWS], vectors["scales"][start:start + SCORE_CHUNK_ROWS] = quantize_embeddings(embeddings[start:start + SCORE_CHUNK_ROWS])
+        
+        for name, array in vectors.items():
+            
+            if isinstance(array, np.memmap):
+                array.flush()
+            
+            # Rows deleted since the count leave unused space at the end
+            writer.resize(name, row)
+        
+        skus = encode_skus(skus)
+        
+        writer.add("ids", np.array(product_ids, dtype=np.int64), capacity=capacity)
+        writer.add("skus", skus.astype(f"S{max(skus.itemsize, SKU_BYTES)}"), capacity=capacity)
+        writer.add("prices", np.array(prices, dtype=np.int64), capacity=capacity)
+        writer.add("quantities", np.array(quantities, dtype=np.int64), capacity=capacity)
+        writer.add("deleted", np.zeros(row, dtype=np.uint8), capacity=capacity)
+        
+        with index_lock(EMBEDDINGS_INDEX):
+            
+            writer.commit({**meta, "sorted_rows": row})
+            
+            # Centroids and postings are rebuilt from the new rows on the
+            # next search that needs them
+            remove_ivf_index()
+            remove_lexical_index()
+    
+    except BaseException:
+        writer.abort()
+        raise
     
-    return product_embeddings, products
+    return row
 
-def semantic_search(query, top_n=10):
+def _catch_up_product_embeddings(started_at):
     
-    query_embedding = nlp(query).vector
+    # Saves made while the new generation was encoded went to the previous
+    # one, they are applied again now that the new one is live
+    update_cache_embeddings(Product.objects.filter(updated_at__gte=started_at))
     
-    product_embeddings, products = get_cached_product_embeddings()
+    product_embeddings = get_row_lookup(*load_bundle(get_index_path(EMBEDDINGS_INDEX)))
     
-    similarities = []
+    product_ids = np.fromiter(Product.objects.values_list('id', flat=True).iterator(), dtype=np.int64)
+    deleted = ~np.isin(product_embeddings["ids"], product_ids)
     
-    for product_embedding in product_embeddings:
-        similarity = np.dot(query_embedding, product_embedding) / (np.linalg.norm(query_embedding) * np.linalg.norm(product_embedding))
-        similarities.append(similarity)
+    if "live" in product_embeddings:
+        deleted &= product_embeddings["live"]
+    
+    if deleted.any():
+        remove_cache_embeddings(product_embeddings["ids"][deleted].tolist())
+
+def _rebuild_product_embeddings(batch_size, n_process):
     
-    ranked_products = sorted(zip(products, similarities), key=lambda x: x[1], reverse=True)
+    # Margin for clocks of other workers that are slightly behind this one
+    started_at = timezone.now() - timedelta(minutes=1)
     
-    return ranked_products[:top_n]
+    rows = _build_product_embeddings(batch_size, n_process)
+    _catch_up_product_embeddings(started_at)
+    
+    return rows
 
-def get_product_insights():
+def build_product_embeddings(batch_size=None, n_process=None):
+    
+    batch_size = batch_size or settings.SEMANTIC_SEARCH_BUILD_BATCH_SIZE
+    n_process = n_process or settings.SEMANTIC_SEARCH_BUILD_PROCESSES
+    
+    # Searches and saves keep using the current generation meanwhile, a
+    # second rebuild started in the meantime is skipped
+    with index_lock(REBUILD_LOCK, blocking=False) as acquired:
+        
+        if not acquired:
+            return None
+        
+        rows = _rebuild_product_embeddings(batch_size, n_process)
     
-    low_stock_threshold = 10
-    low_stock_products = Product.objects.filter(quantity__lt=low_stock_threshold)
-    low_stock_percentage = (low_stock_products.count() / Product.objects.count()) * 100
+    if settings.SEMANTIC_SEARCH_BACKEND == "ivf":
+        get_ivf_index(get_cached_product_embeddings())
     
-    trending_products = detect_trending_products(top_n=5)
+    if settings.SEMANTIC_SEARCH_MODE == "hybrid":
+        write_lexical_index()
+    
+    return rows
 
-    return {
-        "low_stock_percentage": round(low_stock_percentage , 2),
-        "trending_products": [
-            {
-                "name" : product.name,
-                "price" : product.price,
-                "sku" : product.sku
-            }
-            for product in trending_products
-        ]
-    }
+def get_cached_product_bundle():
+    
+    cache_path = get_index_path(EMBEDDINGS_INDEX)
+    bundle = load_bundle(cache_path)
+    
+    # Bundles written before a column was added, or by another encoder,
+    # are rebuilt like a missing one
+    if not is_usable_bundle(bundle):
+        
+        # Only a cold start waits, and it waits for the single build
+        # running in the background instead of starting another
+        with index_lock(REBUILD_LOCK):
+            
+            bundle = load_bundle(cache_path)
+            
+            if not is_usable_bundle(bundle):
+                _rebuild_product_embeddings(settings.SEMANTIC_SEARCH_BUILD_BATCH_SIZE, 1)
+                bundle = load_bundle(cache_path)
     
-def detect_trending_products(top_n=10):
+    meta, product_embeddings = bundle
     
-    one_week_ago = timezone.now() - timedelta(days=7)
+    # Another storage mode is rebuilt in the background, this generation is
+    # served until the new one is published
+    if not is_current_bundle(bundle) and not meta.get("rebuild_requested"):
+        _request_rebuild(cache_path)
     
-    stock_changes = ProductHistory.objects.filter(updated_at__gte=one_week_ago).select_related('product')
+    # Derived once per revision and process
+    if meta["revision"] not in _row_lookups:
+        _row_lookups.clear()
+        _row_lookups[meta["revision"]] = get_row_lookup(meta, product_embeddings)
     
-    product_changes = defaultdict(int)
+    return meta, _row_lookups[meta["revision"]]
+
+def _request_rebuild(cache_path):
     
-    for change in stock_changes:
-        total_change = abs(change.current_quantity - change.previous_quantity)
-        product_changes[change.product] += total_change
+    with index_lock(EMBEDDINGS_INDEX):
+        
+        meta, _ = read_bundle(cache_path)
+        
+        if meta.get("rebuild_requested"):
+            return
         
-    sorted_products = sorted(product_changes.items(), key=lambda x: x[1], reverse=True)
+        touch_bundle(cache_path, meta={"rebuild_requested": True})
     
-    trending_products = [product for product, _ in sorted_products[:top_n]]
+    request_index_rebuild()
+
+def get_cached_product_embeddings():
     
-    return trending_products
+    _, product_embeddings = get_cached_product_bundle()
+    
+    return product_embeddings
 
-def remove_cache_embeddings():
+def update_cache_embeddings(products):
     
-    cache_path = "/tmp/product_embeddings_cache.pkl"
-    if os.path.exists(cache_path):
-        os.remove(cache_path)
\ No newline at end of file
+    # Index files are written once the caller's transaction commits, a
+    # rollback leaves them untouched and no row lock is held meanwhile.
+    # Outside a transaction this runs right away
+    transaction.on_commit(lambda: _update_cache_embeddings(products))
+
+def _update_cache_embeddings(products):
+    
+    cache_path = get_index_path(EMBEDDINGS_INDEX)
+    
+    # Nothing to patch until a search builds the cache, and that build
+    # already reads the current names
+    if not os.path.exists(cache_path):
+        return
+    
+    products = list(products)
+    
+    if not products:
+        return
+    
+    rows = get_product_columns(products)
+    embeddings = get_product_embeddings(products)
+    
+    update_ivf_index(rows["ids"], embeddings)
+    update_lexical_index(products)
+    
+    with index_lock(EMBEDDINGS_INDEX):
+        
+        if not os.path.exists(cache_path):
+            return
+        
+        meta, product_embeddings = read_bundle(cache_path, mode="r+")
+        
+        # Built by another encoder, the next search rebuilds it anyway
+        if not is_usable_bundle((meta, product_embeddings)):
+            return
+        
+        # Rows match the storage mode of the bundle, not of the settings
+        rows.update(get_embedding_rows(embeddings, "codes" in product_embeddings))
+        
+        positions, found = find_rows(get_row_lookup(meta, product_embeddings), rows["ids"])
+        appended = {name: values[~found] for name, values in rows.items()}
+        appended["deleted"] = np.zeros(len(appended["ids"]), dtype=np.uint8)
+        
+        compact = should_compact(meta, len(product_embeddings["ids"]) + len(appended["ids"]), meta.get("tombstones", 0))
+        fits = rows["skus"].itemsize <= product_embeddings["skus"].itemsize
+        
+        # Saved products already in the index are rewritten in place, every
+        # process sees the new rows through the shared mapping
+        if fits and found.any():
+            
+            for name, values in rows.items():
+                
+                if name != "ids":
+                    product_embeddings[name][positions[found]] = values[found]
+                    product_embeddings[name].flush()
+        
+        # New products go to the reserved tail, the rebuild merges them into
+        # the sorted rows
+        added = fits and len(appended["ids"]) > 0 and append_bundle(cache_path, appended, meta={"rebuild_requested": True} if compact else None)
+        
+        if not added:
+            
+            # Without room, or with a longer sku, they wait for that rebuild
+            if (not fits or len(appended["ids"])) and not meta.get("rebuild_requested"):
+                compact = True
+            
+            touch_bundle(cache_path, meta={"rebuild_requested": True} if compact else None)
+    
+    if compact:
+        request_index_rebuild()
+
+def update_cache_columns(products):
+    transaction.on_commit(lambda: _update_cache_columns(products))
+
+def _update_cache_columns(products):
+    
+    cache_path = get_index_path(EMBEDDINGS_INDEX)
+    
+    if not os.path.exists(cache_path):
+        return
+    
+    rows = get_product_columns(list(products))
+    
+    with index_lock(EMBEDDINGS_INDEX):
+        
+        if not os.path.exists(cache_path):
+            return
+        
+        meta, product_embeddings = read_bundle(cache_path, mode="r+")
+        positions, found = find_rows(get_row_lookup(meta, product_embeddings), rows["ids"])
+        
+        # Products missing from the index are added with their columns
+        # by the save or rebuild that adds their embedding
+        if not found.any():
+            return
+        
+        for name in ("prices", "quantities"):
+            product_embeddings[name][positions[found]] = rows[name][found]
+            product_embeddings[name].flush()
+        
+        # Unfiltered rankings don't depend on the columns and stay cached
+        touch_bundle(cache_path, field="columns_revision")
+
+def get_filter_mask(product_embeddings, filters):
+    
+    # Deleted rows stay in the index until the next rebuild
+    live = product_embeddings.get("live")
+    
+    if not filters:
+        return live
+    
+    prices = product_embeddings["prices"]
+    quantities = product_embeddings["quantities"]
+    mask = live.copy() if live is not None else np.ones(len(prices), dtype=bool)
+    
+    if filters.get("price") is not None:
+        mask &= prices == filters["price"]
+    
+    if filters.get("min_price") is not None:
+        mask &= prices >= filters["min_price"]
+    
+    if filters.get("max_price") is not None:
+        mask &= prices <= filters["max_price"]
+    
+    if filters.get("quantity") is not None:
+        mask &= quantities == filters["quantity"]
+    
+    if filters.get("in_stock"):
+        mask &= quantities > 0
+    
+    return mask
+
+def rank_products(query_embedding, product_embeddings, top_n, backend=None, nprobe=None, mask=None):
+    
+    backend = backend or settings.SEMANTIC_SEARCH_BACKEND
+    
+    if backend == "ivf":
+        return search_ivf(
+            get_ivf_index(product_embeddings),
+            product_embeddings,
+            query_embedding,
+            top_n,
+            max(1, nprobe or settings.SEMANTIC_SEARCH_IVF_NPROBE),
+            mask=mask
+        )
+    
+    rows = get_scored_rows(mask)
+    similarities = score_embeddings(product_embeddings, query_embedding, rows)
+    
+    if rows is None and mask is not None:
+        similarities[~mask] = -np.inf
+    
+    return _rescore(product_embeddings, query_embedding, similarities, top_n, rows)
+
+def get_scored_rows(mask):
+    
+    # Only rows passing a selective mask are scored. A mask keeping most
+    # rows, like the one of deleted rows, scores every row and drops the
+    # rest, copying the kept rows out would cost more
+    if mask is None or mask.mean() >= DENSE_MASK_RATIO:
+        return None
+    
+    return np.flatnonzero(mask)
+
+def score_embeddings(product_embeddings, query_embeddings, rows=None):
+    
+    # Rows are pre-normalized, so one matrix product gives the cosines
+    if "codes" not in product_embeddings:
+        
+        embeddings = product_embeddings["embeddings"]
+        embeddings = embeddings if rows is None else embeddings[rows]
+        
+        return query_embeddings @ embeddings.T if query_embeddings.ndim > 1 else embeddings @ query_embeddings
+    
+    codes, scales = product_embeddings["codes"], product_embeddings["scales"]
+    
+    if rows is not None:
+        codes, scales = codes[rows], scales[rows]
+    
+    queries = np.atleast_2d(query_embeddings)
+    similarities = np.empty((len(queries), len(codes)), dtype=np.float32)
+    
+    # int8 rows are widened a chunk at a time, a float copy of the whole
+    # matrix would undo the memory saving
+    for start in range(0, len(codes), SCORE_CHUNK_ROWS):
+        chunk = slice(start, start + SCORE_CHUNK_ROWS)
+        similarities[:, chunk] = (queries @ codes[chunk].astype(np.float32).T) * scales[chunk]
+    
+    return similarities if query_embeddings.ndim > 1 else similarities[0]
+
+def _rescore(product_embeddings, query_embedding, similarities, top_n, rows=None):
+    
+    quantized = "codes" in product_embeddings
+    best = top_k(similarities, top_n * settings.SEMANTIC_SEARCH_RESCORE_FACTOR if quantized else top_n)
+    best = best[np.isfinite(similarities[best])]
+    candidates = best if rows is None else rows[best]
+    
+    if not quantized:
+        return candidates, similarities[best]
+    
+    return _rescore_shortlist(product_embeddings, query_embedding, candidates, top_n)
+
+def _rescore_shortlist(product_embeddings, query_embedding, shortlist, top_n):
+    
+    # int8 scores only pick the shortlist, its float rows give the order
+    shortlist = np.sort(shortlist)
+    exact = product_embeddings["embeddings"][shortlist] @ query_embedding
+    best = top_k(exact, top_n)
+    
+    return shortlist[best], exact[best]
+
+def rank_hybrid(query, query_embedding, product_embeddings, top_n, backend=None, nprobe=None, mask=None):
+    
+    lexical_ids, lexical_scores = search_lexical(query)
+    
+    lexical_rows, found = find_rows(product_embeddings, lexical_ids)
+    lexical_rows, lexical_scores = lexical_rows[found], lexical_scores[found]
+    
+    if mask is not None:
+        allowed = mask[lexical_rows]
+        lexical_rows, lexical_scores = lexical_rows[allowed], lexical_scores[allowed]
+    
+    best_lexical = top_k(lexical_scores, settings.SEMANTIC_SEARCH_LEXICAL_CANDIDATES)
+    vector_rows, _ = rank_products(query_embedding, product_embeddings, top_n, backend=backend, nprobe=nprobe, mask=mask)
+    
+    # Both candidate sets are scored on both signals
+    rows = np.union1d(lexical_rows[best_lexical], vector_rows)
+    
+    lexical = np.zeros(len(rows), dtype=np.float32)
+    lexical[np.searchsorted(rows, lexical_rows[best_lexical])] = lexical_scores[best_lexical]
+    
+    weight = settings.SEMANTIC_SEARCH_HYBRID_VECTOR_WEIGHT
+    scores = weight * (product_embeddings["embeddings"][rows] @ query_embedding) + (1 - weight) * lexical
+    best = top_k(scores, top_n)
+    
+    return rows[best], scores[best]
+
+def rank_products_batch(query_embeddings, product_embeddings, top_n, mask=None):
+    
+    candidate_rows = get_scored_rows(mask)
+    rows_count = len(candidate_rows) if candidate_rows is not None else len(product_embeddings["ids"])
+    
+    quantized = "codes" in product_embeddings
+    k = min(top_n * settings.SEMANTIC_SEARCH_RESCORE_FACTOR if quantized else top_n, int(mask.sum()) if mask is not None else rows_count)
+    
+    # Queries are scored in blocks so the score matrix stays within budget
+    block_size = max(1, settings.SEMANTIC_SEARCH_BATCH_BLOCK_SCORES // max(rows_count, 1))
+    ranked = []
+    
+    for start in range(0, len(query_embeddings), block_size):
+        
+        block = query_embeddings[start:start + block_size]
+        
+        if k <= 0:
+            ranked.extend((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in block)
+            continue
+        
+        similarities = score_embeddings(product_embeddings, block, candidate_rows)
+        
+        if candidate_rows is None and mask is not None:
+            similarities[:, ~mask] = -np.inf
+        
+        best = top_k(similarities, k)
+        best_similarities = np.take_along_axis(similarities, best, axis=1)
+        
+        if candidate_rows is not None:
+            best = candidate_rows[best]
+        
+        if quantized:
+            ranked.extend(
+                _rescore_shortlist(product_embeddings, query_embedding, shortlist, top_n)
+                for query_embedding, shortlist in zip(block, best)
+            )
+        else:
+            ranked.extend(zip(best, best_similarities))
+    
+    return ranked
+
+def encode_query(query):
+    return get_encoder().encode([query])[0]
+
+def encode_queries(queries):
+    return get_encoder().encode(list(queries))
+
+def _get_search_options(backend, nprobe, mode, filters):
+    
+    return (
+        backend or settings.SEMANTIC_SEARCH_BACKEND,
+        nprobe or settings.SEMANTIC_SEARCH_IVF_NPROBE,
+        mode or settings.SEMANTIC_SEARCH_MODE,
+        {name: value for name, value in (filters or {}).items() if value is not None}
+    )
+
+def _get_results_key(meta, query, top_n, backend, nprobe, mode, filters):
+    
+    # Every index write gets a new revision, so cached rankings of older
+    # revisions are never served again
+    revision = meta['revision']
+    
+    if filters:
+        revision = f"{revision}.{meta.get('columns_revision', '')}"
+    
+    return f"{revision}:{mode}:{backend}:{nprobe if backend == 'ivf' else ''}:{top_n}:{sorted(filters.items())}:{query}"
+
+def _rank(query, query_embedding, product_embeddings, top_n, backend, nprobe, mode, mask):
+    
+    if mode == "hybrid":
+        rows, scores = rank_hybrid(query, query_embedding, product_embeddings, top_n, backend=backend, nprobe=nprobe, mask=mask)
+    else:
+        rows, scores = rank_products(query_embedding, product_embeddings, top_n, backend=backend, nprobe=nprobe, mask=mask)
+    
+    return list(zip(product_embeddings["ids"][rows].tolist(), scores.tolist()))
+
+def _hydrate(ranked_results):
+    
+    products = Product.objects.in_bulk([product_id for ranked in ranked_results for product_id, _ in ranked])
+    
+    return [
+        [(products[product_id], similarity) for product_id, similarity in ranked if product_id in products]
+        for ranked in ranked_results
+    ]
+
+def semantic_search(query, top_n=10, backend=None, nprobe=None, mode=None, filters=None):
+    
+    query = normalize_query(query)
+    backend, nprobe, mode, filters = _get_search_options(backend, nprobe, mode, filters)
+    
+    meta, product_embeddings = get_cached_product_bundle()
+    
+    results_key = _get_results_key(meta, query, top_n, backend, nprobe, mode, filters)
+    ranked = get_results(results_key)
+    
+    if ranked is None:
+        
+        query_embedding = get_query_vector(query, encode_query, namespace=meta["encoder"])
+        mask = get_filter_mask(product_embeddings, filters)
+        
+        ranked = _rank(query, query_embedding, product_embeddings, top_n, backend, nprobe, mode, mask)
+        set_results(results_key, ranked)
+    
+    return _hydrate([ranked])[0]
+
+def semantic_search_batch(queries, top_n=10, backend=None, nprobe=None, mode=None, filters=None):
+    
+    queries = [normalize_query(query) for query in queries]
+    backend, nprobe, mode, filters = _get_search_options(backend, nprobe, mode, filters)
+    
+    meta, product_embeddings = get_cached_product_bundle()
+    
+    results_keys = {query: _get_results_key(meta, query, top_n, backend, nprobe, mode, filters) for query in queries}
+    ranked = {query: get_results(results_key) for query, results_key in results_keys.items()}
+    missing = [query for query, results in ranked.items() if results is None]
+    
+    if missing:
+        
+        query_embeddings = get_query_vectors(missing, encode_queries, namespace=meta["encoder"])
+        mask = get_filter_mask(product_embeddings, filters)
+        
+        # Exhaustive vector ranking of every query is one matrix product,
+        # hybrid and IVF rankings reuse the batch encoded vectors
+        if mode != "hybrid" and backend != "ivf":
+            ids = product_embeddings["ids"]
+            missing_ranked = [
+                list(zip(ids[rows].tolist(), similarities.tolist()))
+                for rows, similarities in rank_products_batch(query_embeddings, product_embeddings, top_n, mask=mask)
+            ]
+        else:
+            missing_ranked = [
+                _rank(query, query_embedding, product_embeddings, top_n, backend, nprobe, mode, mask)
+                for query, query_embedding in zip(missing, query_embeddings)
+            ]
+        
+        for query, results in zip(missing, missing_ranked):
+            ranked[query] = results
+            set_results(results_keys[query], results)
+    
+    return _hydrate([ranked[query] for query in queries])
+
+def detect_trending_products(top_n=10, days=7, now=None):
+    
+    # Ranked from the rollups, the cost depends on products and buckets in
+    # the window instead of the number of changes
+    return get_top_changed_products(days, top_n, now=now)
+
+def remove_cache_embeddings(product_ids=None):
+    
+    cache_path = get_index_path(EMBEDDINGS_INDEX)
+    
+    if product_ids is None:
+        remove_bundle(cache_path)
+        remove_ivf_index()
+        remove_lexical_index()
+        return
+    
+    product_ids = np.array(list(product_ids), dtype=np.int64)
+    transaction.on_commit(lambda: _remove_cache_embeddings(product_ids))
+
+def _remove_cache_embeddings(product_ids):
+    
+    cache_path = get_index_path(EMBEDDINGS_INDEX)
+    
+    update_ivf_index(product_ids)
+    update_lexical_index(removed_ids=product_ids.tolist())
+    
+    if not os.path.exists(cache_path):
+        return
+    
+    with index_lock(EMBEDDINGS_INDEX):
+        
+        if not os.path.exists(cache_path):
+            return
+        
+        meta, product_embeddings = read_bundle(cache_path, mode="r+")
+        
+        # Built by another encoder, the next search rebuilds it anyway
+        if not is_usable_bundle((meta, product_embeddings)):
+            return
+        
+        positions, found = find_rows(get_row_lookup(meta, product_embeddings), product_ids)
+        
+        if not found.any():
+            return
+        
+        # Rows are only flagged, the matrix is compacted by a rebuild
+        deleted = np.unique(positions[found])
+        product_embeddings["deleted"][deleted] = 1
+        product_embeddings["deleted"].flush()
+        
+        tombstones = meta.get("tombstones", 0) + len(deleted)
+        compact = should_compact(meta, len(product_embeddings["ids"]), tombstones)
+        
+        touch_bundle(cache_path, meta={"tombstones": tombstones, **({"rebuild_requested": True} if compact else {})})
+    
+    if compact:
+        request_index_rebuild()
@@ -2,12 +2,17 @@ from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.response import Response
-from shopify.models import Product
-from shopify.serializers import ProductSerializer
+from shopify.models import Product, MockProductData
+from shopify.serializers import ProductSerializer, MockProductDataProgressSerializer
 from rest_framework.pagination import PageNumberPagination
+from shopify.pagination import KeysetPagination, PaginationError
+from shopify.substring_search import filter_contains
 from shopify.permissions import CanReadProducts, CanEditProducts
-from shopify.utils import semantic_search, get_product_insights
+from shopify.utils import semantic_search, semantic_search_batch
+from shopify.insights import get_product_insights
+from shopify.search_cache import get_search_cache_stats
 from django.db import transaction
+from django.conf import settings
 import traceback
 import logging
 
@@ -24,16 +29,23 @@ class ProductView(APIView):
         sku = request.GET.get("sku")
         price = request.GET.get("price")
         quantity = request.GET.get("quantity")
+        pagination = request.GET.get("pagination", "page")
+        
+        if pagination not in ("page", "cursor"):
+            return Response({
+                "success" : False,
+                "message" : "pagination must be page or cursor."
+            }, status=400)
         
         try:
         
             products = Product.objects.all()
 
             if name:
-                products = products.filter(name__icontains=name)
+                products = filter_contains(products, "name", name)
                 
             if sku:
-                products = products.filter(sku__icontains=sku)
+                products = filter_contains(products, "sku", sku)
                 
             if price:
                 products = products.filter(price=price)
@@ -41,19 +53,31 @@ class ProductView(APIView):
             if quantity:
                 products = products.filter(quantity=quantity)
             
-            if not products:
+            # EXISTS stops at the first match instead of loading every row
+            if not products.exists():
                 return Response({
                     "success": False,
                     "message": "No products found."
                 }, status=400)
             
-            paginator = PageNumberPagination()
-            paginator.page_size = 10
+            # Cursor pages seek by key, their cost does not grow with depth
+            if pagination == "cursor":
+                paginator = KeysetPagination()
+            else:
+                paginator = PageNumberPagination()
+                paginator.page_size = 10
+            
             result_page = paginator.paginate_queryset(products, request)
             
             serializer = ProductSerializer(result_page, many=True)
             
             return paginator.get_paginated_response(serializer.data)
+        
+        except PaginationError as e:
+            return Response({
+                "success" : False,
+                "message" : str(e)
+            }, status=400)
 
         except Exception as e:
             log.exception(traceback.format_exc())
@@ -125,6 +149,37 @@ class UpdateInventory(APIView):
                 "message" : "Internal Server Error"
             }, status=500)
         
+def get_search_options(params):
+    
+    mode = params.get('mode', None)
+    
+    if mode not in (None, "vector", "hybrid"):
+        return None, None, "mode must be vector or hybrid."
+    
+    try:
+        filters = {
+            name: int(params[name])
+            for name in ("price", "min_price", "max_price", "quantity")
+            if params.get(name) not in (None, "")
+        }
+    except (TypeError, ValueError):
+        return None, None, "Price and quantity filters must be integers."
+    
+    if str(params.get('in_stock', '')).lower() in ("1", "true"):
+        filters["in_stock"] = True
+    
+    return mode, filters, None
+
+def serialize_search_results(top_products):
+    
+    return [
+        {
+            "name": product.name,
+            "sku": product.sku,
+            "price": product.price
+        } for product, _ in top_products
+    ]
+
 class SemanticSearchAPIView(APIView):
     
     authentication_classes = [TokenAuthentication]
@@ -140,17 +195,19 @@ class SemanticSearchAPIView(APIView):
                 "message" : "Query params are required."
             }, status=400)
         
+        mode, filters, error = get_search_options(request.query_params)
+        
+        if error:
+            return Response({
+                "success" : False,
+                "message" : error
+            }, status=400)
+        
         try:
         
-            top_products = semantic_search(query, top_n=10)
+            top_products = semantic_search(query, top_n=10, mode=mode, filters=filters)
             
-            results = [
-                {
-                    "name": product.name,
-                    "sku": product.sku,
-                    "price": product.price
-                } for product, _ in top_products
-            ]
+            results = serialize_search_results(top_products)
             
             return Response({
                 "success" : True,
@@ -165,11 +222,139 @@ class SemanticSearchAPIView(APIView):
                 "message" : "Internal Server Error"
             }, status=500)
         
+class SemanticSearchBatchAPIView(APIView):
+    
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request, *args, **kwargs):
+        
+        queries = request.data.get('queries')
+        top_n = request.data.get('top_n', 10)
+        
+        if not isinstance(queries, list) or not queries or not all(isinstance(query, str) and query.strip() for query in queries):
+            return Response({
+                "success" : False,
+                "message" : "queries must be a list of search terms."
+            }, status=400)
+        
+        if len(queries) > settings.SEMANTIC_SEARCH_BATCH_MAX_QUERIES:
+            return Response({
+                "success" : False,
+                "message" : f"At most {settings.SEMANTIC_SEARCH_BATCH_MAX_QUERIES} queries per request."
+            }, status=400)
+        
+        if not isinstance(top_n, int) or not 1 <= top_n <= 100:
+            return Response({
+                "success" : False,
+                "message" : "top_n must be between 1 and 100."
+            }, status=400)
+        
+        mode, filters, error = get_search_options(request.data)
+        
+        if error:
+            return Response({
+                "success" : False,
+                "message" : error
+            }, status=400)
+        
+        try:
+        
+            batch_results = semantic_search_batch(queries, top_n=top_n, mode=mode, filters=filters)
+            
+            return Response({
+                "success" : True,
+                "results" : [
+                    {
+                        "query": query,
+                        "results": serialize_search_results(top_products)
+                    } for query, top_products in zip(queries, batch_results)
+                ]
+            })
+        
+        except Exception as e:
+            log.exception(traceback.format_exc())
+            log.exception(e)
+            return Response({
+                "success" : False,
+                "message" : "Internal Server Error"
+            }, status=500)
+        
+class SemanticSearchCacheStatsView(APIView):
+    
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request, *args, **kwargs):
+        return Response({
+            "success" : True,
+            "cache" : get_search_cache_stats()
+        })
+        
+INSIGHTS_PARAM_RANGES = {
+    "low_stock_threshold": (0, None),
+    "trending_days": (1, 365),
+    "trending_top_n": (1, 100),
+}
+
+def get_insights_options(params):
+    
+    options = {}
+    
+    for name, (minimum, maximum) in INSIGHTS_PARAM_RANGES.items():
+        
+        if params.get(name) in (None, ""):
+            continue
+        
+        try:
+            options[name] = int(params[name])
+        except (TypeError, ValueError):
+            return None, f"{name} must be an integer."
+        
+        if options[name] < minimum or (maximum is not None and options[name] > maximum):
+            return None, f"{name} must be between {minimum} and {maximum}." if maximum is not None else f"{name} must be at least {minimum}."
+    
+    return options, None
+
 class ProductsInsights(APIView):
     
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
     
     def get(self, request, *args, **kwargs):
-        insights = get_product_insights()
-        return Response(insights)
\ No newline at end of file
+        
+        options, error = get_insights_options(request.query_params)
+        
+        if error:
+            return Response({
+                "success" : False,
+                "message" : error
+            }, status=400)
+        
+        insights = get_product_insights(**options)
+        return Response(insights)
+    
+class ImportProgressView(APIView):
+    
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated, CanReadProducts]
+    
+    def get(self, request, pk=None, celery_task_id=None, *args, **kwargs):
+        
+        if pk is not None:
+            mock_data = MockProductData.objects.filter(pk=pk).first()
+        else:
+            mock_data = MockProductData.objects.filter(celery_task_id=celery_task_id).first()
+        
+        if not mock_data:
+            return Response({
+                "success" : False,
+                "message" : "Import not found."
+            }, status=404)
+        
+        serializer = MockProductDataProgressSerializer(mock_data)
+        
+        return Response({
+            "success" : True,
+            "import" : serializer.data
+        })
\ No newline at end of file
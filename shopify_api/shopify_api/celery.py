@@ -1,10 +1,19 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.signals import worker_process_init
 from django.conf import settings
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'wallet.settings')
 
 app = Celery('shopify_api')
 app.config_from_object('django.conf:settings', namespace='CELERY')
-app.autodiscover_tasks()
\ No newline at end of file
+app.autodiscover_tasks()
+
+
+@worker_process_init.connect
+def warm_up_worker(**kwargs):
+    
+    if settings.SEMANTIC_SEARCH_WARMUP:
+        from shopify.utils import warm_up_search
+        warm_up_search()
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
 from pathlib import Path
+from celery.schedules import crontab
 import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -147,6 +148,92 @@ CELERY_TIMEZONE = 'UTC'
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60
 
+CELERY_BEAT_SCHEDULE = {
+    "archive-product-history": {
+        "task": "shopify.tasks.async_archive_product_history",
+        "schedule": crontab(hour=3, minute=0),
+    },
+}
+
+PRODUCT_IMPORT_CHUNK_SIZE = 10000
+PRODUCT_IMPORT_SHARD_COUNT = 4
+PRODUCT_IMPORT_PROGRESS_INTERVAL = 2  # seconds between progress writes
+PRODUCT_IMPORT_STALL_TIMEOUT = 60 * 60  # seconds without progress before a PROCESSING import no longer blocks its file
+
+EMBEDDING_INDEX_DIR = "/tmp/product_embeddings"
+# "spacy" averages the static word vectors of SPACY_MODEL, "sentence-transformers"
+# runs SENTENCE_TRANSFORMERS_MODEL (a hub name or a local directory)
+SEMANTIC_SEARCH_ENCODER = os.environ.get("SEMANTIC_SEARCH_ENCODER", "spacy")
+SPACY_MODEL = "en_core_web_md"
+SENTENCE_TRANSFORMERS_MODEL = os.environ.get("SENTENCE_TRANSFORMERS_MODEL", "all-MiniLM-L6-v2")
+SEMANTIC_SEARCH_ENCODER_DEVICE = os.environ.get("SEMANTIC_SEARCH_ENCODER_DEVICE", "cpu")
+SEMANTIC_SEARCH_ENCODER_BATCH_SIZE = 64
+
+# "int8" scans a quantized copy of the vectors, about a quarter of the
+# memory, and rescores RESCORE_FACTOR * top_n candidates with the float rows
+SEMANTIC_SEARCH_QUANTIZATION = os.environ.get("SEMANTIC_SEARCH_QUANTIZATION") or None
+SEMANTIC_SEARCH_RESCORE_FACTOR = 4
+SEMANTIC_SEARCH_BUILD_BATCH_SIZE = 1000
+SEMANTIC_SEARCH_BUILD_PROCESSES = 4
+
+# Saves append new products to a reserved tail of the index and deletes only
+# flag their rows. Past COMPACT_RATIO of the sorted rows, or COMPACT_MIN_ROWS
+# on a small catalog, a background rebuild merges them
+SEMANTIC_SEARCH_COMPACT_RATIO = 0.1
+SEMANTIC_SEARCH_COMPACT_MIN_ROWS = 1000
+
+# "exact" scans every embedding, "ivf" only scores the products of the
+# SEMANTIC_SEARCH_IVF_NPROBE groups closest to the query. More probes raise
+# recall and latency, see manage.py benchmark_ann_recall
+SEMANTIC_SEARCH_BACKEND = os.environ.get("SEMANTIC_SEARCH_BACKEND", "exact")
+SEMANTIC_SEARCH_IVF_NLIST = None  # defaults to 4 * sqrt(products)
+SEMANTIC_SEARCH_IVF_NPROBE = 16
+
+# "hybrid" adds a token/trigram index over names and skus to the vector
+# scores, SKU and exact name queries then rank the matching product first
+SEMANTIC_SEARCH_MODE = os.environ.get("SEMANTIC_SEARCH_MODE", "vector")
+SEMANTIC_SEARCH_HYBRID_VECTOR_WEIGHT = 0.5
+SEMANTIC_SEARCH_LEXICAL_CANDIDATES = 1000
+SEMANTIC_SEARCH_LEXICAL_DELTA_LIMIT = 5000  # changed products before a background rebuild
+
+SEMANTIC_SEARCH_BATCH_MAX_QUERIES = 1000
+SEMANTIC_SEARCH_BATCH_BLOCK_SCORES = 32 * 1024 * 1024  # similarity scores held in memory at once
+
+# Query vectors and ranked product ids of repeated searches, kept per worker
+# and, when a Redis URL is set, shared between workers
+SEMANTIC_SEARCH_QUERY_CACHE_SIZE = 10000
+SEMANTIC_SEARCH_RESULT_CACHE_SIZE = 10000
+SEMANTIC_SEARCH_CACHE_TTL = 60 * 60
+SEMANTIC_SEARCH_CACHE_REDIS_URL = os.environ.get("SEMANTIC_SEARCH_CACHE_REDIS_URL")
+
+# Load the spaCy model and map the embedding index when a gunicorn or
+# Celery worker starts, instead of on its first search
+SEMANTIC_SEARCH_WARMUP = os.environ.get("SEMANTIC_SEARCH_WARMUP") == "1"
+
+# Product insights are served from a stored snapshot per parameter set. Past
+# the TTL the snapshot is still served while a Celery task recomputes it,
+# past TTL + STALE_TTL the request waits for a fresh one
+PRODUCT_INSIGHTS_CACHE_TTL = 30
+PRODUCT_INSIGHTS_STALE_TTL = 5 * 60
+PRODUCT_INSIGHTS_LOW_STOCK_THRESHOLD = 10  # maintained incrementally, other thresholds are counted
+PRODUCT_INSIGHTS_COUNTER_STRIPES = 8  # rows per counter, summed on read
+PRODUCT_INSIGHTS_TRENDING_DAYS = 7
+PRODUCT_INSIGHTS_TRENDING_TOP_N = 5
+
+# History rows older than the retention are moved to one directory of
+# zstd Parquet files per month and deleted in batches of the given size
+PRODUCT_HISTORY_RETENTION_DAYS = 90
+PRODUCT_HISTORY_ARCHIVE_DIR = os.path.join(MEDIA_ROOT, "product_history_archive")
+PRODUCT_HISTORY_ARCHIVE_BATCH_SIZE = 10000
+
+# Hourly rollups only serve windows up to 7 days, older buckets are deleted
+# by the archive task. Daily rollups are kept
+PRODUCT_HISTORY_HOURLY_ROLLUP_RETENTION_DAYS = 14
+
+# Product name and sku filters served by pg_trgm GIN indexes on PostgreSQL
+# and an FTS5 trigram table on SQLite, both created on migrate
+PRODUCT_SUBSTRING_INDEX = True
+
 EMAIL = ""
 EMAIL_PASSWORD = ""
 
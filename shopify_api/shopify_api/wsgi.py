@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'shopify_api.settings')
 
 application = get_wsgi_application()
+
+from django.conf import settings
+
+if settings.SEMANTIC_SEARCH_WARMUP:
+    from shopify.utils import warm_up_search
+    warm_up_search()